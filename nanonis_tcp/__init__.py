@@ -1,14 +1,32 @@
 # -*- encoding: utf-8 -*-
 '''
 @Time    :   2023/03/04 01:54:40
-@Author  :   Shixuan Shan 
+@Author  :   Shixuan Shan
 '''
-from .help import *
+# The classes have the names of their submodules, so they are imported here directly (a lazy
+# attribute would be replaced by the submodule once it is imported). What made the import slow
+# (scipy, requests, the Nanonis and Andor session setup) is deferred inside photon_meas and nanonis_ctrl.
+from .help import help, esr_meas_help
 from .tcp_ctrl import tcp_ctrl
 from .esr_meas import esr_meas
-from .data_proc import *
+from . import data_proc
 from .nanonis_ctrl import nanonis_ctrl
+from .tcp_pool import tcp_pool
+from .tcp_stats import tcp_stats
+from .tcp_journal import tcp_journal, journal_tcp, journal_server
+from .tcp_async import nanonis_async, andor_async
 from .andor_meas import andor_meas
 from .photon_meas import photon_meas
 from .tcp_andor_ctrl import tcp_andor_ctrl
-from .log_utils import apply_logging, init_logger
\ No newline at end of file
+from . import log_utils
+from .log_utils import apply_logging, init_logger, log_sampling_set, logger_stop
+
+__all__ = [
+    'help', 'esr_meas_help',
+    'tcp_ctrl', 'esr_meas', 'nanonis_ctrl', 'tcp_pool', 'tcp_stats',
+    'tcp_journal', 'journal_tcp', 'journal_server',
+    'nanonis_async', 'andor_async',
+    'andor_meas', 'photon_meas', 'tcp_andor_ctrl',
+    'apply_logging', 'init_logger', 'log_sampling_set', 'logger_stop',
+    'data_proc', 'log_utils',
+]
@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+'''
+Files the Andor server publishes over HTTP (andor.dat, andor.cal), read on a keep-alive session.
+
+    session = http_session()                                  # one pooled connection, reused by every request
+    stream = kinser_stream(session, 'http://host:1234/shm/andor.dat', points = 1024)
+    stream.series_start(andor_thread)                         # the kinetic series (AQR) is running
+    ...
+    stream.series_next()                                      # in the reading thread: the running series
+    stream.read_into(andor_array[i])                          # spectra completed so far, e.g. while the series runs
+
+andor.dat grows while a kinetic series is acquired. The reader asks only for the bytes it has
+not seen yet (HTTP range request "bytes=<offset>-") and parses the complete lines received,
+so the spectra of a line can be taken while the line is still being acquired, and the last
+read after the series costs the last spectrum instead of the whole file. Servers without range
+requests send the whole file (200), of which the new bytes are used.
+
+requests is imported by http_session only.
+'''
+############################### packages ######################################
+import threading
+import time
+from queue import Queue
+import numpy as np
+
+def http_session(pool_maxsize = 4):
+    '''requests.Session keeping its connections to the Andor server open (HTTP keep-alive)'''
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = pool_maxsize)
+    session.mount('http://', adapter)
+    return session
+
+class kinser_reader:
+    '''spectra of a kinetic series read from andor.dat while it grows'''
+    def __init__(self, session, url, points):
+        """
+       Parameters
+       session         : requests.Session (see http_session)
+       url             : URL of andor.dat
+       points          : values per spectrum
+       """
+        self.session = session
+        self.url = url
+        self.points = points
+        self.first = b''                # first line of the series
+        self.start()
+
+    def start(self):
+        '''a new series: andor.dat is read from its start'''
+        self.stale, self.first = self.first, b'' # andor.dat starting with this is still the one of the last series
+        self.offset = 0                 # bytes of andor.dat received
+        self.tail = b''                 # received bytes after the last complete line
+        self.values = np.empty(0)       # values of the spectrum not complete yet
+        self.frames = 0                 # spectra returned
+
+    def poll(self, final = False):
+        '''
+        spectra completed since the last poll, (spectra, points) array. final: the file is complete,
+        also the values after the last line end are used.
+        '''
+        response = self.session.get(self.url, headers = {'Range': f'bytes={self.offset}-'} if self.offset else None)
+        if response.status_code == 416: # nothing new
+            content = b''
+        elif response.status_code in (200, 206):
+            content = response.content
+            if response.status_code == 200 and self.offset: # server without range requests: the whole file
+                content = content[self.offset:]
+        else:
+            raise ValueError(f"Error: {response.status_code}")
+        if self.offset == 0 and self.stale:
+            if content[:len(self.stale)] == self.stale[:len(content)]: # the new series has not started the file yet
+                content = b''
+            else:
+                self.stale = b''
+        self.offset += len(content)
+
+        data = self.tail + content
+        if not self.first and b'\n' in data:
+            self.first = data[:data.index(b'\n') + 1]
+        end = len(data) if final else data.rfind(b'\n') + 1
+        self.tail = data[end:]
+        values = np.array(data[:end].split(), dtype = float)
+        if len(self.values):
+            values = np.concatenate((self.values, values))
+        num = len(values) // self.points
+        self.values = values[num*self.points:]
+        self.frames += num
+        return values[:num*self.points].reshape(num, self.points)
+
+class kinser_stream:
+    '''
+    Hands the running kinetic series from the measurement thread (series_start) to the thread
+    reading its spectra (series_next, read_into). idle is set when the spectra of the last series
+    are read, a new series (which starts a new andor.dat) should wait for it.
+    '''
+    def __init__(self, session, url, points):
+        self.reader = kinser_reader(session, url, points)
+        self.series = Queue()
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def series_start(self, thread):
+        '''thread (running the AQR command) has started its kinetic series'''
+        self.idle.clear()
+        self.series.put(thread)
+
+    def series_next(self):
+        '''thread of the next series, None when the measurement has ended (see close)'''
+        thread = self.series.get()
+        self.reader.start()
+        return thread
+
+    def read_into(self, frames, final = False, timeout = 1., interval = 0.01):
+        '''
+        write the spectra received since the last call into the next rows of frames (one row per
+        spectrum of the series). final: the series has ended, read until all rows are written or
+        timeout (s). Returns the number of rows written so far.
+        '''
+        t_end = time.perf_counter() + timeout
+        while True:
+            first = self.reader.frames
+            new = self.reader.poll(final = final)
+            num = min(len(new), len(frames) - first)
+            frames[first: first + num] = new[:num]
+            if not final or self.reader.frames >= len(frames) or time.perf_counter() > t_end:
+                return min(self.reader.frames, len(frames))
+            time.sleep(interval)
+
+    def close(self):
+        '''no more series: series_next returns None'''
+        self.series.put(None)
+        self.idle.set()
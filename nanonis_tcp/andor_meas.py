@@ -6,12 +6,35 @@ Created on Wed Aug 28 14:54:20 2024
 """
 
 import pickle
+import socket
 import pandas as pd
 from os import mkdir
 from os.path import exists
 import time
 import numpy as np
 from .log_utils import apply_logging, init_logger
+
+def spectrum_parse(result, expected_string):
+    """
+    Response, wavelengths (float) and counts (int) of a spectrum reply
+    "<expected_string> <n> <n wavelengths> <n counts>". The numbers are parsed by NumPy in one go,
+    not converted one by one.
+
+    Raises:
+        ValueError: If the response is not expected_string or the numbers are incomplete.
+    """
+    elements = result.split(None, 3)
+    response = " ".join(elements[:2])
+    if response != expected_string:
+        raise ValueError(f"Error: Expected '{expected_string}', but got '{response}'.")
+
+    ar_length = int(elements[2])
+    values = np.loadtxt([elements[3]], ndmin=1) if len(elements) > 3 else np.empty(0) # one row, NumPy's C parser
+    if len(values) < 2 * ar_length:
+        raise ValueError(f"Error: Expected {2 * ar_length} values after '{expected_string}', but got {len(values)}.")
+    # counts: to float first, then to int
+    return response, values[:ar_length], values[ar_length:].astype(np.int64)
+
 @apply_logging
 class andor_meas:
     # Class variables
@@ -19,6 +42,8 @@ class andor_meas:
     #   import andor_measnanonis_tcp as tcp
     #   tcp.andor_meas.if_print = True
     if_print = False
+    binary = False # spectra as binary replies (AQB, GKB), see binary_enable
+    wl = grating = None # centre wavelength and grating last set (wl_set, grating_set): the calibration follows them
     def __init__(self, tcp):
         self.tcp = tcp
         # self.f_print = False
@@ -49,6 +74,7 @@ class andor_meas:
 
         self.tcp.cmd_send(cmd)
         result= self.tcp.recv_until()
+        self.wl = wl
 
      #   self.tcp.print_err(res_err)
       #  bias_df = pd.DataFrame({'Bias (V)': bias}, index=[0]).T
@@ -86,6 +112,7 @@ class andor_meas:
     
             self.tcp.cmd_send(cmd)
             result= self.tcp.recv_until()
+            self.grating = number
         
             if prt: 
                 print('\n' + result)
@@ -262,23 +289,21 @@ class andor_meas:
         body = ""
         cmd = header + body + self.tcp.termination_char
     
-        self.tcp.cmd_send(cmd)
-        result = self.tcp.recv_until()
-    
-        elements = result.split()
-        response = " ".join(elements[:2])
-        expected_string = "OK AQD"
-        
-        if response != expected_string:
-            raise ValueError(f"Error: Expected '{expected_string}', but got '{response}'.")
-    
-        ar_length = int(elements[2])
-        column_1 = elements[3:(3 + ar_length)]
-        column_2 = elements[3 + ar_length:]
-    
-        # Convert column_1 to floats and column_2 to integers
-        column_1 = [float(x) for x in column_1]
-        column_2 = [int(float(x)) for x in column_2]  # Convert to float first, then to int
+        if self.binary:
+            header = 'AQB '
+            cmd = header + body + self.tcp.termination_char
+            self.tcp.cmd_send(cmd)
+            response = self.tcp.recv_until().strip()
+            expected_string = "OK AQB"
+            if response != expected_string:
+                raise ValueError(f"Error: Expected '{expected_string}', but got '{response}'.")
+            # wavelengths (float32) and counts (uint32) blocks, as the text mode returns them
+            column_1 = self.tcp.recv_block('<f4').astype(float)
+            column_2 = self.tcp.recv_block('<u4').astype(np.int64)
+        else:
+            self.tcp.cmd_send(cmd)
+            result = self.tcp.recv_until()
+            response, column_1, column_2 = spectrum_parse(result, "OK AQD")
     
         # Create a DataFrame with two columns
         df = pd.DataFrame({
@@ -317,6 +342,66 @@ class andor_meas:
             raise ValueError(f"Error: Expected '{expected_string}', but got '{response}'.")
     
 
+    def binary_enable(self, timeout=2.0, prt=if_print):
+        """
+        Asks the Andor server for binary spectrum replies (CAP BIN): acquisition_set then uses AQB
+        and kinser_data_get is available. A block of a binary reply is the number of values
+        (uint32, little-endian) followed by the values (float32 or uint32, little-endian).
+
+        Servers without binary replies answer with an error (or not within timeout seconds)
+        and the text replies are kept.
+
+        Returns:
+            True if binary replies are used.
+        """
+        header = 'CAP '
+        body = "BIN"
+        cmd = header + body + self.tcp.termination_char
+
+        self.tcp.cmd_send(cmd)
+        self.tcp.sk.settimeout(timeout)
+        try:
+            result = self.tcp.recv_until()
+        except socket.timeout:
+            result = 'no reply'
+        finally:
+            self.tcp.sk.settimeout(None)
+
+        self.binary = result.split()[:3] == ['OK', 'CAP', 'BIN']
+        if prt:
+            print('\n' + result)
+        return self.binary
+
+    def kinser_data_get(self, prt=if_print):
+        """
+        Gets the spectra of the last kinetic series as a binary reply (GKB), see binary_enable.
+        The data are not copied after receiving them.
+
+        Raises:
+            ValueError: If binary replies are not enabled or the response "OK GKB" is not received.
+
+        Returns:
+            numpy.ndarray: Counts (float32), one row per spectrum.
+        """
+        if not self.binary:
+            raise ValueError('Binary replies are not enabled, see binary_enable().')
+        header = 'GKB '
+        body = ""
+        cmd = header + body + self.tcp.termination_char
+
+        self.tcp.cmd_send(cmd)
+        response = self.tcp.recv_until().strip()
+        expected_string = "OK GKB"
+        if response != expected_string:
+            raise ValueError(f"Error: Expected '{expected_string}', but got '{response}'.")
+
+        num_spectra, points = self.tcp.recv_block('<u4')
+        data = self.tcp.recv_block('<f4').reshape(int(num_spectra), int(points))
+
+        if prt:
+            print('\n' + response)
+        return data
+
     def settings_get(self, prt=if_print):
         """
         Gets the settings of the spectrograph.
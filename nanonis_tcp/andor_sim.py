@@ -0,0 +1,240 @@
+# -*- encoding: utf-8 -*-
+'''
+Reference stub of the Andor spectrograph server, to run and benchmark andor_meas without the camera.
+
+    with andor_sim(port = 0, http_port = 0) as sim:
+        connect2 = andor_meas(tcp_andor_ctrl('127.0.0.1', sim.port))
+        connect2.binary_enable()          # binary spectrum replies (AQB, GKB)
+        df = connect2.acquisition_set()
+
+The line protocol of the server: one command per line ("SET 0.1", "AQD", ...), answered with
+one line starting with "OK <command>" (or "ERR <command>" for unknown commands). Spectra are
+returned as text ("OK AQD <n> <n wavelengths> <n counts>") or, after "CAP BIN", as binary
+replies: the line "OK AQB" / "OK GKB" followed by blocks of the number of values (uint32,
+little-endian) and the values (little-endian):
+   - AQB: wavelengths (float32), counts (uint32)
+   - GKB: [number of spectra, points] (uint32), counts of the last completed kinetic series (float32)
+The spectra of AQR (kinetic series of SKN spectra) are also served as text over HTTP
+(http_port): /shm/andor.dat one spectrum per line, /shm/andor.cal the wavelengths. AQR starts
+a new andor.dat and appends each spectrum when it is acquired; range requests ("Range:
+bytes=<offset>-") are answered with the bytes from offset (206, or 416 when there are none).
+
+Acquisitions take the set acquisition time (SET) per spectrum. The counts are a gaussian
+peak on a background with Poisson noise.
+
+    python -m nanonis_tcp.andor_sim      # serve on 8888 and HTTP on 1234 until Ctrl+C
+'''
+############################### packages ######################################
+import http.server
+import socket
+import socketserver
+import struct as st
+import threading
+import time
+import numpy as np
+
+def block_encode(values, dtype):
+    '''block of a binary reply: number of values (uint32, little-endian), the values as dtype'''
+    values = np.ascontiguousarray(values, dtype)
+    return st.pack('<I', values.size) + values.tobytes()
+
+class andor_instrument:
+    def __init__(self, points = 1024, wl_start = 500., wl_end = 800., seed = None):
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng(seed)
+        self.points = points
+        self.wl_center = (wl_start + wl_end)/2
+        self.wl_range = wl_end - wl_start
+        # settings as returned by GST: 3-letter code -> value
+        self.settings = {'GRM': 0, 'GAM': 1, 'GKT': 0.1, 'GAN': 1, 'GHS': 0, 'GWL': self.wl_center, 'GGR': 1, 'GKN': 1}
+        self.kinser = np.zeros((0, points), np.float32) # spectra of the last kinetic series completed
+        self.kinser_text = b''                          # andor.dat: the spectra of the running (or last) series acquired so far
+
+    def wavelengths(self):
+        wl = self.settings['GWL']
+        return np.linspace(wl - self.wl_range/2, wl + self.wl_range/2, self.points)
+
+    def spectra(self, num):
+        wl = self.wavelengths()
+        peak = 2000.*np.exp(-0.5*((wl - wl.mean())/(0.02*self.wl_range))**2) + 300.
+        with self.lock:
+            return self.rng.poisson(peak*self.settings['GKT']*10, (num, self.points)).astype(np.float32)
+
+class andor_connection(socketserver.StreamRequestHandler):
+    def handle(self):
+        sim = self.server.sim
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            for line in self.rfile:
+                elements = line.decode('utf-8').split()
+                if not elements:
+                    continue # the clients end their commands with two termination characters
+                reply = sim.command_run(elements[0], elements[1:])
+                if sim.latency:
+                    time.sleep(sim.latency)
+                self.request.sendall(reply)
+        except (ConnectionError, OSError):
+            pass
+
+class andor_http(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    disable_nagle_algorithm = True # headers and body are sent separately
+
+    def do_GET(self):
+        data = self.server.sim.http_file(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        size = len(data)
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes=') and byte_range.endswith('-'): # only "bytes=<offset>-" is served
+            offset = int(byte_range[6:-1])
+            if offset >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            data = data[offset:]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class andor_tcp_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class andor_http_server(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class andor_sim:
+    # set command -> code of the setting it changes (read back by GST)
+    setters = {'SRM': 'GRM', 'SAM': 'GAM', 'SET': 'GKT', 'SAN': 'GAN', 'SHS': 'GHS', 'SWL': 'GWL', 'SGR': 'GGR', 'SKN': 'GKN'}
+
+    def __init__(self, TCP_IP = '127.0.0.1', port = 8888, http_port = None, binary = True, latency = 0.,
+                 start = True, **instrument_kwargs):
+        """
+       Parameters
+       TCP_IP          : IP address to listen on
+       port            : TCP port of the line protocol (0: any free port, see self.port)
+       http_port       : port of the HTTP server for /shm/andor.dat and /shm/andor.cal, None: no HTTP
+       binary          : answer "CAP BIN" (binary spectrum replies), False: behave as a server without them
+       latency         : time (s) between a command arriving and its reply leaving
+       start           : start serving right away (otherwise call start())
+       instrument_kwargs: passed to andor_instrument (points, wl_start, wl_end, seed)
+       """
+        self.TCP_IP = TCP_IP
+        self.binary = binary
+        self.latency = latency
+        self.instrument = andor_instrument(**instrument_kwargs)
+        self.servers, self.threads = [andor_tcp_server((TCP_IP, port), andor_connection)], []
+        if http_port is not None:
+            self.servers.append(andor_http_server((TCP_IP, http_port), andor_http))
+        for server in self.servers:
+            server.sim = self
+        self.port = self.servers[0].server_address[1]
+        self.http_port = self.servers[1].server_address[1] if http_port is not None else None
+        if start:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target = server.serve_forever, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for server in self.servers:
+            if self.threads:
+                server.shutdown()
+            server.server_close()
+        self.threads = []
+
+    def command_run(self, command, args):
+        '''reply (bytes) to one command line'''
+        instrument = self.instrument
+        settings = instrument.settings
+        if command in self.setters:
+            try:
+                value = float(args[0])
+            except (IndexError, ValueError):
+                return f'ERR {command}\n'.encode()
+            with instrument.lock:
+                settings[self.setters[command]] = int(value) if value.is_integer() and command != 'SWL' else value
+            return f'OK {command}\n'.encode()
+        if command == 'GST':
+            with instrument.lock:
+                values = ' '.join(f'{code} {value}' for code, value in settings.items())
+            return f'OK GST {len(settings)} {values}\n'.encode()
+        if command == 'CAP':
+            if self.binary and args[:1] == ['BIN']:
+                return b'OK CAP BIN\n'
+            return f'ERR {command}\n'.encode()
+        if command in ('AQD', 'AQB'):
+            if command == 'AQB' and not self.binary:
+                return f'ERR {command}\n'.encode()
+            time.sleep(settings['GKT'])
+            counts = instrument.spectra(1)[0]
+            wl = instrument.wavelengths()
+            if command == 'AQB':
+                return b'OK AQB\n' + block_encode(wl, '<f4') + block_encode(counts, '<u4')
+            return (f'OK AQD {len(wl)} ' + ' '.join(f'{x:.4f}' for x in wl) + ' '
+                    + ' '.join(f'{x:.0f}' for x in counts) + '\n').encode()
+        if command == 'AQR':
+            num = int(settings['GKN'])
+            spectra = instrument.spectra(num)
+            with instrument.lock:
+                instrument.kinser_text = b''
+            for spectrum in spectra: # andor.dat grows as the spectra are acquired
+                time.sleep(settings['GKT'])
+                text = (' '.join(f'{x:.0f}' for x in spectrum) + '\n').encode()
+                with instrument.lock:
+                    instrument.kinser_text += text
+            with instrument.lock:
+                instrument.kinser = spectra
+            return b'OK AQR\n'
+        if command == 'GKB' and self.binary:
+            with instrument.lock:
+                spectra = instrument.kinser
+            return b'OK GKB\n' + block_encode(spectra.shape, '<u4') + block_encode(spectra, '<f4')
+        if command == 'AQP':
+            return b'OK AQP\n'
+        return f'ERR {command}\n'.encode()
+
+    def http_file(self, path):
+        '''content of the files the server publishes over HTTP, None for unknown paths'''
+        if path == '/shm/andor.dat':
+            with self.instrument.lock:
+                return self.instrument.kinser_text
+        if path == '/shm/andor.cal':
+            return ('\n'.join(f'{x:.4f}' for x in self.instrument.wavelengths()) + '\n\n').encode()
+        return None
+
+    def serve_forever(self):
+        print(f'Andor server stub listening on {self.TCP_IP}, port {self.port}, HTTP port {self.http_port}.')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+if __name__ == '__main__':
+    andor_sim(http_port = 1234).serve_forever()
@@ -0,0 +1,471 @@
+# -*- encoding: utf-8 -*-
+'''
+Micro-benchmarks for the TCP client. No Nanonis software is needed: the messages are
+built in memory, the round trip and map benchmarks run against the local simulator
+(nanonis_sim) with the given latency.
+
+    python -m nanonis_tcp.benchmarks
+'''
+############################### packages ######################################
+import os
+import struct as st
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np
+import pandas as pd
+
+from . import tcp_codec
+from .tcp_ctrl import tcp_ctrl
+from .tcp_ctrl_legacy import tcp_ctrl as tcp_ctrl_legacy
+from .nanonis_ctrl import nanonis_ctrl
+from .photon_meas import photon_meas
+from .nanonis_sim import nanonis_sim
+from .tcp_stats import tcp_stats
+from .tcp_journal import tcp_journal, journal_replies, journal_tcp
+from .andor_sim import andor_sim
+from .andor_meas import andor_meas
+from .tcp_andor_ctrl import tcp_andor_ctrl
+from . import andor_http
+from . import cosmic_rays
+from . import nanonis_files
+
+############################### helpers #######################################
+# a socket that returns the same response message on every recv
+class replay_socket:
+    def __init__(self, message):
+        self.message = message
+
+    def recv(self, buffersize):
+        return self.message
+
+    def sendall(self, data):
+        pass
+
+def response_construct(command_name, body):
+    body = body + st.pack('>Ii', 0, 0) # no error
+    return command_name.encode().ljust(32, b'\x00') + st.pack('>iHH', len(body), 0, 0) + body
+
+def str_array_construct(strings):
+    return b''.join(st.pack('>i', len(s)) + s.encode() for s in strings)
+
+# typical responses: (name, response format, response message)
+def decoder_cases():
+    names = [f'Signal {i} (V)' for i in range(128)]
+    return [
+        ('Bias.Get', ('float32',),
+         response_construct('Bias.Get', st.pack('>f', 0.1))),
+        ('Scan.FrameGet', ('float32', 'float32', 'float32', 'float32', 'float32'),
+         response_construct('Scan.FrameGet', st.pack('>5f', 0, 0, 1e-8, 1e-8, 0))),
+        ('Signals.ValsGet (24)', ('int', '1dfloat32'),
+         response_construct('Signals.ValsGet', st.pack('>i', 24) + np.arange(24, dtype='>f4').tobytes())),
+        ('Signals.NamesGet (128)', ('int', 'int', '1dstr'),
+         response_construct('Signals.NamesGet', st.pack('>ii', len(str_array_construct(names)), len(names)) + str_array_construct(names))),
+        # without the trailing 'uint32' (scan direction): tcp_ctrl_legacy decodes it as '>L', which is 8 bytes on 64-bit Linux
+        ('Scan.FrameDataGrab (256x256)', ('int', 'str', 'int', 'int', '2dfloat32'),
+         response_construct('Scan.FrameDataGrab', st.pack('>i', 5) + b'Z (m)' + st.pack('>ii', 256, 256)
+                            + np.zeros((256, 256), '>f4').tobytes())),
+    ]
+
+############################### benchmarks ####################################
+def decoder_benchmark(number = 2000, prt = True):
+    '''
+    Time decoding of typical responses with the compiled decoder plans (tcp_ctrl) against
+    the format walk of tcp_ctrl_legacy. Only the arguments are decoded (get_header = False,
+    get_err = False). 'plan only' is tcp_codec.decode_args with an already compiled plan.
+    Returns a DataFrame with the time per response in microseconds.
+    '''
+    new = tcp_ctrl(connect = False)
+    legacy = object.__new__(tcp_ctrl_legacy)
+    legacy.buffersize = 0
+
+    rows = []
+    for name, varg_fmt, message in decoder_cases():
+        legacy.sk = replay_socket(message)
+        frame = memoryview(message)
+        n = max(1, number // 50) if len(message) > 100000 else number
+
+        t_legacy = min(timeit.repeat(lambda: legacy.res_recv(*varg_fmt, get_header = False, get_err = False), number = n, repeat = 3))/n
+        t_new = min(timeit.repeat(lambda: new.res_decode(frame, *varg_fmt, get_header = False, get_err = False), number = n, repeat = 3))/n
+        plan = tcp_codec.compile_plan(varg_fmt)
+        t_plan = min(timeit.repeat(lambda: tcp_codec.decode_args(plan, frame), number = n, repeat = 3))/n
+        rows.append([name, len(message), t_legacy*1e6, t_new*1e6, t_plan*1e6, t_legacy/t_new])
+
+    res_df = pd.DataFrame(rows, columns = ['response', 'size (bytes)', 'legacy (us)', 'compiled (us)', 'plan only (us)', 'speedup']).set_index('response')
+    if prt:
+        print('\n' + res_df.round(2).to_string() + '\n')
+    return res_df
+
+def encoder_benchmark(number = 20000, prt = True):
+    '''
+    Time building requests with fixed-size bodies: header_construct + dtype_cvt of tcp_ctrl_legacy
+    against the preassembled encoders (tcp_ctrl.cmd_encode).
+    Returns a DataFrame with the time per request in microseconds.
+    '''
+    new = tcp_ctrl(connect = False)
+    legacy = object.__new__(tcp_ctrl_legacy)
+
+    def legacy_encode(command_name, body_fmt, *args):
+        body = b''
+        for arg_fmt, arg in zip(body_fmt, args):
+            body += legacy.dtype_cvt(arg, arg_fmt, 'bin')
+        return legacy.header_construct(command_name, len(body)) + body
+
+    # no 'uint32' arguments: tcp_ctrl_legacy encodes them as 8-byte '>L' on 64-bit Linux
+    cases = [('Bias.Set', ('float32',), (0.1,)),
+             ('Bias.Get', (), ()),
+             ('Scan.FrameSet', ('float32', 'float32', 'float32', 'float32', 'float32'), (0, 0, 1e-8, 1e-8, 0)),
+             ('FolMe.XYPosSet', ('float64', 'float64', 'int'), (1e-9, 2e-9, 1))]
+    rows = []
+    for command_name, body_fmt, args in cases:
+        t_legacy = min(timeit.repeat(lambda: legacy_encode(command_name, body_fmt, *args), number = number, repeat = 3))/number
+        t_new = min(timeit.repeat(lambda: new.cmd_encode(command_name, body_fmt, *args), number = number, repeat = 3))/number
+        rows.append([command_name, t_legacy*1e6, t_new*1e6, t_legacy/t_new])
+
+    res_df = pd.DataFrame(rows, columns = ['request', 'legacy (us)', 'preassembled (us)', 'speedup']).set_index('request')
+    if prt:
+        print('\n' + res_df.round(2).to_string() + '\n')
+    return res_df
+
+def round_trip_benchmark(latency = 1e-3, number = 100, prt = True):
+    '''
+    Time number Bias.Get calls one by one, in one batch and number Bias.Set calls with and
+    without waiting for the reply, against the simulator with latency (s) per reply.
+    Returns a DataFrame with the time per call in milliseconds.
+    '''
+    with nanonis_sim(ports = (0,), latency = latency, noise = 0) as sim:
+        connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[0]))
+
+        def batched():
+            with connect.batch() as b:
+                for _ in range(number):
+                    b.BiasGet(prt = False)
+
+        def no_reply():
+            with connect.no_reply():
+                for _ in range(number):
+                    connect.BiasSet(0.1, prt = False)
+            connect.BiasGet(prt = False) # wait until Nanonis has processed them
+
+        cases = [('Bias.Get', lambda: [connect.BiasGet(prt = False) for _ in range(number)]),
+                 ('Bias.Get batched', batched),
+                 ('Bias.Set', lambda: [connect.BiasSet(0.1, prt = False) for _ in range(number)]),
+                 ('Bias.Set no reply', no_reply)]
+        rows = []
+        for name, run in cases:
+            t = min(timeit.repeat(run, number = 1, repeat = 3))/number
+            rows.append([name, t*1e3, t/latency if latency else float('nan')])
+        connect.tcp.socket_close()
+
+    res_df = pd.DataFrame(rows, columns = ['calls', 'time per call (ms)', 'latencies per call']).set_index('calls')
+    if prt:
+        print('\n' + res_df.round(3).to_string() + '\n')
+    return res_df
+
+def map_benchmark(pix = (8, 4), acqtime = 0.02, latency = 1e-3, prt = True, **map_kwargs):
+    '''
+    Run photon_meas.nanonis_map_k against the simulator and compare its duration with the
+    time the tip spent moving (FolMe.XYPosSet waiting for the end of the move). The difference
+    is the overhead of the TCP traffic and of the data processing between the moves.
+    prt also prints the per-command statistics (tcp_stats) of the map.
+    '''
+    stats = tcp_stats()
+    with nanonis_sim(ports = (0, 0), latency = latency) as sim:
+        connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[0], stats = stats))
+        connect3 = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[1], stats = stats))
+        meas = photon_meas(connect, connect3 = connect3, logging = False)
+        t0 = time.perf_counter()
+        meas.nanonis_map_k(acqtime = acqtime, pix = pix, **map_kwargs)
+        t_map = time.perf_counter() - t0
+        for ctrl in (connect, connect3):
+            ctrl.tcp.socket_close()
+
+    res_df = pd.DataFrame({'Map time (s)': t_map, 'Move time (s)': sim.wait_time, 'Overhead (s)': t_map - sim.wait_time,
+                           'Requests': sum(sim.command_counts.values())}, index = [f'{pix[0]}x{pix[1]}']).T
+    if prt:
+        stats.snapshot(prt = True)
+        print('\n' + res_df.round(3).to_string(header = False) + '\n')
+    return res_df
+
+def replay_benchmark(pix = (8, 4), acqtime = 0.02, latency = 1e-3, prt = True, **map_kwargs):
+    '''
+    Record photon_meas.nanonis_map_k against the simulator in a tcp_journal, then run it again
+    on the recorded replies (journal_tcp: no network, no moves). The replayed map is the client
+    side only: decoding, data processing and file writing on identical data.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'map.njr')
+        with tcp_journal(path) as journal, nanonis_sim(ports = (0, 0), latency = latency) as sim:
+            connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[0], journal = journal))
+            connect3 = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[1], journal = journal))
+            t0 = time.perf_counter()
+            photon_meas(connect, connect3 = connect3, logging = False).nanonis_map_k(acqtime = acqtime, pix = pix, **map_kwargs)
+            t_map = time.perf_counter() - t0
+            for ctrl in (connect, connect3):
+                ctrl.tcp.socket_close()
+            records = journal.records
+
+        os.makedirs(os.path.join(tmp, 'replay'))
+        replies = journal_replies(path, session_path = os.path.join(tmp, 'replay'))
+        connect = nanonis_ctrl(journal_tcp(path, replies = replies))
+        connect3 = nanonis_ctrl(journal_tcp(path, replies = replies))
+        t0 = time.perf_counter()
+        photon_meas(connect, connect3 = connect3, logging = False).nanonis_map_k(acqtime = acqtime, pix = pix, **map_kwargs)
+        t_replay = time.perf_counter() - t0
+
+    res_df = pd.DataFrame({'Map time (s)': t_map, 'Replay time (s)': t_replay, 'Journal records': records},
+                          index = [f'{pix[0]}x{pix[1]}']).T
+    if prt:
+        print('\n' + res_df.round(3).to_string(header = False) + '\n')
+    return res_df
+
+def andor_benchmark(points = 1024, spectra = 200, number = 20, prt = True):
+    '''
+    Time the spectrum transfer from the Andor server stub (andor_sim, zero acquisition time):
+    one spectrum as text (AQD) and binary (AQB) reply, a kinetic series of spectra as andor.dat
+    over HTTP parsed with np.loadtxt (new connection and keep-alive session) and as binary reply
+    (GKB), and the last spectrum of the series read with a range request (andor_http.kinser_reader,
+    what is left to read at the end of a line when the spectra are read while acquired).
+    Returns a DataFrame with the time per transfer in milliseconds.
+    '''
+    import requests
+    from io import StringIO
+    with andor_sim(port = 0, http_port = 0, points = points) as sim:
+        sim.instrument.settings.update({'GKT': 0., 'GKN': spectra})
+        text = andor_meas(tcp_andor_ctrl('127.0.0.1', sim.port))
+        binary = andor_meas(tcp_andor_ctrl('127.0.0.1', sim.port))
+        binary.binary_enable(prt = False)
+        text.kinser_start(prt = False)
+        url = f'http://127.0.0.1:{sim.http_port}/shm/andor.dat'
+        session = andor_http.http_session()
+        reader = andor_http.kinser_reader(session, url, points)
+        content = session.get(url).content
+        last = content.rfind(b'\n', 0, len(content) - 1) + 1 # offset of the last spectrum
+
+        def last_spectrum():
+            reader.start()
+            reader.offset = last
+            return reader.poll(final = True)
+
+        cases = [('spectrum, text (AQD)', lambda: text.acquisition_set(prt = False)),
+                 ('spectrum, binary (AQB)', lambda: binary.acquisition_set(prt = False)),
+                 (f'{spectra} spectra, HTTP + loadtxt', lambda: np.loadtxt(StringIO(requests.get(url).text))),
+                 (f'{spectra} spectra, HTTP session + loadtxt', lambda: np.loadtxt(StringIO(session.get(url).text))),
+                 (f'{spectra} spectra, binary (GKB)', lambda: binary.kinser_data_get(prt = False)),
+                 ('last spectrum, HTTP range request', last_spectrum)]
+        rows = []
+        for name, run in cases:
+            t = min(timeit.repeat(run, number = number, repeat = 3))/number
+            rows.append([name, t*1e3])
+        for connect in (text, binary):
+            connect.tcp.socket_close()
+
+    res_df = pd.DataFrame(rows, columns = ['transfer', 'time (ms)']).set_index('transfer')
+    if prt:
+        print('\n' + res_df.round(3).to_string() + '\n')
+    return res_df
+
+def cosmic_cube(shape = (128, 128, 1024), spikes = 2000, offset = 300, seed = 0):
+    '''
+    Synthetic map: a broad band and a narrow line (brighter in a spot of a few pixels) with shot
+    and readout noise on the offset, and cosmic rays of 1-2 wavelengths. Returns (cube, cosmic ray mask).
+    '''
+    rng = np.random.default_rng(seed)
+    ny, nx, nw = shape
+    wl = np.arange(nw)
+    yy, xx = np.mgrid[:ny, :nx]
+    spot = 1 + 5*np.exp(-((yy - ny/2)**2 + (xx - nx/3)**2)/8.)
+    spectrum = 200*np.exp(-0.5*((wl - nw/2)/60)**2) + 800*np.exp(-0.5*((wl - 0.7*nw)/1.)**2)
+    cube = (offset + rng.poisson(spot[..., None]*spectrum) + rng.normal(0, 3, shape)).astype(np.float32)
+    truth = np.zeros(shape, bool)
+    y, x, w = rng.integers(0, ny, spikes), rng.integers(0, nx, spikes), rng.integers(0, nw - 1, spikes)
+    for width in (0, 1):
+        hit = rng.random(spikes) < (1 if width == 0 else 0.3) # 30 % two wavelengths wide
+        cube[y[hit], x[hit], w[hit] + width] += rng.uniform(200, 5000, hit.sum())
+        truth[y[hit], x[hit], w[hit] + width] = True
+    return cube, truth
+
+def cosmic_benchmark(shape = (128, 128, 1024), spikes = 2000, processes = None, prt = True):
+    '''
+    Cosmic-ray removal on a synthetic map (cosmic_cube): photon_meas.cr_remove per pixel, the
+    whole cube with cosmic_rays.cr_clean in this process and in a process pool, and line by line
+    with cr_clean_line as during photon_map_k. Returns a DataFrame with the time, the cosmic rays
+    found (recall) and the values replaced that were no cosmic rays.
+    '''
+    processes = os.cpu_count() if processes is None else processes
+    cube, truth = cosmic_cube(shape, spikes)
+
+    def per_pixel():
+        return np.stack([[photon_meas.cr_remove(None, spectrum) for spectrum in line] for line in cube])
+
+    def per_line():
+        cleaned = cube.copy()
+        for i in range(len(cleaned)):
+            cosmic_rays.cr_clean_line(cleaned, i)
+        return cleaned
+
+    cases = [('cr_remove per pixel', per_pixel),
+             ('cr_clean', lambda: cosmic_rays.cr_clean(cube)[0]),
+             (f'cr_clean, {processes} processes', lambda: cosmic_rays.cr_clean(cube, processes = processes)[0]),
+             ('cr_clean_line per line', per_line)]
+    rows = []
+    for name, run in cases:
+        t = time.perf_counter()
+        cleaned = run()
+        t = time.perf_counter() - t
+        replaced = cleaned != cube
+        rows.append([name, t, (replaced & truth).sum()/truth.sum(), (replaced & ~truth).sum()])
+
+    res_df = pd.DataFrame(rows, columns = ['method', 'time (s)', 'recall', 'false replaced']).set_index('method')
+    if prt:
+        print(f'\n{shape[0]} x {shape[1]} x {shape[2]} map, {truth.sum()} cosmic ray values')
+        print(res_df.round(3).to_string() + '\n')
+    return res_df
+
+def grid_benchmark(pix = (128, 128), points = 1024, signals = 8, prt = True):
+    '''
+    Write the .3ds file of a map (in a temporary folder): per pixel as fetch_data_from_queue did
+    (the parameters gathered from a Python list, two buffers per pixel), and a line per write with
+    nanonis_files.grid3ds_writer, in the calling thread and in the background. Returns a DataFrame
+    with the time per line in milliseconds and the total time.
+    '''
+    rng = np.random.default_rng(0)
+    params = rng.random((pix[1], pix[0], signals)).astype(np.float32)
+    counts = rng.random((pix[1], pix[0], points)).astype(np.float32)
+    fixed_parameters = ['Sweep Start', 'Sweep End'] + [f'Signal {i}' for i in range(signals)]
+    sweep = (500., 900.)
+
+    def per_pixel(filename):
+        with nanonis_files.grid3ds_writer(filename, pix, [0, 0, 1e-8, 1e-8, 0]) as grid:
+            grid.experiment(fixed_parameters, points)
+            for i in range(pix[1]):
+                for j in range(pix[0]):
+                    nanonis_files.f4_write(grid.f, np.array(list(sweep) + list(params[i, j])), counts[i, j])
+
+    def per_line(filename, background):
+        with nanonis_files.grid3ds_writer(filename, pix, [0, 0, 1e-8, 1e-8, 0], background = background) as grid:
+            grid.experiment(fixed_parameters, points)
+            for i in range(pix[1]):
+                grid.write_line(params[i], counts[i], sweep)
+
+    cases = [('per pixel, f4_write', per_pixel),
+             ('grid3ds_writer, a line per write', lambda filename: per_line(filename, False)),
+             ('grid3ds_writer, background', lambda filename: per_line(filename, True))]
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for k, (name, run) in enumerate(cases):
+            filename = os.path.join(folder, f'grid{k}.3ds')
+            t = time.perf_counter()
+            run(filename)
+            t = time.perf_counter() - t
+            rows.append([name, t/pix[1]*1e3, t])
+
+    res_df = pd.DataFrame(rows, columns = ['writer', 'time per line (ms)', 'total (s)']).set_index('writer')
+    if prt:
+        print(f'\n{pix[0]} x {pix[1]} pixels, {signals} signals, {points} points')
+        print(res_df.round(3).to_string() + '\n')
+    return res_df
+
+def sxm_benchmark(pix = (128, 128), signals = 6, points = 1024, prt = True):
+    '''
+    Write the .sxm file of a forward / backward map with Andor spectra (in a temporary folder):
+    with nanonis_ctrl.writesxm from the stacked data at the end of the map, as photon_map_k did,
+    and a line at a time with nanonis_files.sxm_writer. Returns a DataFrame with the time and the
+    peak memory allocated while writing (tracemalloc), the map arrays themselves not counted.
+    '''
+    import tracemalloc
+    rng = np.random.default_rng(0)
+    signal_array = rng.random((2*pix[1], pix[0], signals)).astype(np.float32)
+    andor_array = rng.random((2*pix[1], pix[0], points)).astype(np.float32)
+    scan_par = {'REC_DATE': '', 'REC_TIME': '', 'ACQ_TIME': '0.0', 'SCAN_PIXELS': f'{pix[0]}\t{pix[1]}', 'SCAN_DIR': 'up'}
+    channels = [[i, f'Signal {i}', 'V', 'both', '1.000E+0', '0.000E+0'] for i in range(signals)] + \
+               [[128 + i, f'{500 + i/10:.1f}', 'nm', 'both', '1.000E+0', '0.000E+0'] for i in range(points)]
+    connect = nanonis_ctrl.__new__(nanonis_ctrl) # writesxm needs no connection
+
+    def stacked(filename):
+        combined_data = np.vstack((signal_array.transpose(2, 0, 1).reshape(signals, -1), andor_array.transpose(2, 0, 1).reshape(points, -1)))
+        connect.writesxm(True, filename, {}, scan_par, channels, combined_data)
+
+    def per_line(filename):
+        with nanonis_files.sxm_writer(filename, pix, scan_par, channels, backward = True) as sxm:
+            for i in range(pix[1]):
+                sxm.write_line(i, signal_array[2*i], signal_array[2*i+1])
+                sxm.write_line(i, andor_array[2*i], andor_array[2*i+1], first = signals)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for k, (name, run) in enumerate([('writesxm, stacked at the end', stacked), ('sxm_writer, a line at a time', per_line)]):
+            tracemalloc.start()
+            t = time.perf_counter()
+            run(os.path.join(folder, f'map{k}.sxm'))
+            t = time.perf_counter() - t
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            rows.append([name, t, peak/2**20])
+
+    res_df = pd.DataFrame(rows, columns = ['writer', 'time (s)', 'peak memory (MB)']).set_index('writer')
+    if prt:
+        print(f'\n{pix[0]} x {pix[1]} pixels, forward and backward, {signals} signals, {points} spectral channels')
+        print(res_df.round(3).to_string() + '\n')
+    return res_df
+
+startup_script = '''
+import time
+t0 = time.perf_counter()
+import nanonis_tcp
+t1 = time.perf_counter()
+nanonis_tcp.nanonis_ctrl, nanonis_tcp.tcp_ctrl
+t2 = time.perf_counter()
+nanonis_tcp.photon_meas
+t3 = time.perf_counter()
+print(t1 - t0, t2 - t1, t3 - t2)
+'''
+
+def startup_benchmark(latency = 1e-3, slowest = 10, prt = True):
+    '''
+    Time to import the package and its classes in a fresh interpreter, the modules that take the
+    longest to import (python -X importtime), and the time to create nanonis_ctrl and photon_meas
+    objects on the simulator with the given latency.
+    '''
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         os.environ.get('PYTHONPATH', '')]))
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', startup_script], capture_output = True, text = True, env = env)
+    t_import, t_ctrl, t_photon = map(float, run.stdout.split())
+    modules = []
+    for line in run.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[0].startswith('import time:') and parts[1].strip().isdigit():
+            modules.append((parts[2].strip(), int(parts[0].split(':')[1]), int(parts[1])))
+    modules_df = pd.DataFrame(modules, columns = ['Module', 'Self (ms)', 'Cumulative (ms)']).set_index('Module')/1e3
+    modules_df = modules_df.sort_values('Self (ms)', ascending = False).head(slowest)
+
+    with nanonis_sim(ports = (0,), latency = latency) as sim:
+        t0 = time.perf_counter()
+        connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[0]))
+        t1 = time.perf_counter()
+        meas = photon_meas(connect, logging = False)
+        t2 = time.perf_counter()
+        meas.signal_names # first use, asks Nanonis
+        t3 = time.perf_counter()
+        connect.tcp.socket_close()
+
+    res_df = pd.DataFrame({'import nanonis_tcp (s)': t_import, 'nanonis_ctrl, tcp_ctrl (s)': t_ctrl,
+                           'photon_meas (s)': t_photon, 'nanonis_ctrl() (s)': t1 - t0,
+                           'photon_meas() (s)': t2 - t1, 'first use (s)': t3 - t2}, index = ['Startup']).T
+    if prt:
+        print('\n' + modules_df.round(1).to_string() + '\n\n' + res_df.round(4).to_string(header = False) + '\n')
+    return res_df, modules_df
+
+if __name__ == '__main__':
+    decoder_benchmark()
+    encoder_benchmark()
+    round_trip_benchmark()
+    map_benchmark()
+    replay_benchmark()
+    startup_benchmark()
+    andor_benchmark()
+    cosmic_benchmark()
+    grid_benchmark()
+    sxm_benchmark()
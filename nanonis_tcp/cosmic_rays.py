@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+'''
+Cosmic-ray removal on hyperspectral maps: cubes (y, x, wavelength), or (y, x, acquisition,
+wavelength) with repeated acquisitions per pixel.
+
+    clean, replaced = cr_clean(cube)                    # whole cube in tiles of rows (processes = 4: process pool)
+    replaced = cr_clean_line(andor_array, i)            # line i in place, during the map (against the lines before)
+
+A value is taken for a cosmic ray when it stands out both
+   - from its own spectrum: the median over filter_size wavelengths, and
+   - from its neighbourhood: the median over the adjacent pixels (neighbours in x and y),
+     then over the acquisitions of the pixel,
+by more than sigma times the noise of the median it is compared with (shot noise of the counts
+above offset, and readout noise). Light from a single pixel passes (it is broad in wavelength),
+as do narrow lines (the neighbours have them too). The neighbourhood medians are computed only
+for the values failing the spectral test. Cosmic rays are replaced by the spectral median,
+repeated acquisitions are then averaged.
+
+scipy is imported on first use (filter_size other than 3 and 5).
+'''
+############################### packages ######################################
+import numpy as np
+
+def median3(a, b, c):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+def spectral_median(block, filter_size=5):
+    """median over filter_size wavelengths (last axis), the edges repeated"""
+    if filter_size in (3, 5): # min / max networks, no sorting
+        half = filter_size//2
+        padded = np.concatenate([block[..., :1]]*half + [block] + [block[..., -1:]]*half, axis=-1)
+        views = [padded[..., i:i + block.shape[-1]] for i in range(filter_size)]
+        if filter_size == 3:
+            return median3(*views)
+        a, b, c, d, e = views
+        return median3(e, np.maximum(np.minimum(a, b), np.minimum(c, d)), np.minimum(np.maximum(a, b), np.maximum(c, d)))
+    from scipy.ndimage import median_filter
+    return median_filter(block, size=(1,)*(block.ndim - 1) + (filter_size,), mode='nearest')
+
+def cr_mask(block, filter_size=5, neighbours=1, offset=300, sigma=5, noise=3):
+    """
+    Cosmic rays in block (y, x, acquisition, wavelength), with the neighbourhood of every pixel
+    inside the block. Returns (mask, spectral median), both shaped as block.
+    """
+    spectral = spectral_median(block, filter_size)
+    mask = block - spectral > sigma*np.sqrt(np.abs(spectral - offset) + noise**2)
+    y, x, _, w = np.nonzero(mask) # candidates: the neighbourhood medians of these only
+    if len(y):
+        shifts = np.arange(-neighbours, neighbours + 1)
+        ys = np.clip(y[:, None, None] + shifts[None, :, None], 0, block.shape[0] - 1)
+        xs = np.clip(x[:, None, None] + shifts[None, None, :], 0, block.shape[1] - 1)
+        # (candidates, neighbours in y, neighbours in x, acquisitions)
+        values = block[ys[..., None], xs[..., None], np.arange(block.shape[2]), w[:, None, None, None]]
+        local = np.median(np.median(values.reshape(len(y), -1, block.shape[2]), axis=1), axis=1)
+        candidates = block[mask]
+        mask[mask] = candidates - local > sigma*np.sqrt(np.abs(local - offset) + noise**2)
+    return mask, spectral
+
+def cr_tile(block, rows, filter_size=5, neighbours=1, offset=300, sigma=5, noise=3):
+    """
+    Clean the rows rows (slice) of block (y, x, acquisition, wavelength), the other rows are their
+    neighbours. Returns (cleaned rows averaged over the acquisitions, number of values replaced).
+    """
+    mask, spectral = cr_mask(block, filter_size, neighbours, offset, sigma, noise)
+    mask, spectral, block = mask[rows], spectral[rows], block[rows]
+    return np.where(mask, spectral, block).mean(axis=2), int(mask.sum())
+
+def cr_clean(cube, filter_size=5, neighbours=1, offset=300, sigma=5, noise=3, tile=16, processes=None):
+    """
+    Remove the cosmic rays of a map.
+
+    Parameters:
+    - cube: (y, x, wavelength) or (y, x, acquisition, wavelength) array
+    - filter_size: wavelengths of the spectral median (default is 5: cosmic rays up to 2 wavelengths wide)
+    - neighbours: pixels on each side in x and y compared with (default is 1: 3 x 3 pixels)
+    - offset: Offset value of the counts (default is 300)
+    - sigma: threshold in units of the noise (default is 5)
+    - noise: readout noise in counts (default is 3)
+    - tile: rows cleaned together (memory: about 10 copies of a tile)
+    - processes: number of worker processes, None or 1: in this process
+
+    Returns:
+    - cleaned: (y, x, wavelength) float32 array, acquisitions averaged
+    - replaced: number of values replaced
+    """
+    cube = np.asarray(cube, dtype=np.float32)
+    if cube.ndim == 3:
+        cube = cube[:, :, np.newaxis, :]
+    rows = cube.shape[0]
+    jobs = []
+    for start in range(0, rows, tile):
+        stop = min(start + tile, rows)
+        low, high = max(0, start - neighbours), min(rows, stop + neighbours)
+        jobs.append((cube[low:high], slice(start - low, stop - low)))
+
+    if processes is None or processes <= 1:
+        results = [cr_tile(block, rows_slice, filter_size, neighbours, offset, sigma, noise) for block, rows_slice in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(cr_tile, block, rows_slice, filter_size, neighbours, offset, sigma, noise) for block, rows_slice in jobs]
+            results = [future.result() for future in futures]
+
+    cleaned = np.concatenate([result[0] for result in results]).astype(np.float32, copy=False)
+    return cleaned, sum(result[1] for result in results)
+
+def cr_clean_line(cube, line, filter_size=5, neighbours=1, offset=300, sigma=5, noise=3):
+    """
+    Remove the cosmic rays of line line of cube (y, x, wavelength) in place, compared with the
+    lines before it only (the ones already acquired). Returns the number of values replaced.
+    """
+    block = np.asarray(cube[max(0, line - neighbours):line + 1], dtype=np.float32)[:, :, np.newaxis, :]
+    mask, spectral = cr_mask(block, filter_size, neighbours, offset, sigma, noise)
+    mask, spectral = mask[-1, :, 0], spectral[-1, :, 0]
+    cube[line][mask] = spectral[mask]
+    return int(mask.sum())
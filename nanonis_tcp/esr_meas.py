@@ -9,6 +9,7 @@ from os import mkdir
 from os.path import exists
 import time
 import numpy as np
+from .tcp_batch import resolved
 
 class esr_meas:
     def __init__(self, connect):
@@ -23,23 +24,25 @@ class esr_meas:
     
     #################################### BIAS SPECTROSCOPY ###################################3
     def bias_spectr_par_get(self):
-        bias_par = {'Bias': self.connect.BiasGet(),
-                    'BiasSpectrChs': self.connect.BiasSpectrChsGet(),
-                    'BiasSpectrProps': self.connect.BiasSpectrPropsGet(),
-                    'BiasSpectrAdvProps': self.connect.BiasSpectrAdvPropsGet(),
-                    'BiasSpectrLimits': self.connect.BiasSpectrLimitsGet(),
-                    'BiasSpectrTiming': self.connect.BiasSpectrTimingGet(),
-                    'BiasSpectrTTLSync': self.connect.BiasSpectrTTLSyncGet(),
-                    'BiasSpectrAltZCtrl': self.connect.BiasSpectrAltZCtrlGet(),
-                    'BiasSpectrMLSLockinPerSeg': self.connect.BiasSpectrMLSLockinPerSegGet(),
-                    'BiasSpectrMLSMode': self.connect.BiasSpectrMLSModeGet(),
-                    'BiasSpectrMLSVals': self.connect.BiasSpectrMLSValsGet(),
-                    'BiasSpectrMore': pd.DataFrame({'Auto save': 'Yes/On', 'Save dialog': 'No/Off', 'Basename' : 'STS_%Y%m%d_'}, index=[0]).T,
-                    'LockInModAmp1': self.connect.LockInModAmpGet(1),
-                    'LockInModFreq1': self.connect.LockInModPhasFreqGet(1),
-                    'LockInOnOff1': self.connect.LockInModOnOffGet(1),
-                    }
-        return bias_par
+        # all Gets are sent in one batch (one round trip)
+        with self.connect.batch() as b:
+            bias_par = {'Bias': b.BiasGet(),
+                        'BiasSpectrChs': b.BiasSpectrChsGet(),
+                        'BiasSpectrProps': b.BiasSpectrPropsGet(),
+                        'BiasSpectrAdvProps': b.BiasSpectrAdvPropsGet(),
+                        'BiasSpectrLimits': b.BiasSpectrLimitsGet(),
+                        'BiasSpectrTiming': b.BiasSpectrTimingGet(),
+                        'BiasSpectrTTLSync': b.BiasSpectrTTLSyncGet(),
+                        'BiasSpectrAltZCtrl': b.BiasSpectrAltZCtrlGet(),
+                        'BiasSpectrMLSLockinPerSeg': b.BiasSpectrMLSLockinPerSegGet(),
+                        'BiasSpectrMLSMode': b.BiasSpectrMLSModeGet(),
+                        'BiasSpectrMLSVals': b.BiasSpectrMLSValsGet(),
+                        'BiasSpectrMore': pd.DataFrame({'Auto save': 'Yes/On', 'Save dialog': 'No/Off', 'Basename' : 'STS_%Y%m%d_'}, index=[0]).T,
+                        'LockInModAmp1': b.LockInModAmpGet(1),
+                        'LockInModFreq1': b.LockInModPhasFreqGet(1),
+                        'LockInOnOff1': b.LockInModOnOffGet(1),
+                        }
+        return resolved(bias_par)
     
     def bias_spectr_par_save(self, bias_par, fdir, fname = ''):
         with open(fdir + '/BiasSpectr' + fname + '.par', 'wb') as handle:
@@ -54,7 +57,6 @@ class esr_meas:
         return bias_par
 
     def bias_spectr(self, par, data_folder, basename = '%Y%m%d_', run = True):
-        self.connect.BiasSpectrOpen()
         props = (int(par['BiasSpectrProps'].loc['Save all', 0]),
                  int(par['BiasSpectrProps'].loc['Number of sweeps']),
                  par['BiasSpectrProps'].loc['Backward sweep', 0],
@@ -62,20 +64,24 @@ class esr_meas:
                  float(par['BiasSpectrTiming'].loc['Z offset (m)']),
                  par['BiasSpectrMore'].loc['Auto save', 0],
                  par['BiasSpectrMore'].loc['Save dialog', 0])
-        self.connect.BiasSet(*par['Bias'].values)
-        self.connect.BiasSpectrChsSet(*par['BiasSpectrChs'].values.tolist())
-        self.connect.BiasSpectrPropsSet(*props)
-        self.connect.BiasSpectrAdvPropsSet(*par['BiasSpectrAdvProps'].values)
-        self.connect.BiasSpectrLimitsSet(*par['BiasSpectrLimits'].values)
-        self.connect.BiasSpectrTimingSet(*par['BiasSpectrTiming'].values)
-        self.connect.BiasSpectrTTLSyncSet(*par['BiasSpectrTTLSync'].values)
-        self.connect.BiasSpectrAltZCtrlSet(*par['BiasSpectrAltZCtrl'].values)
-        self.connect.BiasSpectrMLSLockinPerSegSet(*par['BiasSpectrMLSLockinPerSeg'].values)
-        self.connect.BiasSpectrMLSModeSet(*par['BiasSpectrMLSMode'].values)
-        self.connect.BiasSpectrMLSValsSet(*par['BiasSpectrMLSVals'].values)
+        # all Sets are sent in one batch (one round trip), Nanonis executes them in order
+        with self.connect.batch() as b:
+            b.BiasSpectrOpen()
+            b.BiasSet(*par['Bias'].values)
+            b.BiasSpectrChsSet(*par['BiasSpectrChs'].values.tolist())
+            b.BiasSpectrPropsSet(*props)
+            b.BiasSpectrAdvPropsSet(*par['BiasSpectrAdvProps'].values)
+            b.BiasSpectrLimitsSet(*par['BiasSpectrLimits'].values)
+            b.BiasSpectrTimingSet(*par['BiasSpectrTiming'].values)
+            b.BiasSpectrTTLSyncSet(*par['BiasSpectrTTLSync'].values)
+            b.BiasSpectrAltZCtrlSet(*par['BiasSpectrAltZCtrl'].values)
+            b.BiasSpectrMLSLockinPerSegSet(*par['BiasSpectrMLSLockinPerSeg'].values)
+            b.BiasSpectrMLSModeSet(*par['BiasSpectrMLSMode'].values)
+            b.BiasSpectrMLSValsSet(*par['BiasSpectrMLSVals'].values)
 
-        self.connect.LockInModAmpSet(*par['LockInModAmp1'].values)
-        self.connect.LockInModPhasFreqSet(*par['LockInModFreq1'].values)
+            b.LockInModAmpSet(*par['LockInModAmp1'].values)
+            b.LockInModPhasFreqSet(*par['LockInModFreq1'].values)
+        b.results() # raise if one of the Sets failed
 
         if run:
             self.connect.LockInModOnOffSet(*par['LockInOnOff1'].values)
@@ -1,15 +1,82 @@
+import atexit
+import itertools
 import logging
-import inspect
+import logging.handlers
 import os
+import queue
+import reprlib
 import threading
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 
 _logger_initialized = False
 _call_depth = threading.local()  # thread-local depth counter
+_root_logger = logging.getLogger()
+_listener = None
+_queue_handler = None
+_logger_pending = None  # returns the session path for init_logger, see init_logger_deferred
+_pending_lock = threading.Lock()
+
+log_queue_size = 10000  # log records waiting for the writer thread, further records are dropped (and counted)
+log_sampling = {}       # method name or qualname -> log every n-th call only, e.g. {'BiasSet': 100}
+
+class call_repr(reprlib.Repr):
+    """
+    Size-bounded repr of call arguments: arrays, DataFrames and Series by type, shape and dtype
+    only, long strings, containers and other objects truncated.
+    """
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 3
+        self.maxlist = self.maxtuple = self.maxset = self.maxdict = 10
+        self.maxstring = 120
+        self.maxother = 120
+
+    def repr_ndarray(self, obj, level):
+        return f"ndarray(shape={obj.shape}, dtype={obj.dtype})"
+
+    def repr_DataFrame(self, obj, level):
+        return f"DataFrame(shape={obj.shape})"
+
+    def repr_Series(self, obj, level):
+        return f"Series(shape={obj.shape}, dtype={obj.dtype})"
+
+    def repr_reply(self, obj, level): # tcp_raw.reply
+        return f"reply(args={self.repr1(obj.args, level - 1)})"
+
+_call_repr = call_repr()
+
+def format_call(func, args, kwargs):
+    # Remove 'self' from args if method
+    args_without_self = args[1:] if args else []
+    arg_list = [_call_repr.repr(a) for a in args_without_self]
+    kwarg_list = [f"{k}={_call_repr.repr(v)}" for k, v in kwargs.items()]
+    return f"Called: {func.__qualname__}({', '.join(arg_list + kwarg_list)})"
+
+class bounded_queue_handler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking the caller"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if not record.args and not record.exc_info:
+            return record  # nothing to render in this thread, the writer thread formats it
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 def init_logger(session_path: str):
-    global _logger_initialized
+    """
+    Log to log_<date>.log in session_path. Records are handed to a writer thread through a
+    bounded queue, the calling thread does no file I/O.
+    """
+    global _logger_initialized, _listener, _queue_handler
     if _logger_initialized:
         print("Logger already initialized")
         return
@@ -24,61 +91,109 @@ def init_logger(session_path: str):
         print("Clearing existing handlers")
         root_logger.handlers.clear()
 
-    logging.basicConfig(
-        filename=log_file,
-        filemode='a',
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    file_handler = logging.FileHandler(log_file, mode='a')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    _queue_handler = bounded_queue_handler(queue.Queue(log_queue_size))
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, file_handler)
+    _listener.start()
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(logging.INFO)
+    atexit.register(logger_stop)
     _logger_initialized = True
 
+def init_logger_deferred(session_path_get):
+    """
+    init_logger(session_path_get()) right before the first logged call instead of now, so that
+    creating a connection object does not wait for Nanonis. Calls before that are not logged anyway.
+    """
+    global _logger_pending
+    if not _logger_initialized and _logger_pending is None:
+        _logger_pending = session_path_get
+
+def logger_pending_init():
+    global _logger_pending
+    with _pending_lock:
+        session_path_get, _logger_pending = _logger_pending, None
+    if session_path_get is None:
+        return
+    try:
+        init_logger(session_path_get())
+    except Exception as e:
+        print(f"Failed to initialize logger: {e}")
+
+def logger_stop():
+    """Write the queued records, stop the writer thread and close the log file"""
+    global _logger_initialized, _listener, _queue_handler
+    if _listener is None:
+        return
+    _root_logger.removeHandler(_queue_handler)
+    _listener.stop()
+    file_handler = _listener.handlers[0]
+    if _queue_handler.dropped:
+        file_handler.handle(logging.makeLogRecord({'msg': f"{_queue_handler.dropped} log records dropped (queue full)",
+                                                   'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+    file_handler.close()
+    _listener = _queue_handler = None
+    _logger_initialized = False
+
+def log_sampling_set(name, every=1):
+    """Log only every n-th call of the method name (e.g. 'BiasSet' or 'nanonis_ctrl.BiasSet'), 1: every call"""
+    log_sampling[name] = every
 
 def log_call(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        try:
-            # Build argument representation
-            # Remove 'self' from args if method
-            args_without_self = args[1:] if args else []
-            arg_list = [repr(a) for a in args_without_self]
-            kwarg_list = [f"{k}={v!r}" for k, v in kwargs.items()]
-            all_args = ", ".join(arg_list + kwarg_list)
-            logging.info(f"Called: {func.__qualname__}({all_args})")
-        except Exception as e:
-            logging.error(f"Logging failed in {func.__qualname__}: {e}")
+        if _root_logger.isEnabledFor(logging.INFO):
+            try:
+                logging.info(format_call(func, args, kwargs))
+            except Exception as e:
+                logging.error(f"Logging failed in {func.__qualname__}: {e}")
         return func(*args, **kwargs)
     return wrapper
 
 
 def log_calls(max_depth=0):
     def decorator(func):
+        calls = itertools.count()  # for log_sampling
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if not hasattr(_call_depth, 'level'):
-                _call_depth.level = 0
-
-            # Check if this is a method (self is first arg) and if logging is enabled
-            instance = args[0] if args else None
-            logging_enabled = getattr(instance, "logging_enabled", True)
-
-            if logging_enabled and _call_depth.level < max_depth:
-                try:
-                    args_without_self = args[1:] if args else []
-                    arg_list = [repr(a) for a in args_without_self]
-                    kwarg_list = [f"{k}={v!r}" for k, v in kwargs.items()]
-                    all_args = ", ".join(arg_list + kwarg_list)
-                    logging.info(f"Called: {func.__qualname__}({all_args})")
-                except Exception as e:
-                    logging.error(f"Logging failed in {func.__qualname__}: {e}")
-
-            _call_depth.level += 1
+            level = getattr(_call_depth, 'level', 0)
+            if _logger_pending is not None and level == 0 and not getattr(_call_depth, 'suppressed', 0):
+                logger_pending_init()
+
+            # Cheap checks first: nested call, logging off (no logger initialized), suppressed,
+            # logging disabled on the instance, sampling. Arguments are formatted only for logged calls.
+            if (level < max_depth and _root_logger.isEnabledFor(logging.INFO)
+                    and not getattr(_call_depth, 'suppressed', 0)
+                    and getattr(args[0] if args else None, "logging_enabled", True)):
+                every = log_sampling.get(func.__qualname__) or log_sampling.get(func.__name__, 1)
+                if every <= 1 or next(calls) % every == 0:
+                    try:
+                        logging.info(format_call(func, args, kwargs))
+                    except Exception as e:
+                        logging.error(f"Logging failed in {func.__qualname__}: {e}")
+
+            _call_depth.level = level + 1
             try:
                 return func(*args, **kwargs)
             finally:
-                _call_depth.level -= 1
+                _call_depth.level = level
         return wrapper
     return decorator
 
+@contextmanager
+def logging_suppressed():
+    """
+    Do not log calls made in this thread inside the with block
+    (e.g. when a batched call is run a second time to decode its reply).
+    """
+    _call_depth.suppressed = getattr(_call_depth, 'suppressed', 0) + 1
+    try:
+        yield
+    finally:
+        _call_depth.suppressed -= 1
+
 def apply_logging(cls, max_depth=1):
     """
     Apply logging decorator to all public callable methods of a class.
@@ -92,4 +207,4 @@ def apply_logging(cls, max_depth=1):
             # Wrap with log_calls decorator with max_depth
             decorated = log_calls(max_depth=max_depth)(attr)
             setattr(cls, attr_name, decorated)
-    return cls
\ No newline at end of file
+    return cls
@@ -7,8 +7,15 @@ import pandas as pd
 import numpy as np
 import os
 import re
-from .log_utils import apply_logging, init_logger
+from .log_utils import apply_logging, init_logger_deferred
+from . import tcp_batch
+from . import tcp_raw
+from . import nanonis_files
+from . import signal_registry
+from . import tcp_state
 @apply_logging
+@tcp_raw.apply_raw
+@tcp_state.apply_state
 class nanonis_ctrl:
     # Class variables
     # To change the value of class variable in your script, use this: 
@@ -16,21 +23,86 @@ class nanonis_ctrl:
     #   tcp.nanonis_ctrl.if_print = True
     if_print = False
     # Functions
-    def __init__(self, tcp,PLL_modulator_index=1):
+    def __init__(self, tcp,PLL_modulator_index=1, raw=False, state_cache=False):
         self.tcp = tcp
+        if raw: # every call returns a tcp_raw.reply, see raw()
+            self.tcp.raw_all += 1
+        self.state = None # tcp_state.state_cache, see state_cache_enable()
+        if state_cache:
+            self.state_cache_enable()
         # self.f_print = False
         self.mod_index=PLL_modulator_index
         self.version=self.tcp.version
         
-        try:
-            session_path = self.UtilSessionPathGet().loc['Session path', 0]
-            init_logger(session_path)
-        except Exception as e:
-            print(f"Failed to initialize logger: {e}")
+        init_logger_deferred(self._session_path) # the logger starts with the first call, not here
+
+    @property
+    def signals(self):
+        '''signal names and slots of the controller, asked for once and cached (see signal_registry)'''
+        return signal_registry.registry_get(self)
+
+    def _session_path(self):
+        return self.UtilSessionPathGet().loc['Session path', 0]
 
 # it is recommended to construct body first so that you don't need to calculate the body size by yourself
 # SI units are used in this module
 
+    def batch(self):
+        """
+        Queue calls and send them in one go, replies are read back in order.
+
+            with connect.batch() as b:
+                bias = b.BiasGet()
+                b.ScanFrameSet(0, 0, 50e-9, 50e-9, 0)
+            bias.result()
+
+        Every call in the with block returns a deferred result (tcp_batch.deferred), available
+        when the block has ended. N independent calls then cost about one round trip instead of N.
+        """
+        return tcp_batch.batch(self)
+
+    def no_reply(self):
+        """
+        Send setters (commands without return arguments) without waiting for Nanonis to reply.
+
+            with connect.no_reply():
+                connect.BiasSet(0.1)
+            connect.no_reply().BiasSet(0.1)   # a single call
+
+        Getters are not affected. Nanonis does not report errors of commands sent without reply.
+        """
+        return tcp_batch.no_reply(self)
+
+    def raw(self):
+        """
+        Return the decoded reply (tcp_raw.reply) instead of building DataFrames, for polling loops.
+
+            vals = connect.raw().SignalsValsGet([0, 1], 1)   # a single call
+            vals[1], vals.error                             # reply arguments, (status, size, description)
+            with connect.raw():
+                status = connect.ScanWaitEndOfScan(1)[0]
+
+        The usual DataFrame is built on demand: vals.df, or DataFrame attributes on the reply (vals.iloc[0, 0]).
+        """
+        return tcp_raw.raw(self)
+
+    def state_cache_enable(self, ttl=None, cache=None):
+        """
+        Serve read-mostly settings (scan frame, buffer and speed, follow me speed, lock-in amplitude, ...)
+        from a write-through cache and do not send setters that write the value already set.
+
+            connect.state_cache_enable(ttl=60)
+            connect.state.stats(prt=True)    # hits, misses and suppressed sets per command
+            connect.state.invalidate()       # after changing settings in Nanonis itself
+
+        ttl: seconds a cached value is trusted (None: until invalidated). cache: a tcp_state.state_cache
+        to share with other connections to the same Nanonis, None for a new one. See tcp_state.
+        """
+        self.state = tcp_state.state_cache(ttl) if cache is None else cache
+        return self.state
+
+    def state_cache_disable(self):
+        self.state = None
 
 
 
@@ -76,28 +148,8 @@ class nanonis_ctrl:
         # Open the file in binary write mode
         fn = open(pathname, mode='wb')
         
-        # Write the Nanonis version information
-        fn.write((":NANONIS_VERSION:\n").encode('utf-8'))
-        fn.write(("2\n").encode('utf-8'))  # Assuming version 2 is being used
-        
-        # Write the scan type information
-        fn.write((":SCANIT_TYPE:\n").encode('utf-8'))
-        fn.write(("\tFLOAT\tMSBFIRST\n").encode('utf-8'))
-        
-        # Write the scan parameters
-        for key in scan_par:
-            print(key)  # Print the current key to the console (for debugging or logging)
-            fn.write((":" + key + ":\n").encode('utf-8'))
-            fn.write((scan_par[key] + "\n").encode('utf-8'))
-        
-        # Write the header information
-        for key in header:
-            fn.write((":" + key + ":\n").encode('utf-8'))
-            fn.write((header[key] + "\n").encode('utf-8'))
-        
-        # Write data information header
-        fn.write((":DATA_INFO:\n").encode('utf-8'))
-        fn.write(("\tChannel\tName\tUnit\tDirection\tCalibration\tOffset\n").encode('utf-8'))
+        # Write the header: version, scan type, scan parameters, header information and channels (see nanonis_files.sxm_writer to write the lines while they are acquired)
+        fn.write(nanonis_files.sxm_header(scan_par, header, channels))
         
         C = data2d.shape[0]  # Number of channels (C)
         L = data2d.shape[1]  # Number of elements (L), which should be equal to pix_tuple[0] * pix_tuple[1]
@@ -110,31 +162,14 @@ class nanonis_ctrl:
             array1 = data[:,:,:pixels[0]]
             array2 = data[:,:,pixels[0]:]
             data = np.stack([array1,array2], axis=-1)
-        # Write the channel data
-        for j in range(len(channels)):
-            for i in range(len(channels[0])):
-                fn.write(("\t").encode('utf-8'))
-                fn.write((str(channels[j][i])).encode('utf-8'))
-            fn.write(("\n").encode('utf-8'))   
-        
-        # End of the data section
-        fn.write(("\n").encode('utf-8'))
-        fn.write((":SCANIT_END:\n\n\n").encode('utf-8'))
-        
-        # Write control characters
-        fn.write(bytes([26]))  # ASCII control character for 'substitute' (often used as EOF marker)
-        fn.write(bytes([4]))   # ASCII control character for 'end of transmission'
-        
-        # Write additional data arrays
+        # Write additional data arrays (big-endian 32-bit float, written as they are when they already are, e.g. ScanFrameDataGrab data)
     
         for i in range(0,len(data)):
            # if direction==False:
             if backward==False:
-                data[i, :, :].astype(">f4").tofile(fn)  # Convert array to big-endian 32-bit float and write to file
-                data[i, :, ::-1].astype(">f4").tofile(fn)
+                nanonis_files.f4_write(fn, data[i, :, :], data[i, :, ::-1])
             else:
-                data[i, :, :,0].astype(">f4").tofile(fn)  # Convert array to big-endian 32-bit float and write to file
-                data[i, :, :,1].astype(">f4").tofile(fn)
+                nanonis_files.f4_write(fn, data[i, :, :,0], data[i, :, :,1])
            # else:
             #    data[i, ::-1, :].astype(">f4").tofile(fn)  # Convert array to big-endian 32-bit float and write to file
              #   data[i, ::-1, ::-1].astype(">f4").tofile(fn)
@@ -163,9 +198,7 @@ class nanonis_ctrl:
         if bias > 10:
             raise ValueError('The maximum allowed bias is 10V. Please check your input! Bias has been set to 0 to protect the tip!')    
         
-        body = self.tcp.dtype_cvt(bias, 'float32', 'bin')
-        header = self.tcp.header_construct('Bias.Set', body_size=len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('Bias.Set', ('float32',), bias)
 
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
@@ -187,9 +220,7 @@ class nanonis_ctrl:
         Returns:
             pd.DataFrame: A DataFrame containing the current bias voltage.
         """
-        header = self.tcp.header_construct('Bias.Get', body_size=0)
-
-        self.tcp.cmd_send(header)
+        self.tcp.cmd_send(self.tcp.cmd_encode('Bias.Get', ()))
         _, res_arg, res_err = self.tcp.res_recv('float32')
 
         self.tcp.print_err(res_err)
@@ -1434,9 +1465,7 @@ class nanonis_ctrl:
             If there is an error in communication with the Z-controller.
         """
         z_pos = self.tcp.unit_cvt(z_pos)
-        body = self.tcp.dtype_cvt(z_pos, 'float32', 'bin')
-        header = self.tcp.header_construct('ZCtrl.ZPosSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('ZCtrl.ZPosSet', ('float32',), z_pos)
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
         self.tcp.print_err(res_err)
@@ -1466,8 +1495,7 @@ class nanonis_ctrl:
         Exception
             If there is an error in communication with the Z-controller.
         """
-        header = self.tcp.header_construct('ZCtrl.ZPosGet', 0)
-        self.tcp.cmd_send(header)
+        self.tcp.cmd_send(self.tcp.cmd_encode('ZCtrl.ZPosGet', ()))
         _, res_arg, res_err = self.tcp.res_recv('float32')
         self.tcp.print_err(res_err)
         z_pos_df = pd.DataFrame({'Z position of the tip (m)': res_arg[0]}, index=[0]).T
@@ -1498,9 +1526,7 @@ class nanonis_ctrl:
         Exception
             If there is an error in communication with the Z-controller.
         """
-        body = self.tcp.dtype_cvt(z_ctrl_status, 'uint32', 'bin')
-        header = self.tcp.header_construct('ZCtrl.OnOffSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('ZCtrl.OnOffSet', ('uint32',), z_ctrl_status)
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
         self.tcp.print_err(res_err)
@@ -2108,10 +2134,7 @@ class nanonis_ctrl:
         Exception
             If there is an error in communication with the scanner.
         """
-        body = self.tcp.dtype_cvt(scan_act, 'uint16', 'bin')
-        body += self.tcp.dtype_cvt(scan_dir, 'uint32', 'bin')
-        header = self.tcp.header_construct('Scan.Action', body_size=len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('Scan.Action', ('uint16', 'uint32'), scan_act, scan_dir)
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
         self.tcp.print_err(res_err)
@@ -2153,9 +2176,7 @@ class nanonis_ctrl:
     def ScanWaitEndOfScan(self, timeout, prt = if_print):
         timeout = int(self.tcp.unit_cvt(timeout)*1000)
 
-        body  = self.tcp.dtype_cvt(timeout, 'int', 'bin')
-        header = self.tcp.header_construct('Scan.WaitEndOfScan', body_size = len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('Scan.WaitEndOfScan', ('int',), timeout)
 
         self.tcp.cmd_send(cmd)
         _, res_arg, res_err = self.tcp.res_recv('uint32', 'uint32', 'str')
@@ -2178,14 +2199,8 @@ class nanonis_ctrl:
         h = self.tcp.unit_cvt(h)
         angle = self.tcp.unit_cvt(angle)
 
-        body  = self.tcp.dtype_cvt(center_x, 'float32', 'bin')
-        body += self.tcp.dtype_cvt(center_y, 'float32', 'bin')
-        body += self.tcp.dtype_cvt(w, 'float32', 'bin')
-        body += self.tcp.dtype_cvt(h, 'float32', 'bin')
-        body += self.tcp.dtype_cvt(angle, 'float32', 'bin')
-        
-        header = self.tcp.header_construct('Scan.FrameSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('Scan.FrameSet', ('float32', 'float32', 'float32', 'float32', 'float32'),
+                                  center_x, center_y, w, h, angle)
 
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
@@ -2205,9 +2220,7 @@ class nanonis_ctrl:
         return scan_frame_df
 
     def ScanFrameGet(self, prt = if_print):
-        header = self.tcp.header_construct('Scan.FrameGet', body_size = 0)
-
-        self.tcp.cmd_send(header)
+        self.tcp.cmd_send(self.tcp.cmd_encode('Scan.FrameGet', ()))
         _, res_arg, res_err = self.tcp.res_recv('float32', 'float32', 'float32', 'float32', 'float32')
 
         self.tcp.print_err(res_err)
@@ -2424,12 +2437,7 @@ class nanonis_ctrl:
         x = self.tcp.unit_cvt(x)
         y = self.tcp.unit_cvt(y)
 
-        body  = self.tcp.dtype_cvt(x, 'float64', 'bin')
-        body += self.tcp.dtype_cvt(y, 'float64', 'bin')
-        body += self.tcp.dtype_cvt(wait_end_of_mv, 'uint32', 'bin')
-        
-        header = self.tcp.header_construct('FolMe.XYPosSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('FolMe.XYPosSet', ('float64', 'float64', 'uint32'), x, y, wait_end_of_mv)
 
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
@@ -2459,10 +2467,7 @@ class nanonis_ctrl:
         - pd.DataFrame: DataFrame displaying the current tip coordinates.
         """
 
-        body  = self.tcp.dtype_cvt(wait_for_new_data, 'uint32', 'bin')
-        
-        header = self.tcp.header_construct('FolMe.XYPosGet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('FolMe.XYPosGet', ('uint32',), wait_for_new_data)
 
         self.tcp.cmd_send(cmd)
         _, res_arg, res_err = self.tcp.res_recv('float64', 'float64')
@@ -2495,11 +2500,7 @@ class nanonis_ctrl:
 
         spd = self.tcp.unit_cvt(spd)
 
-        body  = self.tcp.dtype_cvt(spd, 'float32', 'bin')
-        body += self.tcp.dtype_cvt(cus_spd, 'uint32', 'bin')
-        
-        header = self.tcp.header_construct('FolMe.SpeedSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('FolMe.SpeedSet', ('float32', 'uint32'), spd, cus_spd)
 
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
@@ -4209,6 +4210,7 @@ class nanonis_ctrl:
         cmd = header + body
         
         self.tcp.cmd_send(cmd)
+        signal_registry.slots_changed(self) # before the reply: in raw mode the method stops at res_recv
         _, _, res_err = self.tcp.res_recv()
         
         self.tcp.print_err(res_err)
@@ -4788,9 +4790,7 @@ class nanonis_ctrl:
         pd.DataFrame
             DataFrame containing the Kelvin Controller on/off status.
         """
-        body = self.tcp.dtype_cvt(ctrl_status, 'uint32', 'bin')
-        header = self.tcp.header_construct('KelvinCtrl.CtrlOnOffSet', len(body))
-        cmd = header + body
+        cmd = self.tcp.cmd_encode('KelvinCtrl.CtrlOnOffSet', ('uint32',), ctrl_status)
 
         self.tcp.cmd_send(cmd)
         _, _, res_err = self.tcp.res_recv()
@@ -5156,14 +5156,14 @@ class nanonis_ctrl:
         header = self.tcp.header_construct('Util.VersionGet', body_size=0)
     
         self.tcp.cmd_send(header)
-        _, res_arg, res_err = self.tcp.res_recv('str', 'str', 'uint32', 'uint32')
+        _, res_arg, res_err = self.tcp.res_recv('int', 'str', 'int', 'str', 'uint32', 'uint32')
     
         self.tcp.print_err(res_err)
         version_df = pd.DataFrame({
-            'Product Line': res_arg[0],
-            'Software Version': res_arg[1],
-            'Host App. Release': res_arg[2],
-            'RT Engine Release': res_arg[3]
+            'Product Line': res_arg[1],
+            'Software Version': res_arg[3],
+            'Host App. Release': res_arg[4],
+            'RT Engine Release': res_arg[5]
         }, index=[0]).T
     
         if prt:
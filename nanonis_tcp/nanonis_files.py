@@ -0,0 +1,304 @@
+# -*- encoding: utf-8 -*-
+'''
+Binary data of Nanonis files (.sxm, .3ds): big-endian float32 (MSBFIRST), the same byte
+order as the arrays in the TCP replies.
+
+    f4_write(f, params, counts)         # one record of a .3ds pixel, one (gathered) write
+    grid = grid3ds_writer(filename, pix, grid_settings, bias)   # .3ds file written a line at a time
+    sxm = sxm_writer(filename, pix, scan_par, channels)         # .sxm file filled a line at a time
+
+Arrays already in big-endian float32 (tcp_codec decodes '2dfloat32' etc. as '>f4' views on the
+reply, ScanFrameDataGrab / TipRecDataGet in raw mode hand them out as such) are written as
+they are: no byte swap and no copy. Other arrays are converted once. The buffers of one call
+go to the file in one os.writev where available (the file's own buffer is flushed before),
+otherwise one write per buffer; buffers larger than the file buffer are not copied by Python.
+'''
+############################### packages ######################################
+import io
+import os
+import threading
+from datetime import datetime
+from queue import Queue
+import numpy as np
+
+be_f4 = np.dtype('>f4')
+iov_max = 1024 # buffers per os.writev call
+
+def f4_be(arr):
+    '''arr as a C contiguous big-endian float32 array, arr itself when it already is one'''
+    return np.ascontiguousarray(arr, dtype = be_f4)
+
+def file_fd(f):
+    '''file descriptor for os.writev, None for files without one (or without os.writev, e.g. Windows)'''
+    if not hasattr(os, 'writev'):
+        return None
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+def f4_write(f, *arrays):
+    '''write arrays one after another to the binary file f as big-endian float32'''
+    bufs = [memoryview(f4_be(arr)).cast('B') for arr in arrays]
+    bufs = [buf for buf in bufs if len(buf)]
+    fd = file_fd(f)
+    if fd is None or len(bufs) < 2:
+        for buf in bufs:
+            f.write(buf)
+        return
+    f.flush()
+    while bufs:
+        written = os.writev(fd, bufs[:iov_max])
+        while bufs and written >= len(bufs[0]):
+            written -= len(bufs[0])
+            del bufs[0]
+        if written:
+            bufs[0] = bufs[0][written:]
+    f.seek(0, os.SEEK_CUR) # the file object takes the position of the descriptor again
+
+class grid3ds_writer:
+    '''
+    .3ds grid file written a line of pixels at a time.
+
+        grid = grid3ds_writer(filename, pix, grid_settings, bias, background = True)
+        grid.experiment(fixed_parameters, points, extra = ['wl 0=500.1', ...])  # rest of the header, before the first line
+        grid.write_line(params, counts, sweep = (start, end))                   # (pixels, parameters), (pixels, points) or (points,)
+        grid.close()                                                            # End time written, file closed
+
+    The header is written with the line ends of Nanonis (CRLF), its first line holds the End
+    time, patched in place by close. A line is assembled into one (pixels, parameters + points)
+    big-endian float32 block and written with a single write. background: the blocks are written
+    by a thread of the writer, write_line returns once the block is assembled.
+    file is a file name or a binary file object (not closed by close).
+    '''
+    newline = '\r\n'
+
+    def __init__(self, file, pix, grid_settings, bias = 0., user = '', comment = '', background = False):
+        """
+       Parameters
+       file            : file name or binary file object
+       pix             : (pixels in x, lines)
+       grid_settings   : center x, center y, width, height (m), angle (deg)
+       bias            : Bias (V)
+       user, comment   : User and Comment fields
+       background      : write the lines in a thread of the writer
+       """
+        self.own = isinstance(file, (str, os.PathLike))
+        self.f = open(file, 'wb') if self.own else file
+        self.start = self.f.tell()
+        self.start_time = self.now()
+        self.n_params = self.points = None  # set by experiment
+        self.lines = 0                      # lines written
+        self.error = None
+        self.header([f'End time="{self.start_time}"',
+                     f'Start time="{self.start_time}"',
+                     'Delay before measuring (s)=0',
+                     f'Comment={comment}',
+                     f'Bias (V)={bias:.6E}',
+                     'Experiment=Experiment',
+                     f'Date="{self.start_time.split()[0]}"',
+                     f'User={user}',
+                     f'Grid dim="{pix[0]} x {pix[1]}"',
+                     'Grid settings=' + ';'.join(f'{val:.6E}' for val in grid_settings)])
+        self.queue = self.thread = None
+        if background:
+            self.queue = Queue()
+            self.thread = threading.Thread(target = self.write_loop, daemon = True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    @staticmethod
+    def now():
+        return datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
+
+    def header(self, lines):
+        self.f.write(''.join(line + self.newline for line in lines).encode())
+
+    def experiment(self, fixed_parameters, points, sweep_signal = 'Wavelength (nm)', channels = 'Counts', extra = ()):
+        '''
+        the experiment part of the header, ending it: fixed_parameters (names, the sweep start and end
+        first), points per channel, extra: header lines after Channels (settings, channel names)
+        '''
+        self.header([f'Sweep Signal="{sweep_signal}"',
+                     f'Fixed parameters="{";".join(fixed_parameters)}"',
+                     'Experiment parameters=',
+                     f'# Parameters (4 byte)={len(fixed_parameters)}',
+                     f'Experiment size (bytes)={4*points}',
+                     f'Points={points}',
+                     f'Channels={channels}', *extra, ':HEADER_END:'])
+        self.f.flush() # the lines go to the file as they are, not through the file buffer
+        self.n_params, self.points = len(fixed_parameters), points
+
+    def write_line(self, params, counts, sweep = None):
+        '''
+        a line of pixels: params (pixels, parameters), without the sweep start and end when sweep is
+        given, counts (pixels, points), or (points,) the same for every pixel
+        '''
+        if self.error is not None:
+            raise self.error
+        params = np.asarray(params)
+        block = np.empty((len(params), self.n_params + self.points), dtype = be_f4)
+        first = 0 if sweep is None else len(sweep)
+        block[:, :first] = sweep if sweep is not None else 0
+        block[:, first:self.n_params] = params
+        block[:, self.n_params:] = counts
+        if self.queue is not None:
+            self.queue.put(block)
+        else:
+            self.f.write(memoryview(block).cast('B'))
+        self.lines += 1
+
+    def write_loop(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                if self.error is None:
+                    self.f.write(memoryview(block).cast('B'))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''wait for the lines queued, then flush the file'''
+        if self.queue is not None:
+            self.queue.join()
+        self.f.flush()
+
+    def close(self):
+        '''write the lines left, the End time, and close the file'''
+        if self.f is None:
+            return
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        end = self.f.tell()
+        self.f.seek(self.start)
+        self.f.write(f'End time="{self.now()}"'.encode()) # as long as the Start time: the line keeps its length
+        self.f.seek(end)
+        if self.own:
+            self.f.close()
+        else:
+            self.f.flush()
+        self.f = None
+        if self.error is not None:
+            print(f"Error writing the .3ds file: {self.error}")
+
+def sxm_header(scan_par, header, channels, widths = None):
+    '''
+    header of an .sxm file, up to the data (":SCANIT_END:" and the 0x1a 0x04 marker), as bytes.
+    channels: rows of DATA_INFO, widths: {key: characters} the values of scan_par are padded to
+    '''
+    widths = {} if widths is None else widths
+    lines = [':NANONIS_VERSION:', '2', ':SCANIT_TYPE:', '\tFLOAT\tMSBFIRST']
+    for key, value in scan_par.items():
+        lines += [f':{key}:', value.ljust(widths.get(key, 0))]
+    for key, value in header.items():
+        lines += [f':{key}:', value]
+    lines += [':DATA_INFO:', '\tChannel\tName\tUnit\tDirection\tCalibration\tOffset']
+    lines += [''.join(f'\t{item}' for item in channel) for channel in channels]
+    return ('\n'.join(lines) + '\n\n:SCANIT_END:\n\n\n').encode('utf-8') + bytes([26, 4])
+
+class sxm_writer:
+    '''
+    .sxm file filled a line at a time while the map is acquired.
+
+        sxm = sxm_writer(filename, pix, scan_par, channels, header, backward = True)
+        sxm.channels_add(rows)                          # more channels (rows of DATA_INFO), before the first line
+        sxm.write_line(i, forward, backward, first)     # line i, (pixels, channels) of the channels first, first + 1, ...
+        sxm.close({'ACQ_TIME': '12.3'})                 # values of the reserved keys written
+
+    The header and a region per channel and direction filled with NaN are written when the writer
+    is created (again by channels_add), the lines go into the file through a memory map: only a
+    line is held in memory, and a map aborted at any point leaves a readable file (NaN where not
+    acquired). The data are laid out as
+    writesxm does: backward lines in the order acquired (right to left), None: the forward line
+    mirrored. The values of the reserved keys of scan_par are padded to their width, so close can
+    write them in place.
+    '''
+    reserved = {'REC_DATE': 16, 'REC_TIME': 16, 'ACQ_TIME': 16}
+
+    def __init__(self, filename, pix, scan_par, channels, header = None, backward = False):
+        """
+       Parameters
+       filename        : .sxm file name
+       pix             : (pixels in x, lines)
+       scan_par        : {key: value} of the scan (SCAN_PIXELS, SCAN_RANGE, ...), strings
+       channels        : rows of DATA_INFO (Channel, Name, Unit, Direction, Calibration, Offset)
+       header          : {key: value} written after scan_par
+       backward        : backward lines are given (write_line)
+       """
+        self.filename = filename
+        self.pix = pix
+        self.scan_par = dict(scan_par)
+        self.channels = [list(channel) for channel in channels]
+        self.header = {} if header is None else dict(header)
+        self.backward = backward
+        self.data = None    # memory map (channel, direction, line, pixel)
+        self.written = False # lines written, the channels are fixed
+        self.closed = False
+        self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def channels_add(self, channels):
+        '''more channels: the file (no lines yet) is written again with them'''
+        if self.written:
+            raise ValueError("Channels cannot be added once the lines are written.")
+        self.channels += [list(channel) for channel in channels]
+        self.data = None # unmapped before the file is rewritten
+        self.open()
+
+    def open(self):
+        '''write the header and the data regions (NaN), map the data'''
+        widths = {key: width for key, width in self.reserved.items() if key in self.scan_par}
+        header = sxm_header(self.scan_par, self.header, self.channels, widths)
+        self.values = {} # offsets of the reserved values in the header
+        for key in widths:
+            self.values[key] = header.index(f'\n:{key}:\n'.encode()) + len(key) + 4
+        shape = (len(self.channels), 2, self.pix[1], self.pix[0])
+        empty = memoryview(np.full(shape[1:], np.nan, dtype = be_f4)).cast('B')
+        with open(self.filename, 'wb') as f:
+            f.write(header)
+            for _ in range(shape[0]):
+                f.write(empty)
+        self.data = np.memmap(self.filename, dtype = be_f4, mode = 'r+', offset = len(header), shape = shape)
+
+    def write_line(self, i, forward, backward = None, first = 0):
+        '''
+        line i of the channels first, first + 1, ...: forward (pixels, channels), backward the same in the
+        order acquired, None: forward mirrored
+        '''
+        self.written = True
+        forward = np.asarray(forward)
+        channels = slice(first, first + forward.shape[1])
+        self.data[channels, 0, i] = forward.T
+        self.data[channels, 1, i] = (forward[::-1] if backward is None else np.asarray(backward)).T
+
+    def close(self, scan_par = None):
+        '''flush the lines, write the values of the reserved keys in scan_par'''
+        if self.closed:
+            return
+        self.data.flush()
+        self.data = None
+        with open(self.filename, 'r+b') as f:
+            for key, value in (scan_par or {}).items():
+                if key not in self.values:
+                    print(f"{key} is not reserved in the .sxm header, not written.")
+                    continue
+                f.seek(self.values[key])
+                f.write(value.ljust(self.reserved[key])[:self.reserved[key]].encode())
+        self.closed = True
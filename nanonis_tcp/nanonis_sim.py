@@ -0,0 +1,554 @@
+# -*- encoding: utf-8 -*-
+'''
+Local simulator of the Nanonis TCP interface, to run and benchmark the clients without a controller.
+
+    with nanonis_sim(ports = (6501, 6502), latency = 1e-3) as sim:
+        connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', sim.ports[0]))
+        connect.BiasSet(0.5)
+        photon_meas(connect).nanonis_map_k(acqtime = 0.01, pix = (8, 8), ds3 = False)
+
+The simulator speaks the binary protocol of Nanonis (32-byte command name, body size,
+"send response back" flag, big-endian body, error trailer after the arguments) and keeps
+one instrument state shared by all its ports:
+   - bias, Z position and Z-controller, Kelvin controller
+   - scan frame, scan buffer and a scan that runs for lines x line_time seconds
+   - Follow Me position moving at the set speed, oversampling
+   - tip recorder buffer filling in time with the channels of the scan buffer
+   - signals computed from the tip position and bias (topography, tunnelling current,
+     photon counts) with gaussian noise
+latency (s) delays every reply and bandwidth (bytes/s) limits both directions, like the network
+between the client and the instrument PC. Pipelined requests overlap their latency as they
+would on a real link. Commands the simulator does not know are answered with an error.
+
+    python -m nanonis_tcp.nanonis_sim      # serve on 6501-6504 until Ctrl+C
+'''
+############################### packages ######################################
+import queue
+import socket
+import socketserver
+import struct as st
+import tempfile
+import threading
+import time
+from collections import Counter
+import numpy as np
+
+from . import tcp_codec
+
+############################### signals #######################################
+# signal name: noise amplitude at noise = 1
+default_signals = {
+    'Current (A)': 5e-12,
+    'Bias (V)': 1e-4,
+    'X (m)': 2e-12,
+    'Y (m)': 2e-12,
+    'Z (m)': 5e-12,
+    'Phase (deg)': 0.1,
+    'Amplitude (m)': 1e-12,
+    'Frequency Shift (Hz)': 0.05,
+    'Excitation (V)': 1e-3,
+    'LI Demod 1 X (A)': 1e-13,
+    'LI Demod 1 Y (A)': 1e-13,
+    'LI Demod 2 X (A)': 1e-13,
+    'LI Demod 2 Y (A)': 1e-13,
+    'Counter 1 (Hz)': 30.,
+    'Counter 2 (Hz)': 30.,
+    'Input 1 (V)': 1e-3,
+    'Input 2 (V)': 1e-3,
+    'Input 3 (V)': 1e-3,
+    'Input 4 (V)': 1e-3,
+    'Temperature 1 (K)': 1e-3,
+}
+
+def body_encode(body_fmt, args):
+    '''big-endian body of the arguments, formats as in tcp_codec.supported_fmts'''
+    parts = []
+    for arg_fmt, arg in zip(body_fmt, args):
+        if arg_fmt in tcp_codec.scalar_codes:
+            parts.append(st.pack('>' + tcp_codec.scalar_codes[arg_fmt], arg))
+        elif arg_fmt == 'str':
+            parts.append(arg.encode('iso-8859-1'))
+        elif arg_fmt in tcp_codec.str_array_fmts:
+            parts.extend(st.pack('>i', len(s)) + s.encode('utf-8') for s in (str(s) for s in np.ravel(arg)))
+        else:
+            parts.append(np.ascontiguousarray(arg, tcp_codec.array_dtypes[arg_fmt]).tobytes())
+    return b''.join(parts)
+
+def str_array_size(strings):
+    '''size in bytes of a string array in the protocol (the 'int' preceding 1dstr arguments)'''
+    return sum(4 + len(s.encode('utf-8')) for s in strings)
+
+class sim_error(Exception):
+    '''error reported to the client in the error trailer of the reply'''
+
+############################### instrument ####################################
+class sim_instrument:
+    '''
+    Instrument state shared by all ports of a nanonis_sim, and the commands acting on it.
+    commands maps a command name to (request format, reply format, method name); the
+    method gets the decoded request arguments and returns the reply arguments.
+    '''
+    sample_rate = 20000. # Follow Me / tip recorder samples per second at oversampling 1
+    kappa = 1e10         # tunnelling decay constant (1/m)
+    period = 5e-9        # period of the simulated surface (m)
+    corrugation = 1e-10  # height of the simulated surface (m)
+
+    commands = {
+        'Util.SessionPathGet':    ((), ('int', 'str'), 'session_path_get'),
+        'Util.VersionGet':        ((), ('int', 'str', 'int', 'str', 'uint32', 'uint32'), 'version_get'),
+        'Signals.NamesGet':       ((), ('int', 'int', '1dstr'), 'signals_names_get'),
+        'Signals.InSlotsGet':     ((), ('int', 'int', '1dstr', 'int', '1dint'), 'signals_in_slots_get'),
+        'Signals.ValGet':         (('int', 'uint32'), ('float32',), 'signal_val_get'),
+        'Signals.ValsGet':        (('int', '1dint', 'uint32'), ('int', '1dfloat32'), 'signals_vals_get'),
+        'Current.Get':            ((), ('float32',), 'current_get'),
+        'Bias.Set':               (('float32',), (), 'bias_set'),
+        'Bias.Get':               ((), ('float32',), 'bias_get'),
+        'ZCtrl.ZPosSet':          (('float32',), (), 'z_pos_set'),
+        'ZCtrl.ZPosGet':          ((), ('float32',), 'z_pos_get'),
+        'ZCtrl.OnOffSet':         (('uint32',), (), 'z_ctrl_set'),
+        'ZCtrl.OnOffGet':         ((), ('uint32',), 'z_ctrl_get'),
+        'KelvinCtrl.CtrlOnOffSet':(('uint32',), (), 'kelvin_ctrl_set'),
+        'KelvinCtrl.CtrlOnOffGet':((), ('uint32',), 'kelvin_ctrl_get'),
+        'Scan.FrameSet':          (('float32',)*5, (), 'scan_frame_set'),
+        'Scan.FrameGet':          ((), ('float32',)*5, 'scan_frame_get'),
+        'Scan.BufferSet':         (('int', '1dint', 'int', 'int'), (), 'scan_buffer_set'),
+        'Scan.BufferGet':         ((), ('int', '1dint', 'int', 'int'), 'scan_buffer_get'),
+        'Scan.Action':            (('uint16', 'uint32'), (), 'scan_action'),
+        'Scan.StatusGet':         ((), ('uint32',), 'scan_status_get'),
+        'Scan.WaitEndOfScan':     (('int',), ('uint32', 'uint32', 'str'), 'scan_wait_end'),
+        'Scan.FrameDataGrab':     (('uint32', 'uint32'), ('int', 'str', 'int', 'int', '2dfloat32', 'uint32'), 'scan_frame_data_grab'),
+        'FolMe.XYPosSet':         (('float64', 'float64', 'uint32'), (), 'folme_xy_pos_set'),
+        'FolMe.XYPosGet':         (('uint32',), ('float64', 'float64'), 'folme_xy_pos_get'),
+        'FolMe.SpeedSet':         (('float32', 'uint32'), (), 'folme_speed_set'),
+        'FolMe.SpeedGet':         ((), ('float32', 'uint32'), 'folme_speed_get'),
+        'FolMe.OversamplSet':     (('int',), (), 'folme_oversampl_set'),
+        'FolMe.OversamplGet':     ((), ('int', 'float32'), 'folme_oversampl_get'),
+        'TipRec.BufferSizeSet':   (('int',), (), 'tiprec_buffer_size_set'),
+        'TipRec.BufferSizeGet':   ((), ('int',), 'tiprec_buffer_size_get'),
+        'TipRec.BufferClear':     ((), (), 'tiprec_buffer_clear'),
+        'TipRec.DataGet':         ((), ('int', '1dint', 'int', 'int', '2dfloat32'), 'tiprec_data_get'),
+    }
+
+    def __init__(self, session_path = None, signals = None, noise = 1., move_speed = 100e-9,
+                 line_time = 0.05, version = 13520, seed = None):
+        self.lock = threading.RLock()
+        self.scan_changed = threading.Condition(self.lock)
+        self.rng = np.random.default_rng(seed)
+        self.session_path = session_path if session_path is not None else tempfile.mkdtemp(prefix = 'nanonis_sim_')
+        self.version = version
+        self.noise = noise
+        self.signals = dict(default_signals if signals is None else signals)
+        self.signal_names = list(self.signals)
+        self.noise_scales = np.array(list(self.signals.values()))
+        now = time.perf_counter()
+
+        self.bias_t, self.bias_v = [now], [0.1]         # bias steps
+        self.z, self.z_ctrl, self.kelvin_ctrl = 0., 1, 0
+        self.setpoint = 100e-12
+
+        self.frame = [0., 0., 50e-9, 50e-9, 0.]          # center x, center y, width, height, angle (deg)
+        self.buffer_channels, self.pixels, self.lines = [0, 4], 256, 256
+        self.line_time = line_time                       # s per line (forward + backward)
+        self.scan_running, self.scan_paused = False, False
+        self.scan_elapsed, self.scan_since, self.scan_dir = 0., now, 1
+        self.scan_done_lines = self.lines                # lines of the last frame in the buffer
+
+        self.path_t, self.path_x, self.path_y = [now], [0.], [0.] # Follow Me path (linear between points)
+        self.default_speed = move_speed
+        self.speed, self.custom_speed = move_speed, 0
+        self.oversampling = 10
+
+        self.tiprec_size, self.tiprec_t0 = 10000, now
+
+    ############################### model #####################################
+    def position(self, t):
+        return np.interp(t, self.path_t, self.path_x), np.interp(t, self.path_t, self.path_y)
+
+    def bias_at(self, t):
+        return np.asarray(self.bias_v)[np.searchsorted(self.bias_t, t, side = 'right') - 1]
+
+    def topography(self, x, y):
+        k = 2*np.pi/self.period
+        return self.corrugation*np.cos(k*x)*np.cos(k*y)
+
+    def signals_eval(self, idxs, x, y, bias):
+        '''values of the signals idxs at the tip positions x, y and bias (arrays of one shape), with noise'''
+        x, y, bias = np.broadcast_arrays(np.asarray(x, float), np.asarray(y, float), np.asarray(bias, float))
+        topo = self.topography(x, y)
+        z = topo if self.z_ctrl else np.full(x.shape, self.z)
+        current = self.setpoint*np.sign(bias)*np.exp(-2*self.kappa*(z - topo))
+        pattern = 0.5*(1 + np.cos(2*np.pi*x/self.period)*np.cos(2*np.pi*y/self.period))
+        model = {'Current (A)': current, 'Bias (V)': bias, 'X (m)': x, 'Y (m)': y, 'Z (m)': z,
+                 'LI Demod 1 X (A)': 0.1*current*pattern, 'LI Demod 1 Y (A)': 0.05*current*pattern,
+                 'LI Demod 2 X (A)': 0.02*current, 'LI Demod 2 Y (A)': 0.01*current,
+                 'Counter 1 (Hz)': 1e4*np.abs(bias)*pattern, 'Counter 2 (Hz)': 1e3*np.abs(bias),
+                 'Amplitude (m)': np.full(x.shape, 50e-12), 'Temperature 1 (K)': np.full(x.shape, 4.3)}
+        values = np.empty((len(idxs),) + x.shape, np.float32)
+        for row, idx in enumerate(idxs):
+            if not 0 <= idx < len(self.signal_names):
+                raise sim_error(f'Signal index {idx} out of range.')
+            values[row] = model.get(self.signal_names[idx], 0.)
+            if self.noise:
+                values[row] += self.noise*self.noise_scales[idx]*self.rng.standard_normal(x.shape)
+        return values
+
+    def signals_now(self, idxs):
+        now = time.perf_counter()
+        x, y = self.position(now)
+        return self.signals_eval(idxs, x, y, self.bias_at(now))
+
+    def history_trim(self, t):
+        '''drop the path and bias points before t that are no longer needed by the tip recorder'''
+        for times, *values in ((self.path_t, self.path_x, self.path_y), (self.bias_t, self.bias_v)):
+            start = max(int(np.searchsorted(times, t, side = 'right')) - 1, 0)
+            if start:
+                for points in (times, *values):
+                    del points[:start]
+
+    def scan_update(self):
+        '''end the scan once lines x line_time of scanning have passed'''
+        if self.scan_running and not self.scan_paused:
+            now = time.perf_counter()
+            self.scan_elapsed += now - self.scan_since
+            self.scan_since = now
+            if self.scan_elapsed >= self.lines*self.line_time:
+                self.scan_running, self.scan_done_lines = False, self.lines
+                self.scan_changed.notify_all()
+
+    ############################### commands ##################################
+    def session_path_get(self):
+        return len(self.session_path), self.session_path
+
+    def version_get(self):
+        product, version = 'Nanonis SPM Control Software (simulator)', str(self.version)
+        return len(product), product, len(version), version, self.version, self.version
+
+    def signals_names_get(self):
+        return str_array_size(self.signal_names), len(self.signal_names), self.signal_names
+
+    def signals_in_slots_get(self):
+        names = self.signal_names[:24]
+        return str_array_size(names), len(names), names, len(names), np.arange(len(names))
+
+    def signal_val_get(self, signal_idx, wait_for_new):
+        return (float(self.signals_now([int(signal_idx)])[0]),)
+
+    def signals_vals_get(self, num_signals, signal_idxs, wait_for_new):
+        values = self.signals_now([int(idx) for idx in np.atleast_1d(signal_idxs)])
+        return len(values), values
+
+    def current_get(self):
+        return (float(self.signals_now([self.signal_names.index('Current (A)')])[0]),)
+
+    def bias_set(self, bias):
+        now = time.perf_counter()
+        self.bias_t.append(now)
+        self.bias_v.append(float(bias))
+
+    def bias_get(self):
+        return (self.bias_v[-1],)
+
+    def z_pos_set(self, z_pos):
+        self.z = float(z_pos)
+
+    def z_pos_get(self):
+        if self.z_ctrl:
+            return (float(self.topography(*self.position(time.perf_counter()))),)
+        return (self.z,)
+
+    def z_ctrl_set(self, status):
+        if self.z_ctrl and not status: # hold the Z position of the tip
+            self.z = self.z_pos_get()[0]
+        self.z_ctrl = int(status)
+
+    def z_ctrl_get(self):
+        return (self.z_ctrl,)
+
+    def kelvin_ctrl_set(self, status):
+        self.kelvin_ctrl = int(status)
+
+    def kelvin_ctrl_get(self):
+        return (self.kelvin_ctrl,)
+
+    def scan_frame_set(self, *frame):
+        self.frame = [float(value) for value in frame]
+
+    def scan_frame_get(self):
+        return tuple(self.frame)
+
+    def scan_buffer_set(self, num_chs, ch_idx, pixels, lines):
+        channels = [int(idx) for idx in np.atleast_1d(ch_idx)][:int(num_chs)]
+        for idx in channels:
+            if not 0 <= idx < len(self.signal_names):
+                raise sim_error(f'Signal index {idx} out of range.')
+        self.buffer_channels, self.pixels, self.lines = channels, int(pixels), int(lines)
+
+    def scan_buffer_get(self):
+        return len(self.buffer_channels), np.array(self.buffer_channels), self.pixels, self.lines
+
+    def scan_action(self, action, direction):
+        self.scan_update()
+        now = time.perf_counter()
+        if action == 0:   # start
+            self.scan_running, self.scan_paused = True, False
+            self.scan_elapsed, self.scan_since, self.scan_dir = 0., now, int(direction)
+        elif action == 1: # stop
+            if self.scan_running:
+                self.scan_done_lines = int(self.scan_elapsed/self.line_time)
+            self.scan_running = False
+        elif action == 2: # pause
+            self.scan_paused = self.scan_running
+        elif action == 3: # resume
+            if self.scan_paused:
+                self.scan_paused, self.scan_since = False, now
+        else:
+            raise sim_error(f'Unknown scan action {action}.')
+        self.scan_changed.notify_all()
+
+    def scan_status_get(self):
+        self.scan_update()
+        return (int(self.scan_running),)
+
+    def scan_wait_end(self, timeout):
+        deadline = None if timeout < 0 else time.perf_counter() + timeout/1000
+        while True:
+            self.scan_update()
+            if not self.scan_running:
+                return 0, 0, ''
+            wait = None if self.scan_paused else self.lines*self.line_time - self.scan_elapsed
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return 1, 0, ''
+                wait = remaining if wait is None else min(wait, remaining)
+            self.scan_changed.wait(wait)
+
+    def scan_frame_data_grab(self, ch_idx, data_dir):
+        if ch_idx not in self.buffer_channels:
+            raise sim_error(f'Channel {ch_idx} is not in the scan buffer.')
+        self.scan_update()
+        cx, cy, width, height, angle = self.frame
+        u = ((np.arange(self.pixels) + 0.5)/self.pixels - 0.5)*width
+        v = ((np.arange(self.lines) + 0.5)/self.lines - 0.5)*height
+        u, v = np.meshgrid(u, v)
+        angle = np.radians(angle)
+        x = cx + u*np.cos(angle) + v*np.sin(angle)
+        y = cy - u*np.sin(angle) + v*np.cos(angle)
+        data = self.signals_eval([int(ch_idx)], x, y, self.bias_v[-1])[0]
+        done = int(self.scan_elapsed/self.line_time) if self.scan_running else self.scan_done_lines
+        if done < self.lines: # lines not scanned yet
+            if self.scan_dir: # up: from the bottom line
+                data[:self.lines - done] = np.nan
+            else:
+                data[done:] = np.nan
+        name = self.signal_names[int(ch_idx)]
+        return len(name), name, self.lines, self.pixels, data, int(data_dir)
+
+    def folme_xy_pos_set(self, x, y, wait_end_of_move):
+        '''returns the time the connection is blocked for when waiting for the end of the move'''
+        now = time.perf_counter()
+        x0, y0 = self.position(now)
+        duration = float(np.hypot(x - x0, y - y0))/(self.speed if self.custom_speed else self.default_speed)
+        # a new move replaces the rest of the current one
+        end = int(np.searchsorted(self.path_t, now, side = 'right'))
+        for points in (self.path_t, self.path_x, self.path_y):
+            del points[end:]
+        self.path_t += [now, now + duration]
+        self.path_x += [float(x0), float(x)]
+        self.path_y += [float(y0), float(y)]
+        return sim_wait(duration if wait_end_of_move else 0.)
+
+    def folme_xy_pos_get(self, wait_for_new_data):
+        x, y = self.position(time.perf_counter())
+        return float(x), float(y)
+
+    def folme_speed_set(self, speed, custom_speed):
+        if speed <= 0:
+            raise sim_error('The Follow Me speed must be positive.')
+        self.speed, self.custom_speed = float(speed), int(custom_speed)
+
+    def folme_speed_get(self):
+        return self.speed, self.custom_speed
+
+    def folme_oversampl_set(self, oversampling):
+        self.oversampling = max(int(oversampling), 1)
+
+    def folme_oversampl_get(self):
+        return self.oversampling, self.sample_rate/self.oversampling
+
+    def tiprec_buffer_size_set(self, buffer_size):
+        self.tiprec_size = max(int(buffer_size), 1)
+
+    def tiprec_buffer_size_get(self):
+        return (self.tiprec_size,)
+
+    def tiprec_buffer_clear(self):
+        self.tiprec_t0 = time.perf_counter()
+        self.history_trim(self.tiprec_t0)
+
+    def tiprec_data_get(self):
+        '''the newest tiprec_size samples since the last clear, one row per channel of the scan buffer'''
+        rate = self.sample_rate/self.oversampling
+        recorded = int((time.perf_counter() - self.tiprec_t0)*rate)
+        t = self.tiprec_t0 + np.arange(max(recorded - self.tiprec_size, 0), recorded)/rate
+        x, y = self.position(t)
+        data = self.signals_eval(self.buffer_channels, x, y, self.bias_at(t))
+        channels = np.array(self.buffer_channels)
+        return len(channels), channels, len(channels), data.shape[1], data
+
+class sim_wait:
+    '''reply of a command that keeps the connection busy for duration seconds (no reply arguments)'''
+    def __init__(self, duration):
+        self.duration = duration
+
+############################### server ########################################
+class sim_connection(socketserver.StreamRequestHandler):
+    '''one client: requests are processed in order, replies delivered after latency and bandwidth delays'''
+    def handle(self):
+        sim = self.server.sim
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = None
+        if sim.latency or sim.bandwidth:
+            replies = queue.Queue()
+            sender = threading.Thread(target = self.replies_send, args = (replies,), daemon = True)
+            sender.start()
+        t_in = 0. # time the last request finished arriving
+        try:
+            while True:
+                header = self.rfile.read(tcp_codec.HEADER_SIZE)
+                if len(header) < tcp_codec.HEADER_SIZE:
+                    break
+                body_size, res, _ = tcp_codec.size_flag_struct.unpack_from(header, 32)
+                body = self.rfile.read(body_size)
+                if sim.bandwidth: # requests arrive one after the other over the link
+                    t_in = max(t_in, time.perf_counter()) + (len(header) + len(body))/sim.bandwidth
+                    sim.sleep_until(t_in)
+
+                reply = sim.command_run(header + body)
+                if not res:
+                    continue
+                if replies is None:
+                    self.request.sendall(reply)
+                else:
+                    replies.put((time.perf_counter() + sim.latency, reply))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if replies is not None:
+                replies.put(None)
+
+    def replies_send(self, replies):
+        sim = self.server.sim
+        t_out = 0. # time the link is free for the next reply
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            due, reply = item
+            if sim.bandwidth:
+                due = t_out = max(due, t_out) + len(reply)/sim.bandwidth
+            sim.sleep_until(due)
+            try:
+                self.request.sendall(reply)
+            except OSError:
+                return
+
+class sim_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class nanonis_sim:
+    def __init__(self, TCP_IP = '127.0.0.1', ports = (6501, 6502, 6503, 6504), latency = 0., bandwidth = None,
+                 start = True, **instrument_kwargs):
+        """
+       Parameters
+       TCP_IP          : IP address to listen on
+       ports           : TCP ports to serve, all on the same instrument state (0: any free port, see self.ports)
+       latency         : time (s) between a request arriving and its reply leaving
+       bandwidth       : bytes/s in each direction, None for no limit
+       start           : start serving right away (otherwise call start())
+       instrument_kwargs: passed to sim_instrument (session_path, signals, noise, move_speed, line_time, version, seed)
+       """
+        self.TCP_IP = TCP_IP
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.instrument = sim_instrument(**instrument_kwargs)
+        self.command_counts = Counter() # requests received per command
+        self.wait_time = 0.             # s the connections were blocked by commands waiting for the instrument (moves)
+        self.servers, self.threads = [], []
+        for port in ports:
+            server = sim_server((TCP_IP, port), sim_connection)
+            server.sim = self
+            self.servers.append(server)
+        self.ports = [server.server_address[1] for server in self.servers]
+        if start:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target = server.serve_forever, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for server in self.servers:
+            if self.threads:
+                server.shutdown()
+            server.server_close()
+        self.threads = []
+
+    @staticmethod
+    def sleep_until(t):
+        delay = t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def command_run(self, message):
+        '''process one request message and return the reply message'''
+        command_name = tcp_codec.decode_header(message)[0]
+        self.command_counts[command_name] += 1
+        command = self.instrument.commands.get(command_name)
+        reply_fmt, reply_args, wait = (), (), 0.
+        err_status, err_description = 0, ''
+        try:
+            if command is None:
+                raise sim_error(f'{command_name} is not supported by the Nanonis simulator.')
+            request_fmt, reply_fmt, method = command
+            args = tcp_codec.decode_args(tcp_codec.compile_plan(request_fmt), message)[0] if request_fmt else []
+            with self.instrument.lock:
+                reply_args = getattr(self.instrument, method)(*args)
+            if isinstance(reply_args, sim_wait):
+                wait, reply_args = reply_args.duration, ()
+            body = body_encode(reply_fmt, reply_args or ())
+        except (sim_error, st.error, TypeError, ValueError) as e:
+            err_status, err_description = 1, str(e)
+            # empty arguments, as Nanonis does on errors
+            body = body_encode(reply_fmt, [0 if arg_fmt in tcp_codec.scalar_codes else '' if arg_fmt == 'str' else []
+                                           for arg_fmt in reply_fmt])
+        if wait: # e.g. FolMe.XYPosSet waiting for the end of the move
+            self.wait_time += wait
+            time.sleep(wait)
+
+        err = err_description.encode('iso-8859-1')
+        body += tcp_codec.error_struct.pack(err_status, len(err)) + err
+        return tcp_codec.header_encode(command_name, len(body), res = False) + body
+
+    def serve_forever(self):
+        print(f'Nanonis simulator listening on {self.TCP_IP}, ports {self.ports}. Session path: {self.instrument.session_path}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+if __name__ == '__main__':
+    nanonis_sim().serve_forever()
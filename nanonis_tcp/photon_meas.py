@@ -13,38 +13,79 @@ import threading
 from datetime import datetime
 import sys
 import math
-from scipy.ndimage import median_filter
-from scipy.signal import savgol_filter
-import requests
 from queue import Queue
+from contextlib import nullcontext
 from io import StringIO  # Import StringIO for in-memory text handling
-from .log_utils import apply_logging, init_logger
-from scipy.interpolate import interp1d
+from .log_utils import apply_logging, init_logger_deferred
+from .tcp_batch import resolved
+from .andor_meas import andor_meas
+from .tcp_andor_ctrl import tcp_andor_ctrl
+from . import andor_http
+from . import cosmic_rays
+from .signal_stats import signal_stats
+from .signal_streamer import signal_streamer
+from . import nanonis_files
 
 @apply_logging
 class photon_meas:
-    def __init__(self, connect,connect2=None, connect3=None, logging=True,dig_port=2 ): #connect2 = andor 
+    def __init__(self, connect,connect2=None, connect3=None, logging=True,dig_port=2, pool=None ): #connect2 = andor 
         self.connect = connect
         self.connect2=connect2
         self.connect3=connect3
+        self.pool = pool # tcp_pool on the Nanonis ports not used by connect/connect3: worker threads check out connections of their own
         self.logging_enabled = logging
         self.dig_port = dig_port #digital port on nanonis RT controller receiving fire from CCD for photon_map_k A-0,B-1,C-2,D-3
-        try:
-            session_path = self.connect.UtilSessionPathGet().loc['Session path', 0]
-            init_logger(session_path)
-        except Exception as e:
-            print(f"Failed to initialize logger: {e}")
-        
-        if connect2 is not None:
-            try:
-                self.andor_settings=self.connect2.settings_get()
-            except:
-                self.andor_settings=None
-        self.signal_names = self.connect.SignalsNamesGet() 
+        init_logger_deferred(self._session_path) # the logger starts with the first call
+        # andor_settings and signal_names are asked for on first use (see the properties below), so that
+        # creating photon_meas does not wait for Nanonis and the Andor server
+        self._andor_settings = self._signal_names = None
+        self._andor_settings_read = False
         # Initialize URL placeholders
         self.url_cal = None
         self.kinser_dat = None
+        self._andor_data = None # second Andor connection for the kinetic series data, see andor_data_connection
+        self._http = None # keep-alive HTTP session to the Andor server, see http_session
+        self._cal = {} # calibrations read, per (centre wavelength, grating) set through connect2, see get_cal
+        self.kinser_stream = None # andor_http.kinser_stream of the running photon_map_k, spectra read while acquired
+        self.signal_stats = None # signal_stats of the signals polled during the last exposure (spectrum, spectrum_list, photon_map)
         return
+
+    def _session_path(self):
+        return self.connect.UtilSessionPathGet().loc['Session path', 0]
+
+    @property
+    def andor_settings(self):
+        if not self._andor_settings_read:
+            self._andor_settings_read = True
+            if self.connect2 is not None:
+                try:
+                    self._andor_settings=self.connect2.settings_get()
+                except:
+                    self._andor_settings=None
+        return self._andor_settings
+
+    @andor_settings.setter
+    def andor_settings(self, settings):
+        self._andor_settings, self._andor_settings_read = settings, True
+
+    @property
+    def signal_names(self):
+        if self._signal_names is None: # the signal registry of the controller, unless set
+            return self.connect.signals.names_df
+        return self._signal_names
+
+    @signal_names.setter
+    def signal_names(self, names):
+        self._signal_names = names
+    def worker_connect(self, connect=None):
+        """
+        Nanonis connection for a worker thread, to be used in a with statement:
+        a pooled connection of its own if photon_meas was given a pool, otherwise connect (default self.connect).
+        """
+        if self.pool is not None:
+            return self.pool.checkout()
+        return nullcontext(self.connect if connect is None else connect)
+
     def clear_line(self):
         sys.stdout.write("\033[K") 
         sys.stdout.flush()
@@ -76,6 +117,40 @@ class photon_meas:
             f.seek(0)
             f.write(end_time_str)
     
+    def sxm_scan_par(self, filename_sxm, frame, pix, acqtime, direction, bias=None, acq_time="0.0"):
+        """scan parameters of the .sxm header of a map, frame: (cx, cy, dim (nm), angle)"""
+        cx, cy, dim, angle = frame
+        scan_par = {
+            "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
+            "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
+            "ACQ_TIME": acq_time,
+            "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
+            "SCAN_FILE": filename_sxm,
+            "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
+            "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
+            "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
+            "SCAN_ANGLE": str(angle),
+            "SCAN_DIR": direction
+            }
+        if bias is not None:
+            scan_par["BIAS"] = str(bias)
+        return scan_par
+
+    def sxm_channels(self, nanonis_names, andor_names=()):
+        """rows of DATA_INFO: the nanonis signals (averaged) from 1, the andor wavelengths from 128"""
+        channels = []
+        for i, signal in enumerate(nanonis_names, start=1):
+            base_name, unit = signal.split(' (')
+            channels.append([i, f'{base_name}_avg.', unit.strip(')'), 'both', '1.000E+0', '0.000E+0'])
+        for i, wavelength in enumerate(andor_names, start=128):
+            channels.append([i, wavelength, 'nm', 'both', '1.000E+0', '0.000E+0'])
+        return channels
+
+    def sxm_open(self, filename_sxm, frame, pix, acqtime, signal_names, direction, bias, backward=False):
+        """.sxm file of a map filled a line at a time (nanonis_files.sxm_writer), the header is written now"""
+        scan_par = self.sxm_scan_par(filename_sxm, frame, pix, acqtime, direction, bias)
+        return nanonis_files.sxm_writer(filename_sxm, pix, scan_par, self.sxm_channels(signal_names), backward=backward)
+    
     def cr_remove(self,spectra, filter_size=3, offset=300):
         """
         Identify and remove cosmic ray outliers from spectral data and average the acquisitions.
@@ -88,6 +163,7 @@ class photon_meas:
         Returns:
         - cleaned_average: 1D NumPy array of the averaged spectra after removing outliers
         """
+        from scipy.ndimage import median_filter # scipy and requests are imported on first use, they take seconds to import
         
         # Ensure spectra is 2D: If it's 1D, reshape to (1, 1024)
         if spectra.ndim == 1:
@@ -510,7 +586,24 @@ class photon_meas:
             Vz_nm=df.values[3][0]*1e9+dVz_nm
             
         self.connect.PiezoDriftCompSet(compensation,Vx_nm*1e-9,Vy_nm*1e-9,Vz_nm*1e-9,10)
-        
+
+    def frame_data_grab(self, channels):
+        """
+        Grab the forward and backward scan frame of every channel in one batch
+        (2 x len(channels) ScanFrameDataGrab calls in about one round trip).
+
+        Returns
+        -------
+        tuple
+            Lists of 2D NumPy arrays with the forward and the backward data, in the order of channels.
+        """
+        with self.connect.raw(), self.connect.batch() as b:
+            grabs = [(b.ScanFrameDataGrab(channel, 0), b.ScanFrameDataGrab(channel, 1)) for channel in channels]
+        # raw replies: the scan data stays big-endian float32 as received, writesxm writes it without conversion
+        data_fw = [fw.result()[4] for fw, _ in grabs]
+        data_bw = [bw.result()[4] for _, bw in grabs]
+        return data_fw, data_bw
+
     def scan(self, direction="up", wait=True):
         """
         Perform a scan in the specified direction and wait until completion or interruption.
@@ -559,9 +652,9 @@ class photon_meas:
         
         try:
             while wait:
-                df = self.connect.ScanWaitEndOfScan(1)
+                timeout_status = self.connect.raw().ScanWaitEndOfScan(1)[0]
                 # Process the current iteration
-                if float(df.loc['Timeout status', 0]) == 0:
+                if timeout_status == 0:
                     wait = False
                 
         except KeyboardInterrupt:
@@ -570,10 +663,7 @@ class photon_meas:
             print("Iteration finished. Exiting gracefully.")
         finally:
             channels = self.connect.ScanBufferGet().iloc[1, 0]
-            data_fw, data_bw = [], []
-            for channel in channels:
-                data_fw.append(self.connect.ScanFrameDataGrab(channel, 0)[0].to_numpy())
-                data_bw.append(self.connect.ScanFrameDataGrab(channel, 1)[0].to_numpy())
+            data_fw, data_bw = self.frame_data_grab(channels)
         
         return np.stack(data_fw), np.stack(data_bw), channels
     
@@ -601,10 +691,7 @@ class photon_meas:
         self.connect.ScanAction(2, 0)
         self.connect.ScanFrameGet()
         channels = self.connect.ScanBufferGet().iloc[1, 0]
-        data_fw, data_bw = [], []
-        for channel in channels:
-            data_fw.append(self.connect.ScanFrameDataGrab(channel, 0)[0].to_numpy())
-            data_bw.append(self.connect.ScanFrameDataGrab(channel, 1)[0].to_numpy())
+        data_fw, data_bw = self.frame_data_grab(channels)
         
         return np.stack(data_fw), np.stack(data_bw), channels
     
@@ -632,9 +719,9 @@ class photon_meas:
         wait=True
         try:
             while wait:
-                df = self.connect.ScanWaitEndOfScan(1)
+                timeout_status = self.connect.raw().ScanWaitEndOfScan(1)[0]
                 # Process the current iteration
-                if float(df.loc['Timeout status', 0]) == 0:
+                if timeout_status == 0:
                     wait = False
                 
         except KeyboardInterrupt:
@@ -643,10 +730,7 @@ class photon_meas:
             print("Iteration finished. Exiting gracefully.")
         finally:
             channels = self.connect.ScanBufferGet().iloc[1, 0]
-            data_fw, data_bw = [], []
-            for channel in channels:
-                data_fw.append(self.connect.ScanFrameDataGrab(channel, 0)[0].to_numpy())
-                data_bw.append(self.connect.ScanFrameDataGrab(channel, 1)[0].to_numpy())
+            data_fw, data_bw = self.frame_data_grab(channels)
         
         return np.stack(data_fw), np.stack(data_bw), channels
     
@@ -676,10 +760,7 @@ class photon_meas:
         self.connect.ScanAction(1, 0)
         self.connect.ScanFrameGet()
         channels = self.connect.ScanBufferGet().iloc[1, 0]
-        data_fw, data_bw = [], []
-        for channel in channels:
-            data_fw.append(self.connect.ScanFrameDataGrab(channel, 0)[0].to_numpy())
-            data_bw.append(self.connect.ScanFrameDataGrab(channel, 1)[0].to_numpy())
+        data_fw, data_bw = self.frame_data_grab(channels)
         
         return np.stack(data_fw), np.stack(data_bw), channels
     
@@ -741,9 +822,9 @@ class photon_meas:
                 self.connect.ScanAction(0, direction)
                 wait=True
                 while wait:
-                    df = self.connect.ScanWaitEndOfScan(1)
+                    timeout_status = self.connect.raw().ScanWaitEndOfScan(1)[0]
                     # Process the current iteration
-                    if float(df.loc['Timeout status', 0]) == 0:
+                    if timeout_status == 0:
                         wait = False
                 
         except KeyboardInterrupt:
@@ -754,10 +835,7 @@ class photon_meas:
             if return_to_start==True:
                 self.dz(-z_range)
             channels = self.connect.ScanBufferGet().iloc[1, 0]
-            data_fw, data_bw = [], []
-            for channel in channels:
-                data_fw.append(self.connect.ScanFrameDataGrab(channel, 0)[0].to_numpy())
-                data_bw.append(self.connect.ScanFrameDataGrab(channel, 1)[0].to_numpy())
+            data_fw, data_bw = self.frame_data_grab(channels)
         
         return np.stack(data_fw), np.stack(data_bw), channels
     
@@ -808,40 +886,38 @@ class photon_meas:
             
         return(data)
 
-    def acquire_data_from_connect(self, signal_values, acquisition_complete, stop_time,signal_range):
-        start_time = time.time()
-        while not acquisition_complete.is_set() and (time.time() - start_time) < stop_time:
-            # Collect signal values from the connect device
-            signal_values.append(self.connect.SignalsValsGet(np.arange(0, signal_range, 1), 1))
-            # Sleep briefly to avoid busy-waiting
-           # time.sleep(0.1)
+    def signals_poll(self, indexes, callback, until=None, duration=None, rate=None, wait=1, connect=None):
+        """
+        Sample the signals indexes (signal_streamer) until the event until is set or duration (s) has
+        passed, as fast as possible or at rate (samples/s): callback(values, t) for every sample.
+        Runs in the calling thread, on a connection of its own (worker_connect). Returns the streamer
+        (rate_achieved, dropped).
+        """
+        with self.worker_connect(connect) as connect:
+            streamer = signal_streamer(connect, indexes, rate=rate, size=1, wait=wait)
+            streamer.subscribe(callback)
+            streamer.run(until=until, duration=duration)
+        return streamer
+
+    def acquire_data_from_connect(self, stats, acquisition_complete, stop_time,signal_range):
+        # Add signal values from the connect device to the running statistics
+        self.signals_poll(np.arange(0, signal_range, 1), stats.add, until=acquisition_complete, duration=stop_time)
         # Signal that acquisition is complete
         acquisition_complete.set()
         
-    def acquire_data_from_connect_relevant(self, signal_values, acquisition_complete, stop_time,relevant_indices):
-        start_time = time.time()
-        while not acquisition_complete.is_set() and (time.time() - start_time) < stop_time:
-            # Collect signal values from the connect device
-            signal_values.append(self.connect.SignalsValsGet(relevant_indices, 1))
-            # Sleep briefly to avoid busy-waiting
-           # time.sleep(0.1)
+    def acquire_data_from_connect_relevant(self, stats, acquisition_complete, stop_time,relevant_indices):
+        # Add signal values from the connect device to the running statistics
+        self.signals_poll(relevant_indices, stats.add, until=acquisition_complete, duration=stop_time)
         # Signal that acquisition is complete
         acquisition_complete.set()
         
     def acquire_data_from_connect_relevant_2(self, signal_values,acquisition_complete, relevant_indices):
-        while not acquisition_complete.is_set():
-            # Collect signal values from the connect device
-            signal_values.append(self.connect2.SignalsValsGet(relevant_indices,0))
-           # time.sleep(0.1)  # Adjust sampling frequency as desired
+        # Collect signal values from the connect device
+        self.signals_poll(relevant_indices, lambda values, t: signal_values.append(values), until=acquisition_complete, wait=0, connect=self.connect2)
         
     def acquire_data_from_connect_new(self, signal_values, acquisition_complete, stop_time,signal_range):
-        start_time = time.time()
-        while not acquisition_complete.is_set() and (time.time() - start_time) < stop_time:
-            # Collect signal values from the connect device
-            val=(self.connect.SignalsValsGet(np.arange(0, signal_range, 1), 1)).iloc[:,1].to_numpy() # extract 2nd column and convert to np array
-            signal_values.append(val)
-            # Sleep briefly to avoid busy-waiting
-            #time.sleep(0.1)
+        # Collect signal values from the connect device as np arrays
+        self.signals_poll(np.arange(0, signal_range, 1), lambda values, t: signal_values.append(values.astype(float)), until=acquisition_complete, duration=stop_time)
         # Signal that acquisition is complete
         acquisition_complete.set()
 
@@ -870,6 +946,13 @@ class photon_meas:
         valid_signal_names = set(signal_names_df['Signal names'])
         signal_col = signal_names_df['Signal names']
 
+        if isinstance(list_of_dfs, signal_stats): # running statistics of all signals (acquire_data_from_connect)
+            means = {}
+            for signal, mean in zip(signal_col, list_of_dfs.mean):
+                means.setdefault(signal, mean)
+            return {signal: None if np.isnan(means[signal]) else means[signal]
+                    for signal in signal_names if signal in valid_signal_names}
+
         # Create a mask for valid signal names (this mask is based on the set of valid signal names)
         valid_signal_mask = lambda signal_col: signal_col.isin(valid_signal_names)
 
@@ -1043,13 +1126,12 @@ class photon_meas:
         if 'Signal names' not in signal_names_df.columns:
             raise ValueError("The DataFrame must contain a 'Signal names' column.")
     
-        # Extract relevant indices for the signals to acquire
-        relevant_indices = [
-        int(signal_names_df[signal_names_df['Signal names'] == name].index[0])
-        for name in signal_names_for_save if name in signal_names_df['Signal names'].values
-        ]
-
-        matching_signals = [name for name in signal_names_for_save if name in signal_names_df['Signal names'].values]
+        # Extract relevant indices for the signals to acquire: name -> index (first one for duplicates)
+        name_index = {}
+        for idx, name in zip(signal_names_df.index, signal_names_df['Signal names']):
+            name_index.setdefault(name, int(idx))
+        matching_signals = [name for name in signal_names_for_save if name in name_index]
+        relevant_indices = [name_index[name] for name in matching_signals]
         return relevant_indices, matching_signals
 
 
@@ -1061,7 +1143,7 @@ class photon_meas:
         settings=self.connect2.settings_get()
         signal_names_df=self.signal_names 
 
-        sigvals = []
+        sigvals = self.signal_stats = signal_stats(len(signal_names_df), signal_names_df['Signal names']) # all acquisitions
         data_dict = {}
         try:
             for i in range(int(acqnum)):
@@ -1078,8 +1160,7 @@ class photon_meas:
                 acquire_thread2.start()
                 
                 # Start a thread to acquire data from connect with a time limit
-                signal_values = []
-                acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect, args=(signal_values, acquisition_complete_connect, acqtime,len(signal_names_df))) 
+                acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect, args=(sigvals, acquisition_complete_connect, acqtime,len(signal_names_df))) 
                 acquire_thread_connect.start()
                 
                 # Wait for the acquisition to complete on connect2
@@ -1089,9 +1170,6 @@ class photon_meas:
                 acquire_thread_connect.join()
                 acquire_thread2.join()
                 
-                # Process the acquired signal values
-                sigvals.append(signal_values)
-                
                 # Update the DataFrame with new data from connect2
                 data_new = data_storage['data']
                 if i == 0:
@@ -1272,7 +1350,7 @@ class photon_meas:
                 acquire_thread2.start()
                 
                 # Start a thread to acquire data from connect with a time limit
-                signal_values = []
+                signal_values = self.signal_stats = signal_stats(len(relevant_indices), matching_signals)
                 acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect_relevant, args=(signal_values, acquisition_complete_connect, acqtime,relevant_indices)) 
                 acquire_thread_connect.start()
                 
@@ -1284,7 +1362,7 @@ class photon_meas:
                 acquire_thread2.join()
                 
                 # Process the acquired signal values
-                nanonis_array[i,:]=np.nanmean(np.stack([df.iloc[:, 1].values for df in signal_values]), axis=0)
+                nanonis_array[i,:]=signal_values.mean
                 #del signal_values
                 # Update the DataFrame with new data from connect2
                 data_new = data_storage['data']
@@ -1396,35 +1474,19 @@ class photon_meas:
         filename_3ds = self.connect.get_next_filename("G"+name, extension='.3ds', folder=folder)
     
         bias_voltage = self.connect.BiasGet().iloc[0, 0]  # Bias (V) as float
-        grid_settings = np.array([cx,cy,1e-9*dim[0],1e-9*dim[1],angle])  # Grid settings as np.array
+        grid_settings = [cx,cy,1e-9*dim[0],1e-9*dim[1],angle]  # Grid settings
         sweep_signal = "Wavelength (nm)"  # Sweep signal as string
         count_write=0
         
-        # Prepare the header
-        start_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-        header = f'''End time="{start_time}"
-Start time="{start_time}"
-Delay before measuring (s)=0
-Comment=
-Bias (V)={bias_voltage:.6E}
-Experiment=Experiment
-Date="{start_time.split()[0]}"
-User=
-Grid dim="{pix[0]} x {pix[1]}"
-Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
-
-'''
         if backward==False:
             col_lst=list(range(pix[0]))
             bw_fact=1
         else:
             col_lst=list(range(pix[0])) + list(range(pix[0]-1, -1, -1))
             filename_3ds_bw = self.connect.get_next_filename("G"+name+'_bw', extension='.3ds', folder=folder)
-            f_bw = open(filename_3ds_bw, 'wb')
-            f_bw.write(header.encode())
+            grid_bw = nanonis_files.grid3ds_writer(filename_3ds_bw, pix, grid_settings, bias_voltage)
             bw_fact=2
-        f = open(filename_3ds, 'wb')
-        f.write(header.encode())
+        grid = nanonis_files.grid3ds_writer(filename_3ds, pix, grid_settings, bias_voltage)
         try:
             for row in range(pix[1]):
                 for index, column in enumerate(col_lst):
@@ -1457,7 +1519,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         acquire_thread2.start()
                         
                         # Start a thread to acquire data from connect with a time limit
-                        signal_values = []
+                        signal_values = signal_stats(len(signal_names_df))
                         acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect, args=(signal_values, acquisition_complete_connect, acqtime, len(signal_names_df)))
                         acquire_thread_connect.start()
                         
@@ -1473,7 +1535,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         # Process the acquired signal values
              #           sigvals.append(signal_values)
 
-                        nanonis_array[i,:]=np.mean(np.stack([df.iloc[:, 1].values for df in signal_values]), axis=0)
+                        nanonis_array[i,:]=signal_values.mean
                         del signal_values
                         
                         # Update the DataFrame with new data from connect2
@@ -1543,12 +1605,12 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         # Write all data to a file in one go
                         with open(filename, 'w') as f_text:
                             # Write the formatted DataFrame
-                            combined_df.to_csv(f, sep='\t', header=False, index=False, lineterminator="\n")
-                            settings_df.to_csv(f, sep='\t', header=False, index=False, lineterminator="\n")  # Write additional settings
+                            combined_df.to_csv(f_text, sep='\t', header=False, index=False, lineterminator="\n")
+                            settings_df.to_csv(f_text, sep='\t', header=False, index=False, lineterminator="\n")  # Write additional settings
                             
                             # Write section header and additional data
                             f_text.write("\n[DATA]\n")
-                            data.to_csv(f, sep='\t', header=True, index=False, lineterminator="\n")
+                            data.to_csv(f_text, sep='\t', header=True, index=False, lineterminator="\n")
                     else:
                         pass
                     
@@ -1571,33 +1633,19 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                     if row==0 and index==0:
                         fixed_parameters = ["Sweep Start", "Sweep End"]+sigvals_df['Signal names'].tolist()
                             #print(fixed_parameters)
-                        header2=f'''Sweep Signal="{sweep_signal}"
-Fixed parameters="{';'.join(fixed_parameters)}"
-Experiment parameters=
-# Parameters (4 byte)={len(fixed_parameters)}
-Experiment size (bytes)=4096
-Points={num_pixels}
-Channels=Counts
-'''
-                        f.write(header2.encode())
                         andor_chan_names= data.iloc[:, 0].values.tolist()
                         chnames = [f"wl {i}=" + str(item) for i, item in enumerate(andor_chan_names)]
-                        f.write(('\n'.join(chnames)+"\n").encode())
-                        f.write((':HEADER_END:\n').encode())
+                        grid.experiment(fixed_parameters, num_pixels, sweep_signal, extra=chnames)
                     if backward==True and row==0 and index==pix[0]:
-                        f_bw.write(header2.encode())
-                        f_bw.write(('\n'.join(chnames)+"\n").encode())
-                        f_bw.write((':HEADER_END:\n').encode())
+                        grid_bw.experiment(fixed_parameters, num_pixels, sweep_signal, extra=chnames)
                     res_list=[float(andor_chan_names[0]),float(andor_chan_names[-1])]+matching_signals
                  #   print(res_list)
                     swrite=time.perf_counter()
                     # write only forward scan
                     if index<pix[0]: 
-                        np.array(res_list).astype(">f4").tofile(f)
-                        row_average.astype(">f4").tofile(f)
+                        grid.write_line([res_list], row_average)
                     else:
-                        np.array(res_list).astype(">f4").tofile(f_bw)
-                        row_average.astype(">f4").tofile(f_bw)
+                        grid_bw.write_line([res_list], row_average)
                     
                     #timing and print in terminal remaining time
                     elapsed = time.perf_counter() - start_time_scan
@@ -1613,28 +1661,17 @@ Channels=Counts
                 sigval_ar.append([np.NaN] * num_signals)
                 data_ar.append(np.full(num_pixels, np.NaN))
         finally:
-            f.close()
+            grid.close()
             if backward==True:
-                f_bw.close()
+                grid_bw.close()
             end_time_scan = time.perf_counter()
             elapsed_time_scan="{:.1f}".format(end_time_scan-start_time_scan)
             filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
             
             nanonis_const= dict(zip(combined_df.T.iloc[0], combined_df.T.iloc[1].astype(str)))
             settings_dict=(dict(zip(settings.T.iloc[0], settings.T.iloc[1].astype(str))))
-            scan_par = {
-                "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
-                "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
-                "ACQ_TIME": str(elapsed_time_scan),
-                "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
-                "SCAN_FILE": filename_sxm,
-                "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
-                "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
-                "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
-                "SCAN_ANGLE": str(angle),
-                "SCAN_DIR": direction,
-                "BIAS": str(sigvals_df[sigvals_df['Column1'].isin(["Bias (V)"])]['Column2'].iloc[0])
-                }   
+            bias = sigvals_df[sigvals_df['Column1'].isin(["Bias (V)"])]['Column2'].iloc[0]
+            scan_par = self.sxm_scan_par(filename_sxm, (cx, cy, dim, angle), pix, acqtime, direction, bias, str(elapsed_time_scan))
             andor_chan_names= data.iloc[:, 0].values.tolist()
             nanonis_chan_names=sigvals_df['Signal names'].tolist()
             
@@ -1643,23 +1680,7 @@ Channels=Counts
             combined_data = np.concatenate((nanononis_data_to_sxm, andor_data_to_sxm), axis=0)
             del nanononis_data_to_sxm, andor_data_to_sxm #delete intermediate data
             
-                        # Define constants
-            scan_dir = 'both'
-            default_value1 = '1.000E+0'
-            default_value2 = '0.000E+0'
-            
-            # Initialize lists to store the final output
-            final_list = []
-            
-            # Process nanonis_chan_names
-            for i, name in enumerate(nanonis_chan_names, start=1):
-                base_name, unit = name.split(' (')
-                unit = unit.strip(')')
-                final_list.append([i, f'{base_name}_avg.', unit, scan_dir, default_value1, default_value2])
-            
-            # Process andor_chan_names starting from index 128
-            for i, name in enumerate(andor_chan_names, start=128):
-                final_list.append([i, name, 'nm', scan_dir, default_value1, default_value2])
+            final_list = self.sxm_channels(nanonis_chan_names, andor_chan_names)
 
             data_sxm=self.connect.writesxm(backward,filename_sxm, settings_dict, scan_par, final_list, combined_data)
             del combined_data
@@ -1713,35 +1734,19 @@ Channels=Counts
         filename_3ds = self.connect.get_next_filename("G"+name, extension='.3ds', folder=folder)
     
         bias_voltage = self.connect.BiasGet().iloc[0, 0]  # Bias (V) as float
-        grid_settings = np.array([cx,cy,1e-9*dim[0],1e-9*dim[1],angle])  # Grid settings as np.array
+        grid_settings = [cx,cy,1e-9*dim[0],1e-9*dim[1],angle]  # Grid settings
         sweep_signal = "Wavelength (nm)"  # Sweep signal as string
         count_write=0
         
-        # Prepare the header
-        start_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-        header = f'''End time="{start_time}"
-Start time="{start_time}"
-Delay before measuring (s)=0
-Comment=
-Bias (V)={bias_voltage:.6E}
-Experiment=Experiment
-Date="{start_time.split()[0]}"
-User=
-Grid dim="{pix[0]} x {pix[1]}"
-Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
-
-'''
         if backward==False:
             col_lst=list(range(pix[0]))
             bw_fact=1
         else:
             col_lst=list(range(pix[0])) + list(range(pix[0]-1, -1, -1))
             filename_3ds_bw = self.connect.get_next_filename("G"+name+'_bw', extension='.3ds', folder=folder)
-            f_bw = open(filename_3ds_bw, 'wb')
-            f_bw.write(header.encode())
+            grid_bw = nanonis_files.grid3ds_writer(filename_3ds_bw, pix, grid_settings, bias_voltage)
             bw_fact=2
-        f = open(filename_3ds, 'wb')
-        f.write(header.encode())
+        grid = nanonis_files.grid3ds_writer(filename_3ds, pix, grid_settings, bias_voltage)
         try:
             for row in range(pix[1]):
                 for index, column in enumerate(col_lst):
@@ -1756,7 +1761,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                     dx_rot, dy_rot = self.rotate(dx_nm, dy_nm, angle)
                     self.connect.FolMeXYPosSet(cx + dx_rot, cy + dy_rot, wait_num)  # Set new position
                     
-                    sigvals = []
+                    sigvals = self.signal_stats = signal_stats(len(signal_names_df), signal_names_df['Signal names']) # all acquisitions of the pixel
                     data_dict = {}
                     
                     for i in range(int(acqnum)):
@@ -1774,8 +1779,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         acquire_thread2.start()
                         
                         # Start a thread to acquire data from connect with a time limit
-                        signal_values = []
-                        acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect, args=(signal_values, acquisition_complete_connect, acqtime, len(signal_names_df)))
+                        acquire_thread_connect = threading.Thread(target=self.acquire_data_from_connect, args=(sigvals, acquisition_complete_connect, acqtime, len(signal_names_df)))
                         acquire_thread_connect.start()
                         
                         # Wait for the acquisition to complete on connect2
@@ -1787,9 +1791,6 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         
                         count_write+=time.perf_counter()-swrite # stop meas time
                         
-                        # Process the acquired signal values
-                        sigvals.append(signal_values)
-                        
                         # Update the DataFrame with new data from connect2
                         data_new = data_storage['data']
                         if i == 0:
@@ -1848,12 +1849,12 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         # Write all data to a file in one go
                         with open(filename, 'w') as f_text:
                             # Write the formatted DataFrame
-                            combined_df.to_csv(f, sep='\t', header=False, index=False, lineterminator="\n")
-                            settings_df.to_csv(f, sep='\t', header=False, index=False, lineterminator="\n")  # Write additional settings
+                            combined_df.to_csv(f_text, sep='\t', header=False, index=False, lineterminator="\n")
+                            settings_df.to_csv(f_text, sep='\t', header=False, index=False, lineterminator="\n")  # Write additional settings
                             
                             # Write section header and additional data
                             f_text.write("\n[DATA]\n")
-                            data.to_csv(f, sep='\t', header=True, index=False, lineterminator="\n")
+                            data.to_csv(f_text, sep='\t', header=True, index=False, lineterminator="\n")
                     else:
                         pass
                     
@@ -1876,33 +1877,19 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                     if row==0 and index==0:
                         fixed_parameters = ["Sweep Start", "Sweep End"]+filtered_sigvals_df['Column1'].tolist()
                             #print(fixed_parameters)
-                        header2=f'''Sweep Signal="{sweep_signal}"
-Fixed parameters="{';'.join(fixed_parameters)}"
-Experiment parameters=
-# Parameters (4 byte)={len(fixed_parameters)}
-Experiment size (bytes)=4096
-Points={num_pixels}
-Channels=Counts
-'''
-                        f.write(header2.encode())
                         andor_chan_names= data.iloc[:, 0].values.tolist()
                         chnames = [f"wl {i}=" + str(item) for i, item in enumerate(andor_chan_names)]
-                        f.write(('\n'.join(chnames)+"\n").encode())
-                        f.write((':HEADER_END:\n').encode())
+                        grid.experiment(fixed_parameters, num_pixels, sweep_signal, extra=chnames)
                     if backward==True and row==0 and index==pix[0]:
-                        f_bw.write(header2.encode())
-                        f_bw.write(('\n'.join(chnames)+"\n").encode())
-                        f_bw.write((':HEADER_END:\n').encode())
+                        grid_bw.experiment(fixed_parameters, num_pixels, sweep_signal, extra=chnames)
                     res_list=[float(andor_chan_names[0]),float(andor_chan_names[-1])]+filtered_sigvals_list
                  #   print(res_list)
                     swrite=time.perf_counter()
                     # write only forward scan
                     if index<pix[0]: 
-                        np.array(res_list).astype(">f4").tofile(f)
-                        row_average.astype(">f4").tofile(f)
+                        grid.write_line([res_list], row_average)
                     else:
-                        np.array(res_list).astype(">f4").tofile(f_bw)
-                        row_average.astype(">f4").tofile(f_bw)
+                        grid_bw.write_line([res_list], row_average)
                     
                     #timing and print in terminal remaining time
                     elapsed = time.perf_counter() - start_time_scan
@@ -1918,27 +1905,16 @@ Channels=Counts
                 sigval_ar.append([np.NaN] * num_signals)
                 data_ar.append(np.full(num_pixels, np.NaN))
         finally:
-            f.close()
+            grid.close()
             if backward==True:
-                f_bw.close()
+                grid_bw.close()
             end_time_scan = time.perf_counter()
             elapsed_time_scan="{:.1f}".format(end_time_scan-start_time_scan)
             filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
             
             settings_dict=(dict(zip(settings.T.iloc[0], settings.T.iloc[1].astype(str))))
-            scan_par = {
-                "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
-                "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
-                "ACQ_TIME": str(elapsed_time_scan),
-                "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
-                "SCAN_FILE": filename_sxm,
-                "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
-                "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
-                "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
-                "SCAN_ANGLE": str(angle),
-                "SCAN_DIR": direction,
-                "BIAS": str(sigvals_df[sigvals_df['Column1'].isin(["Bias (V)"])]['Column2'].iloc[0])
-                }   
+            bias = sigvals_df[sigvals_df['Column1'].isin(["Bias (V)"])]['Column2'].iloc[0]
+            scan_par = self.sxm_scan_par(filename_sxm, (cx, cy, dim, angle), pix, acqtime, direction, bias, str(elapsed_time_scan))
             andor_chan_names= data.iloc[:, 0].values.tolist()
             nanonis_chan_names=filtered_sigvals_df['Column1'].tolist()
             
@@ -1946,23 +1922,7 @@ Channels=Counts
             andor_data_to_sxm=np.array(data_ar).T
             combined_data = np.vstack((nanonis_data_to_sxm, andor_data_to_sxm))
             
-                        # Define constants
-            scan_dir = 'both'
-            default_value1 = '1.000E+0'
-            default_value2 = '0.000E+0'
-            
-            # Initialize lists to store the final output
-            final_list = []
-            
-            # Process nanonis_chan_names
-            for i, name in enumerate(nanonis_chan_names, start=1):
-                base_name, unit = name.split(' (')
-                unit = unit.strip(')')
-                final_list.append([i, f'{base_name}_avg.', unit, scan_dir, default_value1, default_value2])
-            
-            # Process andor_chan_names starting from index 128
-            for i, name in enumerate(andor_chan_names, start=128):
-                final_list.append([i, name, 'nm', scan_dir, default_value1, default_value2])
+            final_list = self.sxm_channels(nanonis_chan_names, andor_chan_names)
 
             data_sxm=self.connect.writesxm(backward,filename_sxm, settings_dict, scan_par, final_list, combined_data)
 
@@ -2017,6 +1977,7 @@ Channels=Counts
             # Start threads
             andor_thread = threading.Thread(target=send_andor_command)
             port_thread = threading.Thread(target=monitor_port)
+            signal_values = signal_stats(len(self.signal_names), self.signal_names['Signal names'])
             acquisition_thread = threading.Thread(target=acquire_data_from_connect, args=(signal_values,))
             
             # Start all threads
@@ -2108,7 +2069,7 @@ Channels=Counts
             acquire_thread.join()  # Ensure acquisition stops exactly when movement completes
 
             
-            stacked_data = np.stack([df.iloc[:, 1].values for df in signal_values])
+            stacked_data = np.stack(signal_values).astype(float)
             
 
             signal_array[index]=bin_average_stacked(stacked_data,pix[1])
@@ -2140,15 +2101,14 @@ Channels=Counts
         dim = (1e9 * SF.values[2][0], 1e9 * SF.values[3][0]) if dim is None else dim
         cx, cy, angle = SF.values[0][0], SF.values[1][0], SF.values[4][0]
         
-        signals_slots=self.connect.SignalsInSlotsGet(prt=False)
 
         if signal_names is None:
             signal_names = [
                 "Bias (V)", "X (m)", "Y (m)", "Z (m)", "Current (A)", 
                 "LI Demod 1 Y (A)", "LI Demod 2 Y (A)", "Counter 1 (Hz)"
             ]
-        # Filter rows in `signals_slots` where the first column matches any item in `signal_names`
-        signals =signals_slots.iloc[:, 0].tolist()
+        # Keep the slots (names from the signal registry) whose signal is in `signal_names`
+        signals = self.connect.signals.slot_names
         matching_indices = [i for i, signal in enumerate(signals) if signal in signal_names]
         unmatched_items = [item for item in signal_names if item not in signals]
         
@@ -2252,16 +2212,15 @@ Channels=Counts
         dim = (1e9 * SF.values[2][0], 1e9 * SF.values[3][0]) if dim is None else dim
         cx, cy, angle = SF.values[0][0], SF.values[1][0], SF.values[4][0]
         bw_ratio=10
-        signals_slots=self.connect.SignalsInSlotsGet(prt=False)
 
         if signal_names is None:
             signal_names = [
                 "Bias (V)", "X (m)", "Y (m)", "Z (m)", "Current (A)", 
                 "LI Demod 1 Y (A)", "LI Demod 2 Y (A)", "Counter 1 (Hz)"
             ]
-        # Filter rows in `signals_slots` where the first column matches any item in `signal_names`
+        # Keep the slots (names from the signal registry) whose signal is in `signal_names`
 
-        signals =signals_slots.iloc[:, 0].tolist()
+        signals = self.connect.signals.slot_names
         matching_indices = [i for i, signal in enumerate(signals) if signal in signal_names]
         matching_items = [item for item in signal_names if item in signals]
         unmatched_items = [item for item in signal_names if item not in signals]
@@ -2399,6 +2358,7 @@ Channels=Counts
             n (int): Desired number of rows for reshaping the data.
     
         """
+        session = self.http_session()
         port = str(self.connect2.tcp.server_addr[1])
         path = "/shm/andor.dat"
         address = self.connect2.tcp.server_addr[0]
@@ -2417,7 +2377,7 @@ Channels=Counts
     
             try:
                 # Send an HTTP GET request to fetch the data file
-                response = requests.get(url)
+                response = session.get(url)
     
                 # Check if the request was successful
                 if response.status_code == 200:
@@ -2449,6 +2409,9 @@ Channels=Counts
     def andor_thread_open(self,port=None,index=0,wait_time=None):
         if port is None:
             port = self.dig_port
+        stream = self.kinser_stream
+        if stream is not None:
+            stream.idle.wait() # the last spectra of the previous series are read before AQR starts a new andor.dat
         andor_thread=threading.Thread(target=self.connect2.kinser_start)
         andor_thread.start()
         if wait_time==None:
@@ -2457,6 +2420,8 @@ Channels=Counts
                    break
         else:
             time.sleep(wait_time)
+        if stream is not None:
+            stream.series_start(andor_thread) # the series is running: its spectra are read while acquired
         return(andor_thread)
     
     def build_urls(self):
@@ -2466,35 +2431,77 @@ Channels=Counts
         self.url_cal = f"http://{TCP_IP}:{PORT}/shm/andor.cal"
         self.kinser_dat = f"http://{TCP_IP}:{PORT}/shm/andor.dat"
 
+    def http_session(self):
+        """Keep-alive HTTP session to the Andor server (andor.dat, andor.cal), created on first use."""
+        if self._http is None:
+            self._http = andor_http.http_session()
+        return self._http
+
     def get_cal(self): #maybe move to andor_meas later
+        """
+        Wavelengths of the pixels and their number. Read once per centre wavelength and grating set
+        through connect2 (changes made in Andor itself are not seen: clear self._cal).
+        """
+        key = (getattr(self.connect2, 'wl', None), getattr(self.connect2, 'grating', None))
+        if key in self._cal:
+            return self._cal[key]
         if self.url_cal is None or self.kinser_dat is None:
             self.build_urls()
         try:
-            response = requests.get(self.url_cal)  # Send GET request to URL
+            response = self.http_session().get(self.url_cal)  # Send GET request to URL
             if response.status_code == 200:  # Check if request is successful
                 data = response.text  # Get the response text
                 split_index = data.rfind("\n\n") + 1  # Find the last empty line to split data
                 cal = np.genfromtxt(StringIO(data[:split_index]), dtype=float, invalid_raise=False)  # Load numeric data into NumPy array
+                self._cal[key] = cal, len(cal)
                 return cal, len(cal)  # Return data and pixel count
             print(f"Failed: {response.status_code}")  # Print error if request failed
         except Exception as e:  # Catch any exceptions
             print(f"Error: {e}")  # Print exception error
             return None, None  # Return None if an error occurred
         
+    def andor_data_connection(self):
+        """
+        Second connection to the Andor server with binary replies, for the kinetic series data
+        (connect2 is waiting for the end of the series meanwhile). Only if connect2 uses binary
+        replies (connect2.binary_enable()), otherwise False.
+        """
+        if self._andor_data is None:
+            self._andor_data = False
+            if getattr(self.connect2, 'binary', False):
+                try:
+                    tcp = self.connect2.tcp
+                    andor_data = andor_meas(tcp_andor_ctrl(*tcp.server_addr, termination_char=tcp.termination_char))
+                    if andor_data.binary_enable(prt=False):
+                        self._andor_data = andor_data
+                    else:
+                        andor_data.tcp.socket_close()
+                except OSError as e:
+                    print(f"No Andor data connection: {e}")
+        return self._andor_data
+
+    def kinser_fetch(self):
+        """Counts of the last kinetic series, flat: binary over the Andor data connection, else andor.dat over HTTP."""
+        andor_data = self.andor_data_connection()
+        if andor_data:
+            return andor_data.kinser_data_get().ravel()
+        if self.url_cal is None or self.kinser_dat is None:
+            self.build_urls()
+        response = self.http_session().get(self.kinser_dat)  # Fetch data
+        if response.status_code != 200: raise ValueError(f"Error: {response.status_code}")
+        return np.loadtxt(StringIO(response.text)).ravel()  # Load data
+
     def read_kinser(self,n): #maybe move to andor_meas later
         """Fetch data, reshape it to 1024 x n, and return."""
         try:
-            response = requests.get(self.kinser_dat)  # Fetch data
-            if response.status_code != 200: raise ValueError(f"Error: {response.status_code}")
-            
-            data = np.loadtxt(StringIO(response.text))  # Load data
+            data = self.kinser_fetch()
             if data.size % n != 0: raise ValueError("Invalid data size")
             
             return data.reshape(data.size // n, n)  # Reshape and return
         except Exception as e:
             raise RuntimeError(f"An error occurred: {e}")  # Error handling
             
-    def fetch_data_from_queue(self, backward,cal,file,matching_signals,signal_array,andor_settings,fetch_queue: Queue, delta: float, andor_array: np.ndarray,file_bw=None):
+    def fetch_data_from_queue(self, backward,cal,file,matching_signals,signal_array,andor_settings,fetch_queue: Queue, delta: float, andor_array: np.ndarray,file_bw=None,cosmic=False,sxm=None,clean_array=None,file_cr=None,file_cr_bw=None):
         """
         Fetches data from an external source and processes it.
     
@@ -2502,82 +2509,87 @@ Channels=Counts
             fetch_queue (Queue): Queue to receive notifications for fetching data.
             delta (float): Time delay between each fetch.
             n (int): Desired number of rows for reshaping the data.
+            cosmic (bool): Also write the lines with the cosmic rays removed: to clean_array and file_cr (file_cr_bw),
+                andor_array and the other files keep the raw spectra.
     
         """
         if self.url_cal is None or self.kinser_dat is None:
             self.build_urls()
         i=0
         bw_fact = 2 if backward else 1
+        stream = self.kinser_stream # spectra read while the series runs (andor.dat over HTTP), None: after the line
         while True:
+            if stream is not None:
+                series = stream.series_next()  # the kinetic series of line i is running
+                if series is None:
+                    break
+                line = andor_array[bw_fact*i:bw_fact*(i+1)].reshape(-1, andor_array.shape[2])  # spectra of line i in the order acquired
+                try:
+                    while series.is_alive():
+                        stream.read_into(line)  # completed spectra go to andor_array during the acquisition
+                        time.sleep(delta)
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+
             # Wait for a notification to fetch data
             item = fetch_queue.get()  # Block until there's a new item in the queue
             if item is None:  # Check for shutdown signal
                 break
     
-            # Wait for the specified delta time
-            time.sleep(delta)
+            if stream is not None:
+                try:
+                    received = stream.read_into(line, final=True)  # the spectra not read yet
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+                    received = stream.reader.frames
+                finally:
+                    stream.idle.set()  # the next series may start
+            else:
+                # Wait for the specified delta time
+                time.sleep(delta)
             
             if i==0:
                 calib,n=self.get_cal() # get calibration
                 cal.append(calib.tolist())
-                sweep_signal = "Wavelength (nm)"  # Sweep signal as string
                 fixed_parameters = ["Sweep Start", "Sweep End"]+matching_signals
-                            #print(fixed_parameters)
-                header2=f'''Sweep Signal="{sweep_signal}"
-Fixed parameters="{';'.join(fixed_parameters)}"
-Experiment parameters=
-# Parameters (4 byte)={len(fixed_parameters)}
-Experiment size (bytes)=4096
-Points={n}
-Channels=Counts
-'''
-                file.write(header2.encode())
-                
-                settings_str = andor_settings.apply(lambda row: f"{row['Code']}={row['Value']}",axis=1).str.cat(sep='\n') + '\n'
-                file.write(settings_str.encode())
-                
+                settings_lines = andor_settings.apply(lambda row: f"{row['Code']}={row['Value']}",axis=1).tolist()
                 andor_chan_names= calib.tolist()
                 chnames = [f"wl {i}=" + str(item) for i, item in enumerate(andor_chan_names)]
-                file.write(('\n'.join(chnames)+"\n").encode())
-                file.write((':HEADER_END:\n').encode())
+                file.experiment(fixed_parameters, n, "Wavelength (nm)", extra=settings_lines+chnames)
                 if backward==True:
-                    file_bw.write(header2.encode())
-                    file_bw.write(settings_str.encode())
-                    file_bw.write(('\n'.join(chnames)+"\n").encode())
-                    file_bw.write((':HEADER_END:\n').encode())
+                    file_bw.experiment(fixed_parameters, n, "Wavelength (nm)", extra=settings_lines+chnames)
+                if cosmic:
+                    file_cr.experiment(fixed_parameters, n, "Wavelength (nm)", extra=settings_lines+chnames)
+                    if backward==True:
+                        file_cr_bw.experiment(fixed_parameters, n, "Wavelength (nm)", extra=settings_lines+chnames)
+                sweep = (float(calib[0]), float(calib[-1]))  # Sweep Start and End of every pixel
+                if sxm is not None:  # andor channels of the .sxm file, starting from index 128
+                    sxm.channels_add(self.sxm_channels((), andor_chan_names))
                 
             try:
-                #print(self.kinser_dat)
-                response = requests.get(self.kinser_dat)  # Fetch data
-                if response.status_code != 200: raise ValueError(f"Error: {response.status_code}")
+                if stream is not None:
+                    if received < len(line): raise ValueError("Invalid data size")
+                else:
+                    data = self.kinser_fetch()  # Fetch data
+                    if data.size % n != 0: raise ValueError("Invalid data size")
+                    andor_array[bw_fact*i:bw_fact*(i+1), :, :] = data.reshape(bw_fact, -1, n)  # backward: first half forward, second half backward
                 
-                data = np.loadtxt(StringIO(response.text))  # Load data
-                if data.size % n != 0: raise ValueError("Invalid data size")
+                # the whole line as one block per file: nanonis data (with start and end wavelength) and andor data of every pixel
+                file.write_line(signal_array[2*i], andor_array[bw_fact*i], sweep)
+                if backward:  # Case for backward==True: the backward line was acquired right to left, written left to right
+                    file_bw.write_line(signal_array[2*i+1, ::-1], andor_array[2*i+1, ::-1], sweep)
                 
-                if backward:  # Case for backward==True
-                    # Split the data into two halves
-                    half_size = data.size // 2
-                    andor_array[2*i, :, :] = data[:half_size].reshape(half_size // n, n)  # First half
-                    andor_array[2*i+1, :, :] = data[half_size:].reshape(half_size // n, n)  # Second half
-                    for j in range(signal_array.shape[1]-1,-1):
-                        nanonis_data_bw = np.array([float(calib[0]), float(calib[-1])] + list(signal_array[2*i, j, :]))
-                        andor_data_bw = andor_array[2*i+1, j, :]
-                        
-                        # Convert to the correct dtype and write to file
-                        nanonis_data_bw.astype(">f4").tofile(file_bw)
-                        andor_data_bw.astype(">f4").tofile(file_bw)
-                    
-                else:  # Case for backward == False
-                    andor_array[i, :, :] = data.reshape(data.size // n, n)  # Reshape and assign
-                    
-                for j in range(signal_array.shape[1]):
-                    # Construct arrays of nanonis data (with start and end wavelength) and andor data 
-                    nanonis_data = np.array([float(calib[0]), float(calib[-1])] + list(signal_array[2*i, j, :]))
-                    andor_data = andor_array[bw_fact*i, j, :]
-                    
-                    # Convert to the correct dtype and write to file
-                    nanonis_data.astype(">f4").tofile(file)
-                    andor_data.astype(">f4").tofile(file)
+                if cosmic:  # a copy of line i without cosmic rays, against the cleaned lines before it in the same direction
+                    clean_array[bw_fact*i:bw_fact*(i+1)] = andor_array[bw_fact*i:bw_fact*(i+1)]
+                    for d in range(bw_fact):
+                        cosmic_rays.cr_clean_line(clean_array[d::bw_fact], i)
+                    file_cr.write_line(signal_array[2*i], clean_array[bw_fact*i], sweep)
+                    if backward:
+                        file_cr_bw.write_line(signal_array[2*i+1, ::-1], clean_array[2*i+1, ::-1], sweep)
+                
+                if sxm is not None:  # the line into the .sxm file: nanonis channels, then andor channels
+                    sxm.write_line(i, signal_array[2*i], signal_array[2*i+1] if backward else None)
+                    sxm.write_line(i, andor_array[bw_fact*i], andor_array[2*i+1] if backward else None, first=len(matching_signals))
                 
             except Exception as e:
                 raise RuntimeError(f"An error occurred: {e}")  # Error handling
@@ -2586,7 +2598,7 @@ Channels=Counts
                 fetch_queue.task_done()  # Mark the task as done
                 i+=1
     
-    def photon_map_k(self, acqtime=10, acqnum=1, pix=(10, 10), dim=None, name="LS-man", user="Jirka", signal_names=None,direction="up",backward=False,bw_ratio=10,readmode=0,wait_time=None,num_points=100000):     
+    def photon_map_k(self, acqtime=10, acqnum=1, pix=(10, 10), dim=None, name="LS-man", user="Jirka", signal_names=None,direction="up",backward=False,bw_ratio=10,readmode=0,wait_time=None,num_points=100000,cosmic=False):     
         """
  Perform a photon mapping scan for a given experimental setup.
 
@@ -2609,9 +2621,12 @@ Channels=Counts
      readmode (int): Mode for the camera acquisition. Default is 0.
      wait_time (float, optional): Time in seconds to wait before starting the next acquisition. Default is None.
      num_points(integer,optional): number of points: default 100k allows ~25 min per line in forward only and 12.5 min in fw-bw mode
+     cosmic (bool): Also save the spectra with the cosmic rays of each line removed (cosmic_rays.cr_clean_line), in a
+         separate file (name + "_cr"). The raw spectra are kept. Default is False.
 
  Returns:
      None: The function doesn't return any value but writes the scanned data to a file.
+     With cosmic=True the cleaned spectra are returned after the raw ones.
 
  Raises:
      RuntimeError: If an error occurs during setup, data fetching, or file writing.
@@ -2686,13 +2701,12 @@ Channels=Counts
                 "Bias (V)", "Z (m)", "Current (A)", 
                 "LI Demod 1 Y (A)", "LI Demod 2 Y (A)", "Counter 1 (Hz)"
             ]
-        # Filter rows in `signals_slots` where the first column matches any item in `signal_names`
+        # Keep the slots (names from the signal registry) whose signal is in `signal_names`
 
         if self.connect.version<13000:
-            signals_slots=self.connect.SignalsInSlotsGet(prt=False)
-            signals =signals_slots.iloc[:, 0].tolist()
+            signals = self.connect.signals.slot_names
         else:
-            signals =self.signal_names.iloc[:, 0].tolist()
+            signals = self.connect.signals.names
         # Get matching indices and signals in the order based on signals
         matching_indices = [i for i, signal in enumerate(signals) if signal in signal_names]
         matching_signals = [signals[i] for i in matching_indices]
@@ -2732,42 +2746,40 @@ Channels=Counts
         filename_3ds = self.connect.get_next_filename("G"+name, extension='.3ds', folder=folder)
     
         bias_voltage = self.connect.BiasGet().iloc[0, 0]  # Bias (V) as float
-        grid_settings = np.array([cx,cy,1e-9*dim[0],1e-9*dim[1],angle])  # Grid settings as np.array
-        sweep_signal = "Wavelength (nm)"  # Sweep signal as string
+        grid_settings = [cx,cy,1e-9*dim[0],1e-9*dim[1],angle]  # Grid settings
         count_write=0
         
-        # Prepare the header
-        start_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-        header = f'''End time="{start_time}"
-Start time="{start_time}"
-Delay before measuring (s)=0
-Comment=
-Bias (V)={bias_voltage:.6E}
-Experiment=Experiment
-Date="{start_time.split()[0]}"
-User=
-Grid dim="{pix[0]} x {pix[1]}"
-Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
-
-'''
+        # .3ds files written a line at a time, the experiment part of the header follows with the calibration (fetch_data_from_queue)
         if backward==True:
            # filename_3ds_bw = self.connect.get_next_filename("G"+name+'_bw', extension='.3ds', folder=folder)
             filename_3ds_bw = filename_3ds.replace(name, f"{name}_bw")
-            f_bw = open(filename_3ds_bw, 'wb')
-            f_bw.write(header.encode())
+            f_bw = nanonis_files.grid3ds_writer(filename_3ds_bw, pix, grid_settings, bias_voltage, background=True)
 
-        f = open(filename_3ds, 'wb')
-        f.write(header.encode())
+        f = nanonis_files.grid3ds_writer(filename_3ds, pix, grid_settings, bias_voltage, background=True)
+        f_cr = f_cr_bw = None
+        if cosmic:  # spectra without cosmic rays, next to the raw ones
+            f_cr = nanonis_files.grid3ds_writer(filename_3ds.replace(name, f"{name}_cr"), pix, grid_settings, bias_voltage, background=True)
+            if backward==True:
+                f_cr_bw = nanonis_files.grid3ds_writer(filename_3ds.replace(name, f"{name}_bw_cr"), pix, grid_settings, bias_voltage, background=True)
+        
+        # .sxm file filled a line at a time (the andor channels are added with the calibration, fetch_data_from_queue)
+        filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
+        sxm = self.sxm_open(filename_sxm, (cx, cy, dim, angle), pix, acqtime, matching_signals, direction, bias_voltage, backward)
         if andor:
             cal=[]
             andor_array = np.full((bw_fact*pix[1], pix[0], 1024), np.nan, dtype=np.float32)
+            clean_array = np.full_like(andor_array, np.nan) if cosmic else None
             #start andor queue for data downloading and processing
             fetch_queue = Queue()  # Create a queue for URLs to fetch
             delta = 0.05  # Set your desired delay time
+            if not self.andor_data_connection():  # andor.dat over HTTP: read the spectra of each line while it is acquired
+                if self.url_cal is None or self.kinser_dat is None:
+                    self.build_urls()
+                self.kinser_stream = andor_http.kinser_stream(self.http_session(), self.kinser_dat, andor_array.shape[2])
             if backward==True:
-                fetch_thread = threading.Thread(target=self.fetch_data_from_queue, args=(backward,cal,f,matching_signals,signal_array,settings,fetch_queue, delta,andor_array,f_bw))
+                fetch_thread = threading.Thread(target=self.fetch_data_from_queue, args=(backward,cal,f,matching_signals,signal_array,settings,fetch_queue, delta,andor_array,f_bw,cosmic,sxm,clean_array,f_cr,f_cr_bw))
             else:
-                fetch_thread = threading.Thread(target=self.fetch_data_from_queue, args=(backward,cal,f,matching_signals,signal_array,settings,fetch_queue, delta,andor_array))
+                fetch_thread = threading.Thread(target=self.fetch_data_from_queue, args=(backward,cal,f,matching_signals,signal_array,settings,fetch_queue, delta,andor_array,None,cosmic,sxm,clean_array,f_cr))
             fetch_thread.start()  # Start the fetch thread
         
 
@@ -2811,6 +2823,8 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         temp_data = self.bin_average_stacked(data,pix[0]) # analyse to fw and bw movement and make avarage of pixels
                         signal_array[index,:,:], signal_array[index + 1,:,:] = temp_data, temp_data[::-1,:] # write first fw an later fw reversed
                         self.connect.FolMeSpeedSet(bw_ratio*mv_spd,1)
+                        if not andor: # with andor the fetch thread writes the line
+                            sxm.write_line(index // 2, temp_data)
                         
                     if index == len(row_range) - 1 and andor==True: #Terminate in last row
                         andor_thread.join()
@@ -2837,6 +2851,8 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         temp_data = self.bin_average_stacked(data,2 * pix[0]) # analyse to fw and bw movement and make avarage of pixels
                     #    print(data.shape,temp_data[pix[0]:, :].shape,index-1,index)
                         signal_array[index - 1,:,:], signal_array[index,:,:] = temp_data[:pix[0], :], temp_data[pix[0]:, :] # write first fw an later bw
+                        if not andor: # with andor the fetch thread writes the line
+                            sxm.write_line(index // 2, temp_data[:pix[0], :], temp_data[pix[0]:, :])
                         
                     if index == len(row_range) - 1 and andor==True: #Terminate in last row
                         andor_thread.join()
@@ -2856,86 +2872,27 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                 # Ensure all remaining items in the queue are processed
                 fetch_queue.join()  # Wait until all items in the queue have been processed
                 fetch_queue.put(None)  # Send a shutdown signal to the fetch thread
+                if self.kinser_stream is not None:
+                    self.kinser_stream.close()
                 fetch_thread.join()  # Wait for the fetch thread to finish
+                self.kinser_stream = None
                 self.connect2.acqmode_set(1)
               #  print("Shutdown complete.")
             
             end_time_scan = time.perf_counter()
             elapsed_time_scan="{:.1f}".format(end_time_scan-s_time)
             
-            end_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-            end_time_line = f'End time="{end_time}" \n'
-            end_time_line = end_time_line.ljust(len(header.splitlines()[0]) + 1)
-            
-            # Seek to the beginning and overwrite the first line
-            f.seek(0)
-            f.write(end_time_line.encode())
+            # write the End time and close the .3ds files
             f.close()
             if backward==True:
-                # Seek to the beginning and overwrite the first line
-                f_bw.seek(0)
-                f_bw.write(end_time_line.encode())
                 f_bw.close()
-            filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
-           ### settings_dict=(dict(zip(settings.T.iloc[0], settings.T.iloc[1].astype(str))))
-            scan_par = {
-                "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
-                "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
-                "ACQ_TIME": str(elapsed_time_scan),
-                "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
-                "SCAN_FILE": filename_sxm,
-                "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
-                "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
-                "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
-                "SCAN_ANGLE": str(angle),
-                "SCAN_DIR": direction,
-                "BIAS": str(bias_voltage)
-                }   
-            andor_chan_names= []
-            settings_dict={}
-            nanonis_chan_names=matching_signals
-            if andor:
-                #print(cal,"calibration")
-                andor_chan_names=[item for sublist in cal for item in sublist]
-                
-            
-            #andor_data_to_sxm=np.array(data_ar).T
-            #combined_data = np.vstack((nanonis_data_to_sxm, andor_data_to_sxm))
-            if andor:
-                if backward==True:
-                    combined_data =np.vstack((signal_array.transpose(2, 0, 1).reshape(signal_array.shape[2], -1),andor_array.transpose(2, 0, 1).reshape(andor_array.shape[2], -1)))
-                else:
-                    print(andor_array.shape,signal_array.shape)
-                    combined_data =np.vstack((signal_array[::2,:,:].transpose(2, 0, 1).reshape(signal_array.shape[2], -1),andor_array.transpose(2, 0, 1).reshape(andor_array.shape[2], -1)))
-            else:
-                if backward==True:
-                    combined_data =signal_array.transpose(2, 0, 1).reshape(signal_array.shape[2], -1)
-                else:
-                    combined_data =signal_array[::2,:,:].transpose(2, 0, 1).reshape(signal_array.shape[2], -1)
-            
-                        # Define constants
-            scan_dir = 'both'
-            default_value1 = '1.000E+0'
-            default_value2 = '0.000E+0'
-            
-            # Initialize lists to store the final output
-            final_list = []
-            
-            # Process nanonis_chan_names
-            for i, name in enumerate(nanonis_chan_names, start=1):
-                base_name, unit = name.split(' (')
-                unit = unit.strip(')')
-                final_list.append([i, f'{base_name}_avg.', unit, scan_dir, default_value1, default_value2])
-            
-            # Process andor_chan_names starting from index 128
-            #print(andor_chan_names)
-            #print(cal,"cal")
-            #print(nanonis_chan_names)
-            for i, name in enumerate(andor_chan_names, start=128):
-                final_list.append([i, name, 'nm', scan_dir, default_value1, default_value2])
-
-            data_sxm=self.connect.writesxm(backward,filename_sxm, settings_dict, scan_par, final_list, combined_data)
-            
+            for f_clean in (f_cr, f_cr_bw):
+                if f_clean is not None:
+                    f_clean.close()
+            # the lines are in the .sxm file already: record time and acquisition time
+            sxm.close({"REC_DATE": datetime.now().strftime('%d.%m.%Y'),
+                       "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
+                       "ACQ_TIME": str(elapsed_time_scan)})
             
 
         
@@ -2945,7 +2902,9 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
         #return(np.stack(signal_array,axis=0))
         e_time=time.perf_counter()
         print("tot time", "{:.5f}".format(e_time-s_time))
-        if andor:
+        if andor and cosmic:
+            return(signal_array,andor_array,clean_array)
+        elif andor:
             return(signal_array,andor_array)
         else:
             return(signal_array)
@@ -2954,7 +2913,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
   
     def fetch_data_from_queue_nanonis(self, backward, file, matching_signals, signal_array, fetch_queue: Queue, delta: float, file_bw=None):
         """
-        Saves Nanonis data to a 3ds file with placeholder Counts=[0,1].
+        Saves Nanonis data to a 3ds file (nanonis_files.grid3ds_writer) with placeholder Counts=[0,1].
         Each pixel keeps its parameters, channel data is minimal.
         """
         i = 0
@@ -2968,39 +2927,17 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
             time.sleep(delta)
 
             if i == 0:
-                # header
-                sweep_signal = "None"  # placeholder
+                # header, sweep signal "None" (placeholder)
                 fixed_parameters = ["Sweep Start", "Sweep End"] + matching_signals
-
-                header = f'''Sweep Signal="{sweep_signal}"
-    Fixed parameters="{';'.join(fixed_parameters)}"
-    Experiment parameters=
-    # Parameters (4 byte)={len(fixed_parameters)}
-    Experiment size (bytes)=4096
-    Points=2
-    Channels=Counts
-    '''
-                file.write(header.encode())
-                file.write((':HEADER_END:\n').encode())
-
+                file.experiment(fixed_parameters, 2, "None")
                 if backward and file_bw is not None:
-                    file_bw.write(header.encode())
-                    file_bw.write((':HEADER_END:\n').encode())
+                    file_bw.experiment(fixed_parameters, 2, "None")
 
-            # loop over signals (channels)
+            # one record per pixel: all parameters for this pixel + placeholder counts of length 2, the line in one block
             print(signal_array.shape,"shape of the signal array ")
-            for j in range(signal_array.shape[1]):
-                # nanonis data: all parameters for this pixel
-                nanonis_data = np.array(list(signal_array[2*i, j, :]), dtype=np.float32)
-                # placeholder counts of length 2
-                counts = np.array([0, 1], dtype=np.float32)
-
-                nanonis_data.astype(">f4").tofile(file)
-                counts.astype(">f4").tofile(file)
-
-                if backward and file_bw is not None:
-                    nanonis_data.astype(">f4").tofile(file_bw)
-                    counts.astype(">f4").tofile(file_bw)
+            file.write_line(signal_array[2*i], [0, 1], (0.0, 1.0))
+            if backward and file_bw is not None:
+                file_bw.write_line(signal_array[2*i], [0, 1], (0.0, 1.0))
 
             fetch_queue.task_done()
             print(i,"number of iterations")
@@ -3009,67 +2946,65 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
     def write_nanonis_3ds_line(self, line_data, len_data, f_fw, f_bw=None):
         """
         Writes one scan line of data (already sliced, shape (n_points, n_signals))
-        to the .3ds file(s).
+        to the .3ds file(s) (nanonis_files.grid3ds_writer).
         """
     
-        # Counts channel placeholder (must match "Points=" in header if used as sweep)
-        counts_channel = np.arange(len_data, dtype=np.float32)
+        # One record per pixel: fixed params (sweep start, sweep end, + signals) and the
+        # Counts channel placeholder (must match "Points=" in header if used as sweep), one block per line
+        counts = np.arange(len_data)
     
-        # Loop through each pixel in the line
-        for px_idx in range(line_data.shape[0]):
-            pixel_signals = line_data[px_idx, :]   # shape (n_signals,)
+        # forward scan
+        f_fw.write_line(line_data, counts, (0.0, 1.0))
     
-            # fixed params (sweep start, sweep end, + signals)
-            nanonis_params = np.array([0.0, 1.0] + list(pixel_signals), dtype=np.float32)
-    
-            # forward scan
-            nanonis_params.astype(">f4").tofile(f_fw)
-            counts_channel.astype(">f4").tofile(f_fw)
-    
-            # backward scan (if file handle provided)
-            if f_bw:
-                nanonis_params.astype(">f4").tofile(f_bw)
-                counts_channel.astype(">f4").tofile(f_bw)
+        # backward scan (if file provided)
+        if f_bw is not None:
+            f_bw.write_line(line_data, counts, (0.0, 1.0))
 
-    def bias_test_worker(self, duration, stop_event, center_bias=0, amplitude=0.1, period=1.0, update_rate_local=50):
+    def bias_test_worker(self, duration, stop_event, center_bias=0, amplitude=0.1, period=1.0, update_rate_local=50, no_reply=False):
             """
             Apply a test sine waveform with precise timing and drift compensation.
+            no_reply: send BiasSet without waiting for Nanonis to reply (allows update rates well above 50 Hz, errors are not reported)
             Returns: actual timestamps of each BiasSet call (for analysis)
             """
-            N = max(2, int(update_rate_local * max(0.0001, duration)))
-            t = np.linspace(0, duration, N)
-            waveform = center_bias + amplitude * np.sin(2 * np.pi * t / period)
-            interval = duration / N
-            start_time = time.perf_counter()
-            
-            timestamps = []
-            
-            for i, val in enumerate(waveform):
-                if stop_event.is_set():
-                    break
-                try:
-                    self.connect3.BiasSet(float(val))
-                except Exception as e:
-                    print("[test] BiasSet error:", e)
+            with self.worker_connect(self.connect3) as connect3:
+                connect = connect3.no_reply() if no_reply else connect3
+                N = max(2, int(update_rate_local * max(0.0001, duration)))
+                t = np.linspace(0, duration, N)
+                waveform = center_bias + amplitude * np.sin(2 * np.pi * t / period)
+                interval = float(duration) / N # duration may be a numpy float32 (from ScanFrameGet), too coarse for perf_counter times
+                start_time = time.perf_counter()
+            
+                timestamps = []
+            
+                for i, val in enumerate(waveform):
+                    if stop_event.is_set():
+                        break
+                    try:
+                        connect.BiasSet(float(val))
+                    except Exception as e:
+                        print("[test] BiasSet error:", e)
                 
-                timestamps.append(time.perf_counter())
+                    timestamps.append(time.perf_counter())
                 
-                # absolute timing to compensate drift
-                next_time = start_time + (i + 1) * interval
-                while True:
-                    now = time.perf_counter()
-                    if now >= next_time:
-                        break
-                    time.sleep(min(next_time - now, 0.001))
+                    # absolute timing to compensate drift
+                    next_time = start_time + (i + 1) * interval
+                    while True:
+                        now = time.perf_counter()
+                        if now >= next_time:
+                            break
+                        time.sleep(min(next_time - now, 0.001))
             
-            return np.array(timestamps)
+                return np.array(timestamps)
     
     
-    def bias_playback_worker(self, bias_profile, duration, stop_event, update_rate_local=50, smooth_local=False, sg_window=1, sg_poly=0,feed_off=True):
+    def bias_playback_worker(self, bias_profile, duration, stop_event, update_rate_local=50, smooth_local=False, sg_window=1, sg_poly=0,feed_off=True, no_reply=False):
         """
         Play back a bias profile over a given duration with precise timing and drift compensation.
+        no_reply: send BiasSet/KelvinCtrlOnOffSet without waiting for Nanonis to reply (allows update rates well above 50 Hz, errors are not reported)
         Returns: actual timestamps of each BiasSet call (for analysis)
         """
+        from scipy.signal import savgol_filter
+        from scipy.interpolate import interp1d
         if bias_profile is None or len(bias_profile) < 2:
             return np.array([])
     
@@ -3096,36 +3031,38 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
         except Exception:
             resampled = np.interp(x_new, x_old, prof)
     
-        interval = duration / N  # use duration/N for precise total timing
-        t_start = time.perf_counter()
-        timestamps = []
+        interval = float(duration) / N  # use duration/N for precise total timing, as a Python float (not float32)
+        with self.worker_connect(self.connect3) as connect3:
+            connect = connect3.no_reply() if no_reply else connect3
+            t_start = time.perf_counter()
+            timestamps = []
     
-        for i, val in enumerate(resampled):
-            if stop_event.is_set():
-                break
-            try:
-                if feed_off:
-                    self.connect3.KelvinCtrlOnOffSet(0)
-                    self.connect3.BiasSet(float(val))
-                    self.connect3.KelvinCtrlOnOffSet(1)
-                else:
-                    self.connect3.BiasSet(float(val))
-            except Exception as e:
-                print("BiasSet error:", e)
-            
-            timestamps.append(time.perf_counter())
-            
-            # drift-compensated sleep
-            next_time = t_start + (i + 1) * interval
-            while True:
+            for i, val in enumerate(resampled):
                 if stop_event.is_set():
-                    return np.array(timestamps)
-                t_now = time.perf_counter()
-                if t_now >= next_time:
                     break
-                time.sleep(min(next_time - t_now, 0.001))
+                try:
+                    if feed_off:
+                        connect.KelvinCtrlOnOffSet(0)
+                        connect.BiasSet(float(val))
+                        connect.KelvinCtrlOnOffSet(1)
+                    else:
+                        connect.BiasSet(float(val))
+                except Exception as e:
+                    print("BiasSet error:", e)
+            
+                timestamps.append(time.perf_counter())
+            
+                # drift-compensated sleep
+                next_time = t_start + (i + 1) * interval
+                while True:
+                    if stop_event.is_set():
+                        return np.array(timestamps)
+                    t_now = time.perf_counter()
+                    if t_now >= next_time:
+                        break
+                    time.sleep(min(next_time - t_now, 0.001))
     
-    def nanonis_map_k(self, acqtime=10, pix=(10, 10), dim=None, name="LS-man", user="Jirka", signal_names=None,direction="up",backward=False,feedfw=False,bw_ratio=10,ds3=True,len_data=128,fftest=False,plotting=False,ff_factor = 10 ):     
+    def nanonis_map_k(self, acqtime=10, pix=(10, 10), dim=None, name="LS-man", user="Jirka", signal_names=None,direction="up",backward=False,feedfw=False,bw_ratio=10,ds3=True,len_data=128,fftest=False,plotting=False,ff_factor = 10, ff_rate=50, ff_no_reply=False ):     
         """
  Perform a photon mapping scan for a given experimental setup.
 
@@ -3145,6 +3082,9 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
      direction (str): Direction of the scan. Can be "up" or "down". Default is "up".
      backward (bool): Whether the scan is backward (zigzag pattern). Default is False.
      bw_ratio (float): Ratio to adjust the backward scan speed. Default is 10.
+     ff_rate (float): Bias update rate of the feedforward (in Hz). Default is 50.
+     ff_no_reply (bool): Send the feedforward bias updates without waiting for Nanonis to reply,
+                         needed for ff_rate well above 50 Hz. Default is False.
      readmode (int): Mode for the camera acquisition. Default is 0.
      wait_time (float, optional): Time in seconds to wait before starting the next acquisition. Default is None.
 
@@ -3186,13 +3126,12 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                 "Bias (V)", "Z (m)", "Current (A)", 
                 "LI Demod 1 Y (A)", "LI Demod 2 Y (A)", "Counter 1 (Hz)"
             ]
-        # Filter rows in `signals_slots` where the first column matches any item in `signal_names`
+        # Keep the slots (names from the signal registry) whose signal is in `signal_names`
 
         if self.connect.version<13000:
-            signals_slots=self.connect.SignalsInSlotsGet(prt=False)
-            signals =signals_slots.iloc[:, 0].tolist()
+            signals = self.connect.signals.slot_names
         else:
-            signals =self.signal_names.iloc[:, 0].tolist()
+            signals = self.connect.signals.names
         # Get matching indices and signals in the order based on signals
         matching_indices = [i for i, signal in enumerate(signals) if signal in signal_names]
         matching_signals = [signals[i] for i in matching_indices]
@@ -3235,52 +3174,26 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
         filename_3ds = self.connect.get_next_filename("G"+name, extension='.3ds', folder=folder)
         
         bias_voltage = self.connect.BiasGet().iloc[0, 0]
-        grid_settings = np.array([cx, cy, 1e-9*dim[0], 1e-9*dim[1], angle])
-        start_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-        
-        # === common header ===
-        header = f'''End time="{start_time}"
-        Start time="{start_time}"
-        Delay before measuring (s)=0
-        Comment=
-        Bias (V)={bias_voltage:.6E}
-        Experiment=Experiment
-        Date="{start_time.split()[0]}"
-        User={user}
-        Grid dim="{pix[0]} x {pix[1]}"
-        Grid settings={";".join([f"{val:.6E}" for val in grid_settings])}
-        '''
+        grid_settings = [cx, cy, 1e-9*dim[0], 1e-9*dim[1], angle]
         
         # === sweep/fixed header ===
         fixed_parameters = ["Sweep Start", "Sweep End"] + matching_signals
-        
-        # --- Calculate the correct experiment size ---
         #len_data = 128  # As requested, one channel with 10 points
-        num_params = len(fixed_parameters)
-        # Size = (number of parameter values + number of data points) * 4 bytes/value
-        experiment_size_bytes = (len_data) * 4
-
-        param_header = f'Sweep Signal="{sweep_signal}"\r\n' \
-               f'Fixed parameters="{";".join(fixed_parameters)}"\r\n' \
-               f'Experiment parameters=\r\n' \
-               f'# Parameters (4 byte)={num_params}\r\n' \
-               f'Experiment size (bytes)={experiment_size_bytes}\r\n' \
-               f'Points={len_data}\r\n' \
-               f'Channels=Counts\r\n' \
-               f':HEADER_END:\r\n'
         
         # --- forward file ---
-        f = open(filename_3ds, 'wb')
-        f.write(header.encode())
-        f.write(param_header.encode())
+        f = nanonis_files.grid3ds_writer(filename_3ds, pix, grid_settings, bias_voltage, user=user, background=True)
+        f.experiment(fixed_parameters, len_data, sweep_signal)
         
         # --- backward file (if needed) ---
         f_bw = None
         if backward:
             filename_3ds_bw = filename_3ds.replace(name, f"{name}_bw")
-            f_bw = open(filename_3ds_bw, 'wb')
-            f_bw.write(header.encode())
-            f_bw.write(param_header.encode()) 
+            f_bw = nanonis_files.grid3ds_writer(filename_3ds_bw, pix, grid_settings, bias_voltage, user=user, background=True)
+            f_bw.experiment(fixed_parameters, len_data, sweep_signal)
+        
+        # --- .sxm file, filled a line at a time ---
+        filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
+        sxm = self.sxm_open(filename_sxm, (cx, cy, dim, angle), pix, acqtime, matching_signals, direction, bias_voltage, backward)
         """
         if ds3: # no fetch thread, we’ll write directly after each line
             #start 3ds loop fo processing
@@ -3344,7 +3257,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                             bias_thread = threading.Thread(
                                 target=self.bias_playback_worker,
                                 args=(prev_fw_bias_profile, line_duration, ff_stop_event),
-                                kwargs={'update_rate_local': 50, 'smooth_local': False},
+                                kwargs={'update_rate_local': ff_rate, 'smooth_local': False, 'no_reply': ff_no_reply},
                             )
                             bias_thread.start()
                      
@@ -3356,7 +3269,8 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                             test_thread = threading.Thread(
                                 target=self.bias_test_worker,
                                 args=(dim[0]*1e-9/(mv_spd/ ff_factor), ff_stop_event),
-                                kwargs={'center_bias': bias_voltage, 'amplitude': 0.05, 'period': 2.0}
+                                kwargs={'center_bias': bias_voltage, 'amplitude': 0.05, 'period': 2.0,
+                                        'update_rate_local': ff_rate, 'no_reply': ff_no_reply}
                             )
                             test_thread.start()
                     mv_time=time.perf_counter()
@@ -3380,6 +3294,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         temp_data = self.bin_average_stacked(data,pix[0]) # analyse to fw and bw movement and make avarage of pixels
                         signal_array[index,:,:], signal_array[index + 1,:,:] = temp_data, temp_data[::-1,:] # write first fw an later fw reversed
                         self.connect.FolMeSpeedSet(bw_ratio*mv_spd,1)
+                        sxm.write_line(index // 2, temp_data)
                         # write forward line directly
                         if ds3:
                             self.write_nanonis_3ds_line(temp_data, len_data, f)
@@ -3426,6 +3341,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                         signal_array[index - 1,:,:], signal_array[index,:,:] = temp_data[:pix[0], :], temp_data[pix[0]:, :] # write first fw an later bw
                         fw_line = temp_data[:pix[0], :]
                         bw_line = temp_data[pix[0]:, :]
+                        sxm.write_line(index // 2, fw_line, bw_line)
                 
                         # write fw to fw file
                         if ds3:
@@ -3449,57 +3365,14 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
             end_time_scan = time.perf_counter()
             elapsed_time_scan="{:.1f}".format(end_time_scan-s_time)
             
-            end_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-            end_time_line = f'End time="{end_time}" \n'
-            end_time_line = end_time_line.ljust(len(header.splitlines()[0]) + 1)
-            
-            # Seek to the beginning and overwrite the first line
-            f.seek(0)
-            f.write(end_time_line.encode())
+            # write the End time and close the .3ds files
             f.close()
             if backward==True:
-                # Seek to the beginning and overwrite the first line
-                f_bw.seek(0)
-                f_bw.write(end_time_line.encode())
                 f_bw.close()
-            filename_sxm = self.connect.get_next_filename("M"+name,extension='.sxm',folder=folder)
-           ### settings_dict=(dict(zip(settings.T.iloc[0], settings.T.iloc[1].astype(str))))
-            scan_par = {
-                "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
-                "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
-                "ACQ_TIME": str(elapsed_time_scan),
-                "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
-                "SCAN_FILE": filename_sxm,
-                "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
-                "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
-                "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
-                "SCAN_ANGLE": str(angle),
-                "SCAN_DIR": direction,
-                "BIAS": str(bias_voltage)
-                }   
-            settings_dict={}
-            nanonis_chan_names=matching_signals                
-            
-            if backward==True:
-                combined_data =signal_array.transpose(2, 0, 1).reshape(signal_array.shape[2], -1)
-            else:
-                combined_data =signal_array[::2,:,:].transpose(2, 0, 1).reshape(signal_array.shape[2], -1)
-            
-                        # Define constants
-            scan_dir = 'both'
-            default_value1 = '1.000E+0'
-            default_value2 = '0.000E+0'
-            
-            # Initialize lists to store the final output
-            final_list = []
-            
-            # Process nanonis_chan_names
-            for i, name in enumerate(nanonis_chan_names, start=1):
-                base_name, unit = name.split(' (')
-                unit = unit.strip(')')
-                final_list.append([i, f'{base_name}_avg.', unit, scan_dir, default_value1, default_value2])
-
-            data_sxm=self.connect.writesxm(backward,filename_sxm, settings_dict, scan_par, final_list, combined_data)
+            # the lines are in the .sxm file already: record time and acquisition time
+            sxm.close({"REC_DATE": datetime.now().strftime('%d.%m.%Y'),
+                       "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
+                       "ACQ_TIME": str(elapsed_time_scan)})
 
         # reset speed and recorded channels in scan window to the original value before the map acquisition
         self.connect.FolMeSpeedSet(mv_spd,0)
@@ -3521,8 +3394,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
         dim = (1e9 * SF.values[2][0], 1e9 * SF.values[3][0]) if dim is None else dim
         cx, cy, angle = SF.values[0][0], SF.values[1][0], SF.values[4][0]
         
-        # Get available signal slots and set signal names
-        signals_slots = self.connect.SignalsInSlotsGet(prt=False)
+        # Slot names from the signal registry (asked for once), set signal names
         if signal_names is None:
             signal_names = [
                 "Bias (V)", "X (m)", "Y (m)", "Z (m)", "Current (A)", 
@@ -3530,7 +3402,7 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
             ]
         
         # Find matching indices of required signals
-        signals = signals_slots.iloc[:, 0].tolist()
+        signals = self.connect.signals.slot_names
         matching_indices = [i for i, signal in enumerate(signals) if signal in signal_names]
     
         # Set scan buffer and initialize settings
@@ -3701,28 +3573,13 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
         filename_3ds = self.connect.get_next_filename(name, extension='.3ds', folder=folder)
     
         bias_voltage = self.connect.BiasGet().iloc[0, 0]  # Bias (V) as float
-        grid_settings = np.array([cx,cy,1e-9*dim[0],1e-9*dim[1],angle])  # Grid settings as np.array
+        grid_settings = [cx,cy,1e-9*dim[0],1e-9*dim[1],angle]  # Grid settings
         sweep_signal = "Wavelength (nm)"  # Sweep signal as string
         count_write=0
         
-        # Prepare the header
-        start_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S.%f')[:-3]
-        header = f'''End time="{start_time}"
-Start time="{start_time}"
-Delay before measuring (s)=0
-Comment=
-Bias (V)={bias_voltage:.6E}
-Experiment=Experiment
-Date="{start_time.split()[0]}"
-User=
-Grid dim="{pix[0]} x {pix[1]}"
-Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
-'''
-        
-    #    with open(filename_3ds, 'wb') as f:
-            # Write the ASCII header encoded as bytes
-        f = open(filename_3ds, 'wb')
-        f.write(header.encode())
+        # .3ds file written a line at a time
+        grid = nanonis_files.grid3ds_writer(filename_3ds, pix, grid_settings, bias_voltage)
+        line_params = []  # parameters of the pixels of the current line
         try:
             for row in range(pix[1]):
                 for column in range(pix[0]):
@@ -3786,27 +3643,15 @@ Grid settings={";".join([f'{val:.6E}' for val in grid_settings])}
                    # print(row, column)
 # start problematic section
                     if row==0 and column==0:
-                        #with open(filename_3ds, 'ab') as f:
-                            # Write the ASCII header encoded as bytes
                         fixed_parameters = ["Sweep Start", "Sweep End"]+filtered_sigvals_df['Column1'].tolist()
                             #print(fixed_parameters)
-                        header2=f'''Sweep Signal="{sweep_signal}"
-Fixed parameters="{';'.join(fixed_parameters)}"
-Experiment parameters=
-# Parameters (4 byte)={len(fixed_parameters)}
-Experiment size (bytes)=4096
-Points=1024
-Channels=Integer
-'''
-                        f.write(header2.encode())
                         chnames=[str(i) for i in range(1, 1025)]
-                        f.write(('\n'.join(chnames)+"\n").encode())
-                        f.write((':HEADER_END:\n').encode())
-                    res_list=[float(1),float(1024)]+filtered_sigvals_list
+                        grid.experiment(fixed_parameters, 1024, sweep_signal, channels="Integer", extra=chnames)
+                    line_params.append(filtered_sigvals_list)
 
-                    #with open(filename_3ds, 'ab') as f:
-                    np.array(res_list).astype(">f4").tofile(f)
-                    np.arange(len(chnames)).astype(">f4").tofile(f)
+                    if column == pix[0]-1:  # the line in one write
+                        grid.write_line(line_params, np.arange(len(chnames)), (1.0, 1024.0))
+                        line_params = []
                  #   print(row, column,"after")
                     count_write+=time.perf_counter()-swrite
                     sys.stdout.write(f"\rTotal write time {count_write}")
@@ -3820,50 +3665,27 @@ Channels=Integer
             for i in range(len(sigval_ar),int(pix[0]*pix[1])):
                 sigval_ar.append([np.NaN] * num_signals)
         finally:
-            f.close()
+            if line_params:  # the pixels of the interrupted line
+                grid.write_line(line_params, np.arange(len(chnames)), (1.0, 1024.0))
+            grid.close()  # End time, close
             end_time_scan = time.perf_counter()
             elapsed_time_scan = "{:.1f}".format(end_time_scan - start_time_scan)
             filename_sxm = self.connect.get_next_filename(name, extension='.sxm', folder=folder)
     
             nanonis_const = dict(zip(sigvals_df.T.iloc[0], sigvals_df.T.iloc[1].astype(str)))
-            scan_par = {
-                "REC_DATE": datetime.now().strftime('%d.%m.%Y'),
-                "REC_TIME":  datetime.now().strftime('%H:%M:%S'),
-                "ACQ_TIME": str(elapsed_time_scan),
-                "SCAN_PIXELS": f"{pix[0]}\t{pix[1]}",
-                "SCAN_FILE": filename_sxm,
-                "SCAN_TIME": f"{acqtime*pix[0]:.6E}\t{acqtime*pix[0]:.6E}",
-                "SCAN_RANGE": f"{1e-9 * dim[0]:.6E}\t{1e-9 * dim[1]:.6E}",
-                "SCAN_OFFSET": f"{cx:.6E}\t{cy:.6E}",
-                "SCAN_ANGLE": str(angle),
-                "SCAN_DIR": direction
-            }
+            scan_par = self.sxm_scan_par(filename_sxm, (cx, cy, dim, angle), pix, acqtime, direction, acq_time=str(elapsed_time_scan))
             settings_dict = {
                 "BIAS": str(bias_df['Column2'].iloc[0])
             }
             nanonis_chan_names = filtered_sigvals_df['Column1'].tolist()
             
-                        # Define constants
-            scan_dir = 'both'
-            default_value1 = '1.000E+0'
-            default_value2 = '0.000E+0'
-            
-            # Initialize lists to store the final output
-            final_list = []
-            
-            # Process nanonis_chan_names
-            for i, name in enumerate(nanonis_chan_names, start=1):
-                base_name, unit = name.split(' (')
-                unit = unit.strip(')')
-                final_list.append([i, f'{base_name}_avg.', unit, scan_dir, default_value1, default_value2])
+            final_list = self.sxm_channels(nanonis_chan_names)
     
             nanonis_data = np.array(sigval_ar).T
             print("shape",nanonis_data.shape)
     
             # Save the final data to an SXM file
             final_data=self.connect.writesxm(False,filename_sxm,settings_dict, scan_par, final_list, nanonis_data)
-            # update.3ds
-            self.update_end_time(filename_3ds)
             return final_data
     
     
@@ -3888,23 +3710,25 @@ Channels=Integer
     
     #################################### BIAS SPECTROSCOPY ###################################3
     def bias_spectr_par_get(self):
-        bias_par = {'Bias': self.connect.BiasGet(),
-                    'BiasSpectrChs': self.connect.BiasSpectrChsGet(),
-                    'BiasSpectrProps': self.connect.BiasSpectrPropsGet(),
-                    'BiasSpectrAdvProps': self.connect.BiasSpectrAdvPropsGet(),
-                    'BiasSpectrLimits': self.connect.BiasSpectrLimitsGet(),
-                    'BiasSpectrTiming': self.connect.BiasSpectrTimingGet(),
-                   # 'BiasSpectrTTLSync': self.connect.BiasSpectrTTLSyncGet(), #doesnt work with version in lab
-                    'BiasSpectrAltZCtrl': self.connect.BiasSpectrAltZCtrlGet(),
-                    'BiasSpectrMLSLockinPerSeg': self.connect.BiasSpectrMLSLockinPerSegGet(),
-                    'BiasSpectrMLSMode': self.connect.BiasSpectrMLSModeGet(),
-                    'BiasSpectrMLSVals': self.connect.BiasSpectrMLSValsGet(),
-                    'BiasSpectrMore': pd.DataFrame({'Auto save': 'Yes/On', 'Save dialog': 'No/Off', 'Basename' : 'STS_%Y%m%d_'}, index=[0]).T,
-                    'LockInModAmp1': self.connect.LockInModAmpGet(1),
-                    'LockInModFreq1': self.connect.LockInModPhasFreqGet(1),
-                    'LockInOnOff1': self.connect.LockInModOnOffGet(1),
-                    }
-        return bias_par
+        # all Gets are sent in one batch (one round trip)
+        with self.connect.batch() as b:
+            bias_par = {'Bias': b.BiasGet(),
+                        'BiasSpectrChs': b.BiasSpectrChsGet(),
+                        'BiasSpectrProps': b.BiasSpectrPropsGet(),
+                        'BiasSpectrAdvProps': b.BiasSpectrAdvPropsGet(),
+                        'BiasSpectrLimits': b.BiasSpectrLimitsGet(),
+                        'BiasSpectrTiming': b.BiasSpectrTimingGet(),
+                       # 'BiasSpectrTTLSync': b.BiasSpectrTTLSyncGet(), #doesnt work with version in lab
+                        'BiasSpectrAltZCtrl': b.BiasSpectrAltZCtrlGet(),
+                        'BiasSpectrMLSLockinPerSeg': b.BiasSpectrMLSLockinPerSegGet(),
+                        'BiasSpectrMLSMode': b.BiasSpectrMLSModeGet(),
+                        'BiasSpectrMLSVals': b.BiasSpectrMLSValsGet(),
+                        'BiasSpectrMore': pd.DataFrame({'Auto save': 'Yes/On', 'Save dialog': 'No/Off', 'Basename' : 'STS_%Y%m%d_'}, index=[0]).T,
+                        'LockInModAmp1': b.LockInModAmpGet(1),
+                        'LockInModFreq1': b.LockInModPhasFreqGet(1),
+                        'LockInOnOff1': b.LockInModOnOffGet(1),
+                        }
+        return resolved(bias_par)
     
     def bias_spectr_par_save(self, bias_par, fdir, fname = ''):
         with open(fdir + '/' + fname + '.par', 'wb') as handle:
@@ -3987,9 +3811,6 @@ Channels=Integer
             par['BiasSpectrMore'].loc['Save dialog', 0]
         )
     
-        # --- set Bias (V) ---
-        self.connect.BiasSet(*par['Bias'].values)
-    
         # --- check and set BiasSpectr channels ---
         try:
             # get currently active channel configuration
@@ -4007,28 +3828,34 @@ Channels=Integer
         except Exception as e:
             raise ValueError(f"Error parsing BiasSpectrChs from parameter file: {e}")
     
-        # compare and update if needed
-        if curr_idx == new_idx:
-            #print(f"BiasSpectr channels already match → {curr_idx}")
-            pass
-        else:
-            print(f"Updating BiasSpectr channels: {curr_idx} → {new_idx}")
-            self.connect.BiasSpectrChsSet(len(new_idx), new_idx)
-    
-        # --- apply all spectroscopy parameters ---
-        self.connect.BiasSpectrPropsSet(*props)
-        self.connect.BiasSpectrAdvPropsSet(*par['BiasSpectrAdvProps'].values)
-        self.connect.BiasSpectrLimitsSet(*par['BiasSpectrLimits'].values)
-        self.connect.BiasSpectrTimingSet(*par['BiasSpectrTiming'].values)
-        # self.connect.BiasSpectrTTLSyncSet(*par['BiasSpectrTTLSync'].values)
-        self.connect.BiasSpectrAltZCtrlSet(*par['BiasSpectrAltZCtrl'].values)
-        #self.connect.BiasSpectrMLSLockinPerSegSet(*par['BiasSpectrMLSLockinPerSeg'].values)
-        #self.connect.BiasSpectrMLSModeSet(*par['BiasSpectrMLSMode'].values)
-        #self.connect.BiasSpectrMLSValsSet(*par['BiasSpectrMLSVals'].values)
-    
-        # --- Lock-in parameters ---
-        self.connect.LockInModAmpSet(*par['LockInModAmp1'].values)
-        #self.connect.LockInModPhasFreqSet(*par['LockInModFreq1'].values)
+        # all Sets below are sent in one batch (one round trip), Nanonis executes them in order
+        with self.connect.batch() as b:
+            # --- set Bias (V) ---
+            b.BiasSet(*par['Bias'].values)
+
+            # compare and update if needed
+            if curr_idx == new_idx:
+                #print(f"BiasSpectr channels already match → {curr_idx}")
+                pass
+            else:
+                print(f"Updating BiasSpectr channels: {curr_idx} → {new_idx}")
+                b.BiasSpectrChsSet(len(new_idx), new_idx)
+    
+            # --- apply all spectroscopy parameters ---
+            b.BiasSpectrPropsSet(*props)
+            b.BiasSpectrAdvPropsSet(*par['BiasSpectrAdvProps'].values)
+            b.BiasSpectrLimitsSet(*par['BiasSpectrLimits'].values)
+            b.BiasSpectrTimingSet(*par['BiasSpectrTiming'].values)
+            # b.BiasSpectrTTLSyncSet(*par['BiasSpectrTTLSync'].values)
+            b.BiasSpectrAltZCtrlSet(*par['BiasSpectrAltZCtrl'].values)
+            #b.BiasSpectrMLSLockinPerSegSet(*par['BiasSpectrMLSLockinPerSeg'].values)
+            #b.BiasSpectrMLSModeSet(*par['BiasSpectrMLSMode'].values)
+            #b.BiasSpectrMLSValsSet(*par['BiasSpectrMLSVals'].values)
+    
+            # --- Lock-in parameters ---
+            b.LockInModAmpSet(*par['LockInModAmp1'].values)
+            #b.LockInModPhasFreqSet(*par['LockInModFreq1'].values)
+        b.results() # raise if one of the Sets failed
     
         # --- optional measurement run ---
         if run:
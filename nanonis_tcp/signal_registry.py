@@ -0,0 +1,180 @@
+# -*- encoding: utf-8 -*-
+'''
+Signal names and slots of a Nanonis controller, asked for once and cached.
+
+    connect.signals.index['Bias (V)']        # signal index of a name, a dict lookup
+    connect.signals.names                    # names of all signals (Signals.NamesGet)
+    connect.signals.slot_names               # names of the signals in the slots (Signals.InSlotsGet)
+    connect.signals.refresh()                # ask Nanonis again (e.g. after changes made in Nanonis itself)
+
+One registry per controller (IP address and version), shared by all its connections.
+SignalsInSlotSet drops the cached lists of its controller.
+
+The names can also be kept between sessions in a JSON file (opt-in), keyed by the controller's
+IP address and RT engine release (UtilVersionGet), so they are not reused after an update:
+
+    signal_registry.cache_path = signal_registry.home_cache_path   # before the first use
+
+The slots are not kept in the file: they are asked once per session, as they may have been
+changed in Nanonis in the meantime.
+'''
+############################### packages ######################################
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+home_cache_path = os.path.join(os.path.expanduser('~'), '.nanonis_tcp', 'signals.json')
+cache_path = None # JSON file the names are kept in between sessions (e.g. home_cache_path), None: only in memory
+persisted = ('names',) # fields kept in the file
+
+registries = {} # (IP address, version) -> signal_registry
+registries_lock = threading.Lock()
+
+class signal_registry:
+    def __init__(self, key, cache_path = None):
+        """
+       Parameters
+       key             : (IP address, version) of the controller
+       cache_path      : JSON file the names are kept in between sessions, None: only in memory
+       """
+        self.key = key
+        self.cache_key = None # IP address and RT engine release, asked for on first use of the file
+        self.cache_path = cache_path
+        self.ctrl = None   # nanonis_ctrl used to ask Nanonis, the last one that asked for the registry
+        self.lock = threading.RLock()
+        self.entry = None  # {'names': [...], 'slot_names': [...], 'slot_indexes': [...]}, lists asked for so far
+        self.derived = {} # lookups and DataFrames built from entry
+
+    ############################### cache #####################################
+    def cache_key_get(self):
+        if self.cache_key is None:
+            res_arg = self.ctrl.raw().UtilVersionGet(prt = False)
+            self.cache_key = f'{self.key[0]} {int(res_arg[5])}'
+        return self.cache_key
+
+    def cache_read(self):
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding = 'utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def cache_write(self):
+        if self.cache_path is None:
+            return
+        try:
+            cache = self.cache_read()
+            kept = {field: self.entry[field] for field in persisted if field in self.entry}
+            if kept:
+                cache[self.cache_key_get()] = kept
+            else:
+                cache.pop(self.cache_key_get(), None)
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok = True)
+            tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding = 'utf-8') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f'Signal cache {self.cache_path} not written: {e}')
+
+    def entry_get(self, field):
+        with self.lock:
+            if self.entry is None:
+                self.entry = dict(self.cache_read().get(self.cache_key_get(), {})) if self.cache_path is not None else {}
+            if field not in self.entry:
+                self.fetch(field)
+            return self.entry[field]
+
+    def fetch(self, field):
+        if field == 'names':
+            res_arg = self.ctrl.raw().SignalsNamesGet(prt = False)
+            self.entry['names'] = [str(name) for name in np.ravel(res_arg[2])]
+        else:
+            res_arg = self.ctrl.raw().SignalsInSlotsGet(prt = False)
+            self.entry['slot_names'] = [str(name) for name in np.ravel(res_arg[2])]
+            self.entry['slot_indexes'] = [int(idx) for idx in np.ravel(res_arg[4])]
+        self.derived.clear()
+        if field in persisted:
+            self.cache_write()
+
+    def refresh(self):
+        '''drop the cached lists, they are asked for again on next use (and replace those in the file)'''
+        with self.lock:
+            self.entry = {} # not None: the file is not read again
+            self.derived.clear()
+
+    ############################### lookups ###################################
+    @property
+    def names(self):
+        return self.entry_get('names')
+
+    @property
+    def index(self):
+        '''signal name -> signal index (the first one for duplicate names)'''
+        return self.lookup('index', 'names')
+
+    @property
+    def slot_names(self):
+        return self.entry_get('slot_names')
+
+    @property
+    def slot_indexes(self):
+        '''signal index of every slot'''
+        return self.entry_get('slot_indexes')
+
+    @property
+    def slot_index(self):
+        '''signal name -> slot'''
+        return self.lookup('slot_index', 'slot_names')
+
+    def lookup(self, name, field):
+        lookup = self.derived.get(name)
+        if lookup is None:
+            values = self.entry_get(field)
+            lookup = {}
+            for idx, value in enumerate(values):
+                lookup.setdefault(value, idx)
+            self.derived[name] = lookup
+        return lookup
+
+    @property
+    def names_df(self):
+        '''as SignalsNamesGet returns it. Shared: copy it before modifying it'''
+        df = self.derived.get('names_df')
+        if df is None:
+            df = self.derived['names_df'] = pd.DataFrame({'Signal names': self.names})
+        return df
+
+    @property
+    def slots_df(self):
+        '''as SignalsInSlotsGet returns it. Shared: copy it before modifying it'''
+        df = self.derived.get('slots_df')
+        if df is None:
+            df = self.derived['slots_df'] = pd.DataFrame({'Signal names': self.slot_names, 'Signal indexes': self.slot_indexes})
+        return df
+
+def registry_get(ctrl):
+    '''signal_registry of the controller ctrl is connected to'''
+    key = (ctrl.tcp.server_addr[0], ctrl.version)
+    with registries_lock:
+        registry = registries.get(key)
+        if registry is None:
+            registry = registries[key] = signal_registry(key, cache_path)
+        registry.ctrl = ctrl
+    return registry
+
+def slots_changed(ctrl):
+    '''
+    the slots of ctrl's controller were changed: drop its cached lists (in old versions NamesGet lists the slots).
+    ctrl may be a batched or replayed copy (see tcp_raw), so it is not kept as the registry's connection.
+    '''
+    key = (ctrl.tcp.server_addr[0], ctrl.version)
+    with registries_lock:
+        registry = registries.get(key)
+        if registry is None:
+            registry = registries[key] = signal_registry(key, cache_path)
+    registry.refresh()
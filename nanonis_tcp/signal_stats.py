@@ -0,0 +1,92 @@
+# -*- encoding: utf-8 -*-
+'''
+Running statistics of polled Nanonis signals: mean, standard deviation, min and max per
+channel, number of samples and their first and last time, in constant memory.
+
+    stats = signal_stats(len(indexes), names)
+    while acquiring:
+        stats.add(connect.raw().SignalsValsGet(indexes, 1)[1])   # decoded values, no DataFrame
+    stats.mean, stats.std                                       # per channel, ready right away
+    stats.df                                                    # Mean, Std, Min, Max, Samples per signal
+
+The mean and variance are updated per sample (Welford), so nothing but the running sums is
+kept however long the exposure. NaN values are skipped per channel (as np.nanmean does).
+Sample times are time.monotonic(), as signal_streamer gives them: intervals and rates, not
+wall-clock times.
+'''
+############################### packages ######################################
+import time
+import numpy as np
+import pandas as pd
+
+class signal_stats:
+    def __init__(self, channels, names = None):
+        """
+       Parameters
+       channels        : number of values per sample
+       names           : signal names of the channels (index of df), default 0, 1, ...
+       """
+        self.names = list(range(channels)) if names is None else list(names)
+        self.reset(channels)
+
+    def reset(self, channels = None):
+        '''forget all samples'''
+        channels = len(self.names) if channels is None else channels
+        self.count = np.zeros(channels, np.int64)   # samples per channel (NaN not counted)
+        self._mean = np.zeros(channels)
+        self._m2 = np.zeros(channels)               # sum of squared deviations from the mean
+        self._min = np.full(channels, np.inf)
+        self._max = np.full(channels, -np.inf)
+        self.samples = 0                            # samples added
+        self.t_first = self.t_last = None           # time.monotonic() of the first and the last sample
+
+    def add(self, values, t = None):
+        '''one sample: a value per channel (t: its time.monotonic(), default now)'''
+        x = np.atleast_1d(values).astype(float)
+        ok = ~np.isnan(x)
+        self.count += ok
+        delta = np.where(ok, x - self._mean, 0.)
+        self._mean += delta/np.maximum(self.count, 1)
+        self._m2 += delta*np.where(ok, x - self._mean, 0.)
+        np.fmin(self._min, x, out = self._min)
+        np.fmax(self._max, x, out = self._max)
+        t = time.monotonic() if t is None else t
+        if self.t_first is None:
+            self.t_first = t
+        self.t_last = t
+        self.samples += 1
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def var(self):
+        '''sample variance (ddof = 1), NaN for channels with less than 2 samples'''
+        return np.where(self.count > 1, self._m2/np.maximum(self.count - 1, 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def min(self):
+        return np.where(self.count > 0, self._min, np.nan)
+
+    @property
+    def max(self):
+        return np.where(self.count > 0, self._max, np.nan)
+
+    @property
+    def rate(self):
+        '''samples per second'''
+        if self.samples < 2 or self.t_last == self.t_first:
+            return np.nan
+        return (self.samples - 1)/(self.t_last - self.t_first)
+
+    @property
+    def df(self):
+        stats_df = pd.DataFrame({'Mean': self.mean, 'Std': self.std, 'Min': self.min, 'Max': self.max, 'Samples': self.count},
+                                index = self.names)
+        stats_df.index.name = 'Signal names'
+        return stats_df
@@ -0,0 +1,175 @@
+# -*- encoding: utf-8 -*-
+'''
+Samples a set of Nanonis signals (Signals.ValsGet) at a fixed rate or as fast as possible, into
+a ring buffer with monotonic timestamps.
+
+    with signal_streamer(connect, [0, 3, 30], rate = 200) as streamer:   # sampling thread runs in the block
+        streamer.subscribe(stats.add)             # callback(values, t) for every sample, in the sampling thread
+        for t, values in streamer.stream():       # generator: the samples as they come, until stopped
+            ...
+        times, values = streamer.snapshot(100)    # copies of the newest 100 samples
+    streamer.rate_achieved, streamer.dropped      # samples per second, deadlines missed
+
+    streamer.run(until = event, duration = 10)    # or sample in the calling thread
+
+connect is used by the sampling loop only while it runs: give it a connection of its own
+(photon_meas.worker_connect, tcp_pool) when other threads use theirs meanwhile. A context
+manager giving a nanonis_ctrl (e.g. photon_meas.worker_connect()) is entered for the run.
+
+With a rate, the samples are taken at t0 + k/rate. A sample that cannot be taken before its
+next deadline (the reply came too late) skips the missed slots, which are counted in dropped.
+'''
+############################### packages ######################################
+import threading
+import time
+import numpy as np
+
+class signal_streamer:
+    def __init__(self, connect, indexes, rate = None, size = 4096, wait = 1, names = None):
+        """
+       Parameters
+       connect         : nanonis_ctrl, or a context manager giving one
+       indexes         : signal indexes to sample (Signals.ValsGet)
+       rate            : samples per second, None: as fast as the replies come
+       size            : samples kept in the ring buffer
+       wait            : wait for the newest values (Signals.ValsGet wait_for_newest)
+       names           : names of the channels
+       """
+        self.connect = connect
+        self.indexes = np.atleast_1d(np.asarray(indexes, dtype = int))
+        self.rate = rate
+        self.size = size
+        self.wait = wait
+        self.names = list(self.indexes) if names is None else list(names)
+        self.times = np.full(size, np.nan)                          # time.monotonic() of the samples
+        self.values = np.full((size, len(self.indexes)), np.nan)    # ring buffer: sample n is at row n % size
+        self.written = 0                                            # samples taken since the start
+        self.dropped = 0                                            # sampling deadlines missed
+        self.t_start = self.t_last = None
+        self.running = False
+        self.callbacks = []
+        self.cond = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    ############################### subscribers ###############################
+    def subscribe(self, callback):
+        '''callback(values, t) for every sample, called in the sampling thread (keep it short)'''
+        self.callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+    def snapshot(self, num = None):
+        '''(times, values): copies of the newest num samples in the buffer (all when None)'''
+        with self.cond:
+            num = min(self.written, self.size) if num is None else min(num, self.written, self.size)
+            rows = np.arange(self.written - num, self.written) % self.size
+            return self.times[rows], self.values[rows]
+
+    def stream(self, since = None, timeout = None):
+        '''
+        generator of (t, values) from sample number since (default: the next one) until the streamer
+        stops or no sample comes within timeout (s). Samples overwritten before they were read are skipped.
+        '''
+        n = self.written if since is None else since
+        while True:
+            with self.cond:
+                while n >= self.written and self.running:
+                    if not self.cond.wait(timeout) and timeout is not None:
+                        return
+                if n >= self.written: # stopped
+                    return
+                n = max(n, self.written - self.size)
+                row = n % self.size
+                item = self.times[row], self.values[row].copy()
+            n += 1
+            yield item
+
+    ############################### counters ##################################
+    @property
+    def rate_achieved(self):
+        '''samples per second since the start'''
+        if self.written < 2 or self.t_last == self.t_start:
+            return np.nan
+        return (self.written - 1)/(self.t_last - self.t_start)
+
+    ############################### sampling ##################################
+    def start(self):
+        '''sample in a thread of its own until stop()'''
+        self.stop_event.clear()
+        self.running = True
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self, until = None, duration = None):
+        '''sample in the calling thread until stop(), the event until is set, or duration (s) has passed'''
+        self.stop_event.clear()
+        self.running = True
+        events = [event for event in (self.stop_event, until) if event is not None]
+        connect = self.connect
+        manager = None if hasattr(connect, 'SignalsValsGet') else connect
+        if manager is not None:
+            connect = manager.__enter__()
+        try:
+            with connect.raw(): # decoded values, no DataFrame per sample
+                self.sample_loop(connect, events, duration)
+        finally:
+            if manager is not None:
+                manager.__exit__(None, None, None)
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+
+    def sample_loop(self, connect, events, duration):
+        indexes, wait = self.indexes, self.wait
+        period = None if not self.rate else 1/self.rate
+        t0 = self.t_start = time.monotonic()
+        t_end = None if duration is None else t0 + duration
+        slot = 0
+        while not any(event.is_set() for event in events):
+            if t_end is not None and time.monotonic() >= t_end:
+                break
+            values = np.atleast_1d(connect.SignalsValsGet(indexes, wait)[1])
+            t = time.monotonic()
+            if len(values) != len(indexes): # error reply (printed by tcp_ctrl)
+                print("Signal streaming stopped: Signals.ValsGet failed.")
+                break
+            with self.cond:
+                row = self.written % self.size
+                self.times[row] = t
+                self.values[row] = values
+                self.written += 1
+                self.t_last = t
+                self.cond.notify_all()
+            for callback in list(self.callbacks):
+                try:
+                    callback(values, t)
+                except Exception as e:
+                    print(f"Callback {callback} failed, unsubscribed: {e}")
+                    self.unsubscribe(callback)
+            if period is not None:
+                slot += 1
+                now = time.monotonic()
+                if now > t0 + (slot + 1)*period: # the reply came after the next deadline: skip the missed slots
+                    missed = int((now - t0)/period) - slot
+                    self.dropped += missed
+                    slot += missed
+                delay = t0 + slot*period - time.monotonic()
+                if delay > 0:
+                    self.stop_event.wait(delay)
@@ -25,6 +25,10 @@ class tcp_andor_ctrl:
         self.sk.connect(self.server_addr)
         self.buffersize = buffersize
         self.termination_char = termination_char
+        # receive buffer of recv_line: bytes rx_start:rx_end are received but not returned yet,
+        # rx_start:rx_scan of them searched for the termination character already
+        self.rx = bytearray(buffersize)
+        self.rx_start = self.rx_end = self.rx_scan = 0
 
     # close socket
     def socket_close(self):
@@ -34,27 +38,81 @@ class tcp_andor_ctrl:
         self.sk.sendall((data+self.termination_char).encode('utf-8'))
         
     def res_recv(self):  
+        if self.rx_end > self.rx_start: # received by recv_line after its line
+            data = bytes(self.rx[self.rx_start:self.rx_end])
+            self.rx_start = self.rx_end = self.rx_scan = 0
+            return data
         return(self.sk.recv(self.buffersize))
     
-    
-    def recv_until(self,termination_char='\n'):
-        """Read from the socket until the termination character is found."""
-        data = []
+    def recv_line(self):
+        """
+        Read from the socket until the termination character, return the bytes up to and including it.
+        Bytes received after it are kept for the next reply. Everything goes into one buffer (recv_into),
+        which grows for longer replies, and only the new bytes are searched for the termination character.
+        """
+        term = self.termination_char.encode('utf-8')
         while True:
-            chunk = self.sk.recv(self.buffersize)
-            if not chunk:
-                # No more data from socket, connection may be closed
+            idx = self.rx.find(term, max(self.rx_start, self.rx_scan - len(term) + 1), self.rx_end)
+            if idx >= 0:
+                end = idx + len(term)
                 break
-            data.append(chunk.decode('utf-8'))
-            if self.termination_char in chunk.decode('utf-8'):
-                # Stop reading once the termination character is found
+            self.rx_scan = self.rx_end
+            if self.rx_end == len(self.rx): # full: move the pending bytes to the start, grow if there is no room
+                pending = self.rx_end - self.rx_start
+                if self.rx_start:
+                    self.rx[:pending] = self.rx[self.rx_start:self.rx_end]
+                if pending == len(self.rx):
+                    self.rx.extend(bytes(len(self.rx)))
+                self.rx_start, self.rx_end, self.rx_scan = 0, pending, pending
+            n = self.sk.recv_into(memoryview(self.rx)[self.rx_end:])
+            if not n:
+                # No more data from socket, connection may be closed
+                end = self.rx_end
                 break
-        return ''.join(data)
+            self.rx_end += n
+        line = bytes(self.rx[self.rx_start:end])
+        self.rx_start = self.rx_scan = end
+        if self.rx_start == self.rx_end:
+            self.rx_start = self.rx_end = self.rx_scan = 0
+        return line
+
+    def recv_exact(self, size):
+        """
+        size bytes as a new bytearray: first the bytes recv_line received after its line,
+        the rest is received into the bytearray directly.
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = min(size, self.rx_end - self.rx_start)
+        view[:received] = self.rx[self.rx_start:self.rx_start + received]
+        self.rx_start = self.rx_scan = self.rx_start + received
+        if self.rx_start == self.rx_end:
+            self.rx_start = self.rx_end = self.rx_scan = 0
+        while received < size:
+            n = self.sk.recv_into(view[received:])
+            if not n:
+                raise ConnectionError('The Andor server closed the connection while sending a binary reply.')
+            received += n
+        return buf
+
+    def recv_block(self, dtype):
+        """
+        One block of a binary reply: the number of values (uint32, little-endian), then the values.
+        Returns a NumPy array of dtype on the received bytes (no copy, no conversion).
+        """
+        dtype = np.dtype(dtype)
+        count = st.unpack('<I', self.recv_exact(4))[0]
+        return np.frombuffer(self.recv_exact(count * dtype.itemsize), dtype)
+
+    def recv_until(self,termination_char='\n'):
+        """Read from the socket until the termination character (of the connection) is found, see recv_line."""
+        return self.recv_line().decode('utf-8')
 
     
     def clear_socket_buffer(self):
         """Clear the receive buffer of the given socket."""
     # Set a small timeout to avoid blocking indefinitely
+        self.rx_start = self.rx_end = self.rx_scan = 0
         self.sk.settimeout(1.0)
     
         try:
@@ -63,7 +121,7 @@ class tcp_andor_ctrl:
                 data = self.sk.recv(1024)
                 if not data:
                     break  # If no data is received, the buffer is clear
-        except self.sk.timeout:
+        except socket.timeout:
             pass  # Timeout means no more data is available
         finally:
             # Reset the socket timeout to the original setting (e.g., 10 seconds)
@@ -0,0 +1,243 @@
+# -*- encoding: utf-8 -*-
+'''
+asyncio clients for Nanonis and the Andor spectrometer server.
+
+    nc = await nanonis_async.open('127.0.0.1', 6501)
+    bias = await nc.BiasGet()                                  # same DataFrame as nanonis_ctrl.BiasGet
+    frame, vals = await asyncio.gather(nc.ScanFrameGet(), nc.SignalsValsGet([0, 1], 1))
+
+    andor = await andor_async.open('localhost', 8888)
+    spectrum = await andor.acquisition_set()
+
+Every method of nanonis_ctrl (andor_meas) is available as a coroutine. The methods are not
+rewritten: as in tcp_batch, a method runs against a stand-in for the connection that records
+the requests it sends and stops where it waits for a reply. The requests are written, the
+replies awaited, and the method runs again with the replies it needs (once per round trip).
+Requests of concurrent commands on one connection are pipelined: replies are matched to
+commands in the order the requests were written, which is the order Nanonis answers in.
+'''
+############################### packages ######################################
+import asyncio
+import copy
+import struct as st
+from collections import deque
+from contextlib import nullcontext
+
+from .tcp_ctrl import tcp_ctrl
+from .nanonis_ctrl import nanonis_ctrl
+from .andor_meas import andor_meas
+from .tcp_batch import request_captured, replies_expected
+from .log_utils import logging_suppressed
+
+############################### connections ###################################
+class async_stream:
+    '''
+    one asyncio connection: requests are written in order, replies handed out in the same order.
+    Subclasses read one reply (reply_read) and count the replies of a list of requests (replies_expected).
+    '''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.waiters = deque()    # futures of the replies not read yet
+        self.reader_task = None
+
+    def send(self, data, replies):
+        '''write data and return one future per expected reply'''
+        self.writer.write(data)
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in range(replies)]
+        self.waiters.extend(futures)
+        if futures and self.reader_task is None:
+            self.reader_task = loop.create_task(self.replies_read())
+        return futures
+
+    async def replies_read(self):
+        try:
+            while self.waiters:
+                reply = await self.reply_read()
+                waiter = self.waiters.popleft()
+                if not waiter.cancelled():
+                    waiter.set_result(reply)
+        except Exception as e:
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if not waiter.cancelled():
+                    waiter.set_exception(e)
+        finally:
+            self.reader_task = None
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+class tcp_async(async_stream):
+    '''Nanonis TCP protocol over asyncio. codec is a tcp_ctrl without socket used for encoding and decoding'''
+    def __init__(self, reader, writer, version = 999999):
+        super().__init__(reader, writer)
+        self.codec = tcp_ctrl(version = version, connect = False)
+
+    @classmethod
+    async def open(cls, TCP_IP = '127.0.0.1', PORT = 6501, version = 999999):
+        reader, writer = await asyncio.open_connection(TCP_IP, PORT)
+        return cls(reader, writer, version)
+
+    async def reply_read(self):
+        frame = bytearray(await self.reader.readexactly(40))
+        body_size = st.unpack_from('>i', frame, 32)[0]
+        frame += await self.reader.readexactly(body_size)
+        return frame
+
+    @staticmethod
+    def replies_expected(requests):
+        return replies_expected(b''.join(requests))
+
+class tcp_andor_async(async_stream):
+    '''line based protocol of the Andor server (see tcp_andor_ctrl) over asyncio'''
+    def __init__(self, reader, writer, termination_char = '\n'):
+        super().__init__(reader, writer)
+        self.termination_char = termination_char
+
+    @classmethod
+    async def open(cls, TCP_IP = 'localhost', PORT = 8888, termination_char = '\n'):
+        reader, writer = await asyncio.open_connection(TCP_IP, PORT, limit = 64*1024*1024) # spectra come as one long line
+        return cls(reader, writer, termination_char)
+
+    async def reply_read(self):
+        line = await self.reader.readuntil(self.termination_char.encode('utf-8'))
+        return line.decode('utf-8')
+
+    @staticmethod
+    def replies_expected(requests):
+        return len(requests) # one reply line per command
+
+############################### stand-ins #####################################
+class command_script:
+    '''stands in for the connection while a command runs: records the requests and answers with the replies received so far'''
+    def __init__(self, replies):
+        self.replies = replies
+        self.reply_idx = 0
+        self.requests = []
+
+    def reply_next(self):
+        if self.reply_idx == len(self.replies):
+            raise request_captured()
+        self.reply_idx += 1
+        return self.replies[self.reply_idx - 1]
+
+class nanonis_script(command_script):
+    def __init__(self, stream, replies):
+        super().__init__(replies)
+        self.tcp = stream.codec
+
+    def __getattr__(self, name):
+        return getattr(self.tcp, name)
+
+    def cmd_send(self, data):
+        self.requests.append(bytes(data))
+
+    def frame_recv(self):
+        return self.reply_next()
+
+    res_recv = tcp_ctrl.res_recv
+    res_recv_MarksPointsGet = tcp_ctrl.res_recv_MarksPointsGet
+
+class andor_script(command_script):
+    def __init__(self, stream, replies):
+        super().__init__(replies)
+        self.termination_char = stream.termination_char
+
+    def cmd_send(self, data):
+        self.requests.append((data + self.termination_char).encode('utf-8'))
+
+    def recv_until(self, termination_char = '\n'):
+        return self.reply_next()
+
+    def res_recv(self):
+        return self.reply_next().encode('utf-8')
+
+async def command_run(stream, script_cls, method, obj, args, kwargs):
+    '''run obj.method(*args, **kwargs) with its requests and replies going through stream'''
+    obj = copy.copy(obj) # concurrent commands must not share the stand-in
+    replies, sent, first = [], 0, True
+    while True:
+        script = script_cls(stream, replies)
+        obj.tcp = script
+        done = False
+        try:
+            with nullcontext() if first else logging_suppressed(): # log each command once
+                result = method(obj, *args, **kwargs)
+            done = True
+        except request_captured:
+            pass
+        first = False
+
+        requests, sent = script.requests[sent:], len(script.requests)
+        futures = stream.send(b''.join(requests), stream.replies_expected(requests)) if requests else []
+        await stream.writer.drain()
+        if done:
+            for future in futures: # replies the method did not read, keep the connection in sync
+                await future
+            return result
+        if not futures:
+            raise RuntimeError(f'{method.__name__} waits for a reply but sent no request.')
+        for future in futures:
+            replies.append(await future)
+
+############################### clients #######################################
+class command_proxy:
+    '''methods of ctrl_cls as coroutines'''
+    ctrl_cls = None
+    script_cls = None
+
+    def __getattr__(self, name):
+        method = getattr(self.ctrl_cls, name)
+        if not callable(method):
+            return getattr(self.ctrl, name)
+        async def command(*args, **kwargs):
+            return await command_run(self.tcp, self.script_cls, method, self.ctrl, args, kwargs)
+        command.__name__ = name
+        command.__doc__ = method.__doc__
+        return command
+
+    async def close(self):
+        await self.tcp.close()
+
+class nanonis_async(command_proxy):
+    '''awaitable nanonis_ctrl commands on one tcp_async connection'''
+    ctrl_cls = nanonis_ctrl
+    script_cls = nanonis_script
+
+    def __init__(self, tcp, PLL_modulator_index = 1):
+        self.tcp = tcp
+        # nanonis_ctrl.__init__ would have the logger start with a blocking UtilSessionPathGet
+        # on the codec (no socket), set its attributes directly
+        self.ctrl = nanonis_ctrl.__new__(nanonis_ctrl)
+        self.ctrl.tcp = tcp.codec
+        self.ctrl.mod_index = PLL_modulator_index
+        self.ctrl.version = tcp.codec.version
+
+    @classmethod
+    async def open(cls, TCP_IP = '127.0.0.1', PORT = 6501, version = 999999, PLL_modulator_index = 1):
+        return cls(await tcp_async.open(TCP_IP, PORT, version), PLL_modulator_index)
+
+class andor_async(command_proxy):
+    '''
+    awaitable andor_meas commands on one tcp_andor_async connection. Only the text replies:
+    the binary spectrum replies (binary_enable, kinser_data_get) need tcp_andor_ctrl.
+    '''
+    ctrl_cls = andor_meas
+    script_cls = andor_script
+    binary_commands = ('binary_enable', 'kinser_data_get')
+
+    def __init__(self, tcp):
+        self.tcp = tcp
+        self.ctrl = andor_meas.__new__(andor_meas)
+
+    def __getattr__(self, name):
+        if name in self.binary_commands: # not available here, as if andor_meas did not have them
+            raise AttributeError(f"'andor_async' object has no attribute {name!r} (binary replies: use tcp_andor_ctrl)")
+        return super().__getattr__(name)
+
+    @classmethod
+    async def open(cls, TCP_IP = 'localhost', PORT = 8888, termination_char = '\n'):
+        return cls(await tcp_andor_async.open(TCP_IP, PORT, termination_char))
@@ -0,0 +1,259 @@
+# -*- encoding: utf-8 -*-
+'''
+Batched (pipelined) and no-reply execution of nanonis_ctrl methods.
+
+    with connect.batch() as b:
+        bias = b.BiasGet()
+        frame = b.ScanFrameGet()
+    bias.result(), frame.result()
+
+Inside the with block a call only encodes its request and returns a deferred result.
+When the block ends all requests are written with one sendall and the replies are
+read back in order, so N independent Get/Set calls cost about one round trip instead of N.
+
+How it works: the method is run once with a capturing stand-in for tcp_ctrl, which
+records what the method sends and stops it at its first res_recv. After sending, the
+method is run again with a replaying stand-in whose cmd_send skips the requests that were
+already sent and whose res_recv returns the next reply. The stand-ins are set on a copy of
+the nanonis_ctrl, so other threads calling the same nanonis_ctrl meanwhile are not affected. Methods that need more than one
+round trip (a second request depending on the first reply) still work: their extra
+requests are sent when the replay reaches them.
+
+    with connect.no_reply():
+        connect.BiasSet(0.1)
+    connect.no_reply().BiasSet(0.1)
+
+In no-reply mode commands without return arguments are sent with "send response back" = 0
+and do not wait for Nanonis at all (see tcp_ctrl.cmd_send).
+'''
+############################### packages ######################################
+import copy
+from collections import deque
+import struct as st
+
+from .tcp_ctrl import tcp_ctrl
+from .log_utils import logging_suppressed
+
+class request_captured(BaseException):
+    '''raised by tcp_capture.res_recv to stop a method once its request is encoded (not an Exception, so the method's own except clauses do not catch it)'''
+
+class deferred:
+    '''result of a batched call. Available once the batch has been sent'''
+    def __init__(self, name):
+        self.name = name
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value, self.done = value, True
+
+    def set_error(self, error):
+        self.error, self.done = error, True
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError(f'{self.name} has not been sent yet. Leave the batch context (or call flush()) first.')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __repr__(self):
+        state = 'error' if self.error is not None else 'done' if self.done else 'pending'
+        return f'<deferred {self.name}: {state}>'
+
+def resolved(values):
+    '''replace the deferred results in a dict or list by their values'''
+    if isinstance(values, dict):
+        return {key: resolved(value) for key, value in values.items()}
+    if isinstance(values, list):
+        return [resolved(value) for value in values]
+    return values.result() if isinstance(values, deferred) else values
+
+def replies_expected(data):
+    '''number of messages in data with the "send response back" flag set'''
+    offset, replies = 0, 0
+    while offset + 40 <= len(data):
+        body_size, res = st.unpack_from('>iH', data, offset + 32)
+        replies += res != 0
+        offset += 40 + body_size
+    return replies
+
+############################### tcp stand-ins #################################
+class tcp_capture:
+    '''stands in for tcp_ctrl while a method encodes its request: nothing is sent or received'''
+    def __init__(self, tcp):
+        self.tcp = tcp
+        self.requests = []
+
+    def __getattr__(self, name):
+        return getattr(self.tcp, name)
+
+    def cmd_send(self, data):
+        self.requests.append(bytes(data)) # cmd_encode reuses its buffer
+
+    def res_recv(self, *varg_fmt, **kwargs):
+        raise request_captured()
+
+    res_recv_MarksPointsGet = res_recv
+
+class tcp_replay:
+    '''stands in for tcp_ctrl while a batched method runs again to decode its reply'''
+    def __init__(self, tcp, batch, call):
+        self.tcp = tcp
+        self.batch = batch
+        self.call = call
+
+    def __getattr__(self, name):
+        return getattr(self.tcp, name)
+
+    def cmd_send(self, data):
+        if self.call.sends:
+            self.call.sends -= 1 # already sent with the batch
+        else:
+            self.batch.drain()
+            self.tcp.cmd_send(data)
+
+    def frame_recv(self):
+        if self.call.replies:
+            self.call.replies -= 1
+            return self.batch.frame_next()
+        return self.tcp.frame_recv()
+
+    res_recv = tcp_ctrl.res_recv
+    res_recv_MarksPointsGet = tcp_ctrl.res_recv_MarksPointsGet
+
+############################### batch #########################################
+class batch_call:
+    def __init__(self, name, method, args, kwargs):
+        self.name, self.method, self.args, self.kwargs = name, method, args, kwargs
+        self.result = deferred(name)
+        self.requests = []
+        self.sends = 0
+        self.replies = 0
+        self.replay = False
+
+class batch:
+    '''
+    Queue nanonis_ctrl calls and send them together. Use as a context manager or call flush().
+       - calls are made as methods of the batch: b.BiasGet(), b.BiasSet(0.1), ...
+       - each call returns a deferred; deferred.result() gives the method's return value
+         (or raises its exception) after the batch has been sent
+       - arguments are checked when the call is queued, eg. BiasSet(20) raises right away
+    '''
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.tcp = None        # tcp_ctrl the batch is sent with
+        self.calls = []
+        self.flushed = []      # deferred results of the last flush
+        self.backlog = deque() # replies read ahead of their call (see drain)
+        self.unread = 0        # replies of the sent batch still in the socket
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def __getattr__(self, name):
+        attr = getattr(self.ctrl, name)
+        if not callable(attr):
+            return attr
+        method = getattr(type(self.ctrl), name) # run on a copy of ctrl, see with_tcp
+        def queue_call(*args, **kwargs):
+            return self.queue(name, method, args, kwargs)
+        return queue_call
+
+    def with_tcp(self, tcp):
+        '''copy of ctrl using the stand-in tcp (the shared ctrl keeps its connection)'''
+        ctrl = copy.copy(self.ctrl)
+        ctrl.tcp = tcp
+        return ctrl
+
+    def queue(self, name, method, args, kwargs):
+        call = batch_call(name, method, args, kwargs)
+        capture = tcp_capture(self.ctrl.tcp)
+        try:
+            call.result.set_result(method(self.with_tcp(capture), *args, **kwargs)) # finished without waiting for a reply
+        except request_captured:
+            call.replay = True
+        call.requests = capture.requests
+        call.sends = len(capture.requests)
+        call.replies = replies_expected(b''.join(capture.requests))
+        self.calls.append(call)
+        return call.result
+
+    def results(self):
+        '''values of all calls of the last flush, in order. Raises the first exception of a call'''
+        return [result.result() for result in self.flushed]
+
+    def frame_next(self):
+        if self.backlog:
+            return self.backlog.popleft()
+        self.unread -= 1
+        return self.tcp.frame_recv()
+
+    # read all remaining replies of the batch, so that a request sent now gets the next reply
+    def drain(self):
+        while self.unread:
+            self.backlog.append(bytearray(self.tcp.frame_recv()))
+            self.unread -= 1
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        self.flushed = [call.result for call in calls]
+        if not calls:
+            return
+        tcp = self.tcp = self.ctrl.tcp
+        tcp.cmd_send(b''.join(request for call in calls for request in call.requests))
+        if tcp.pending: # no-reply mode: send now, the batch waits for the replies
+            tcp.pending_send()
+        self.unread = sum(call.replies for call in calls)
+
+        for call in calls:
+            if call.replay:
+                try:
+                    with logging_suppressed(): # logged when queued
+                        call.result.set_result(call.method(self.with_tcp(tcp_replay(tcp, self, call)), *call.args, **call.kwargs))
+                except Exception as e:
+                    call.result.set_error(e)
+            while call.replies: # keep the socket in sync if the method did not read its reply
+                call.replies -= 1
+                self.frame_next()
+        self.backlog.clear()
+
+############################### no reply ######################################
+class no_reply:
+    '''
+    Send commands without return arguments (setters) with "send response back" = 0.
+       - per context: with connect.no_reply(): ...
+       - per call:    connect.no_reply().BiasSet(0.1)
+    Getters in the block are sent and read as usual, so the connection stays in sync.
+    The mode applies to the calling thread only (tcp_ctrl.no_reply is per thread).
+    Nanonis does not report errors of the commands sent without reply: they return
+    tcp_ctrl.no_error_df and the method's input values.
+    '''
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __enter__(self):
+        self.ctrl.tcp.no_reply += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        tcp = self.ctrl.tcp
+        tcp.no_reply -= 1
+        if not tcp.no_reply:
+            tcp.pending.clear() # left by a method that failed between cmd_send and res_recv
+        return False
+
+    def __getattr__(self, name):
+        method = getattr(self.ctrl, name)
+        if not callable(method):
+            return method
+        def no_reply_call(*args, **kwargs):
+            with self:
+                return method(*args, **kwargs)
+        return no_reply_call
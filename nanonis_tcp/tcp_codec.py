@@ -0,0 +1,230 @@
+# -*- encoding: utf-8 -*-
+'''
+Encoding and decoding of Nanonis TCP messages shared by all transports.
+
+A response format such as ('int', '1dstr', 'int', 'int', '2dfloat32') is compiled once
+into a decoder plan and cached, so decoding a reply does not walk the format tuple
+through the if/elif chain of tcp_ctrl.dtype_cvt again.
+'''
+# data types: 'str', 'int'(i), 'uint16'(H), 'uint32'(I), 'float32'(f), 'float64'(d)
+# big-endian encoded '>'
+############################### packages ######################################
+import struct as st
+import numpy as np
+
+############################### constants #####################################
+HEADER_SIZE = 40
+
+scalar_codes = {'int': 'i', 'uint16': 'H', 'uint32': 'I', 'float32': 'f', 'float64': 'd'}
+scalar_types = {'int': np.int32, 'uint16': np.uint16, 'uint32': np.uint32, 'float32': np.float32, 'float64': np.float64}
+array_dtypes = {'1dint': np.dtype('>i4'), '1duint32': np.dtype('>u4'), '1dfloat32': np.dtype('>f4'),
+                '1dfloat64': np.dtype('>f8'), '2dfloat32': np.dtype('>f4')}
+str_array_fmts = ('1dstr', '2dstr')
+
+supported_fmts = ('str', 'int', 'uint16', 'uint32', 'float32', 'float64',
+                  '1dstr', '1dint', '1duint32', '1dfloat32', '1dfloat64', '2dfloat32', '2dstr')
+
+# decoder plan steps
+SCALARS, STR, STR_ARRAY, ARRAY = range(4)
+
+error_struct = st.Struct('>Ii')
+body_size_struct = st.Struct('>i')
+size_flag_struct = st.Struct('>iHH') # body size, send response back (1) or not (0), 2 empty bytes
+
+_plans = {}
+_str_arrays = {}
+str_array_cache_size = 256
+_command_names = {}
+
+############################### decoding ######################################
+def _size_refs(varg_fmt, idx, arg_fmt, count_idx):
+    '''
+    index of the arguments holding the number of rows and columns of the array at idx
+       - count_idx given: every array has count_idx elements (Marks.PointsGet)
+       - strings and string arrays: the preceding argument(s)
+       - numeric arrays: the preceding 'int', otherwise the last 'int' of the format
+    '''
+    if count_idx is not None:
+        return None, count_idx
+    rows_idx = idx - 2 if arg_fmt in ('2dstr', '2dfloat32') else None
+    if arg_fmt in ('str', '1dstr', '2dstr') or varg_fmt[idx - 1] == 'int':
+        cols_idx = idx - 1
+    elif 'int' in varg_fmt:
+        cols_idx = len(varg_fmt) - 1 - varg_fmt[::-1].index('int')
+    else:
+        cols_idx = -1
+    if cols_idx < 0 or cols_idx >= idx or (rows_idx is not None and rows_idx < 0):
+        raise TypeError(f'The size of argument {idx} ({arg_fmt}) in {varg_fmt} must be given by a preceding argument.')
+    return rows_idx, cols_idx
+
+def compile_plan(varg_fmt, count_idx=None):
+    '''
+    Compile a response format into a decoder plan. Plans are cached per format signature.
+
+    A plan is a tuple of steps:
+       - (SCALARS, struct.Struct, numpy scalar types): a run of fixed-size arguments unpacked in one call
+       - (STR, size_idx)
+       - (STR_ARRAY, rows_idx, cols_idx)
+       - (ARRAY, np.dtype, rows_idx, cols_idx)
+    rows_idx is None for 1D arrays.
+    '''
+    key = (varg_fmt, count_idx)
+    plan = _plans.get(key)
+    if plan is not None:
+        return plan
+
+    steps = []
+    run_codes, run_types = '', []
+    for idx, arg_fmt in enumerate(varg_fmt):
+        if arg_fmt in scalar_codes:
+            run_codes += scalar_codes[arg_fmt]
+            run_types.append(scalar_types[arg_fmt])
+            continue
+        if arg_fmt not in supported_fmts:
+            raise TypeError(f'Please check the data types! "{arg_fmt}" is not supported. Supported data types are: {", ".join(supported_fmts)}')
+        if run_codes:
+            steps.append((SCALARS, st.Struct('>' + run_codes), tuple(run_types)))
+            run_codes, run_types = '', []
+        rows_idx, cols_idx = _size_refs(varg_fmt, idx, arg_fmt, count_idx)
+        if arg_fmt == 'str':
+            steps.append((STR, cols_idx))
+        elif arg_fmt in str_array_fmts:
+            steps.append((STR_ARRAY, rows_idx, cols_idx))
+        else:
+            steps.append((ARRAY, array_dtypes[arg_fmt], rows_idx, cols_idx))
+    if run_codes:
+        steps.append((SCALARS, st.Struct('>' + run_codes), tuple(run_types)))
+
+    plan = _plans[key] = tuple(steps)
+    return plan
+
+def decode_str_array(buf, offset, count):
+    '''
+    Decode a Nanonis string array (count elements, each preceded by its size as 'int') in one pass.
+    Returns the strings as a read-only 1D numpy array and the number of bytes consumed.
+
+    Decoded arrays are cached by their raw bytes, so repeated name lists (Signals.NamesGet,
+    channel names of BiasSpectr.Start/GenSwp.Start) cost one walk over the element sizes
+    and a dictionary lookup. Copy the array before modifying it.
+    '''
+    end = offset
+    unpack_size = body_size_struct.unpack_from
+    for _ in range(count):
+        end += 4 + unpack_size(buf, end)[0]
+    raw = bytes(buf[offset: end])
+    strings = _str_arrays.get(raw)
+    if strings is None:
+        strings, start = [], 0
+        for _ in range(count):
+            ele_size = unpack_size(raw, start)[0]
+            strings.append(raw[start + 4: start + 4 + ele_size].rstrip(b'\x00').decode('utf-8'))
+            start += 4 + ele_size
+        strings = np.array(strings)
+        strings.flags.writeable = False
+        if len(_str_arrays) >= str_array_cache_size:
+            _str_arrays.pop(next(iter(_str_arrays))) # drop the oldest entry
+        _str_arrays[raw] = strings
+    return strings, end - offset
+
+def decode_args(plan, buf, offset = HEADER_SIZE, copy = False):
+    '''
+    Decode the arguments of a response body with a compiled plan.
+       - buf: bytes-like object (bytes, bytearray, memoryview) holding the whole message
+       - copy: copy numeric arrays out of buf (needed when buf is reused for the next message)
+    Returns the list of arguments and the offset of the first byte after them.
+    '''
+    res_arg = []
+    for step in plan:
+        kind = step[0]
+        if kind == SCALARS:
+            struct_, types = step[1], step[2]
+            res_arg.extend([t(v) for t, v in zip(types, struct_.unpack_from(buf, offset))])
+            offset += struct_.size
+        elif kind == STR:
+            str_size = int(res_arg[step[1]])
+            if str_size != 0:
+                res_arg.append(bytes(buf[offset: offset + str_size]).rstrip(b'\x00').decode('iso-8859-1'))
+            else:
+                res_arg.append('EmptyString')
+            offset += str_size
+        elif kind == STR_ARRAY:
+            num_rows = 1 if step[1] is None else int(res_arg[step[1]])
+            num_cols = int(res_arg[step[2]])
+            strings, consumed = decode_str_array(buf, offset, num_rows*num_cols)
+            offset += consumed
+            res_arg.append(strings.reshape(num_rows, num_cols))
+        else:
+            dtype, rows_idx = step[1], step[2]
+            num_cols = int(res_arg[step[3]])
+            num_rows = 1 if rows_idx is None else int(res_arg[rows_idx])
+            count = num_rows*num_cols
+            arg = np.frombuffer(buf, dtype, count, offset)
+            offset += count*dtype.itemsize
+            if rows_idx is not None:
+                arg = arg.reshape(num_rows, num_cols)
+            elif count == 1:
+                arg = arg[0]
+            if copy and isinstance(arg, np.ndarray):
+                arg = arg.copy()
+            res_arg.append(arg)
+    return res_arg, offset
+
+def decode_header(buf):
+    '''command name and body size of a message'''
+    return bytes(buf[0:32]).rstrip(b'\x00').decode('iso-8859-1'), body_size_struct.unpack_from(buf, 32)[0]
+
+def decode_error(buf, offset):
+    '''error status, error description size and error description following the arguments at offset'''
+    if len(buf) < offset + 8:
+        return 0, 0, ''
+    status, size = error_struct.unpack_from(buf, offset)
+    description = bytes(buf[offset + 8: offset + 8 + size]).decode('iso-8859-1') if size > 0 else ''
+    return status, size, description
+
+############################### encoding ######################################
+def command_name_encode(command_name):
+    '''command name padded to 32 bytes with b'\x00', cached per command'''
+    name = _command_names.get(command_name)
+    if name is None:
+        name = _command_names[command_name] = bytes(command_name, 'utf-8').ljust(32, b'\x00')
+    return name
+
+def response_flag_set(data, res):
+    '''copy of the message(s) in data with "send response back" set to 1 (res = True) or 0'''
+    data = bytearray(data)
+    offset = 0
+    while offset + HEADER_SIZE <= len(data):
+        body_size = body_size_struct.unpack_from(data, offset + 32)[0]
+        st.pack_into('>H', data, offset + 36, 1 if res else 0)
+        offset += HEADER_SIZE + body_size
+    return data
+
+def header_encode(command_name, body_size, res = True):
+    return command_name_encode(command_name) + size_flag_struct.pack(body_size, 1 if res else 0, 0)
+
+class request_encoder:
+    '''
+    Preassembled request with a fixed-size body (only scalars in body_fmt).
+    Header and body are packed by one struct.Struct into a preallocated buffer, so
+    encode() allocates nothing but the returned memoryview. The buffer is overwritten by
+    the next encode() call: send it (or copy it) before encoding again.
+    '''
+    def __init__(self, command_name, body_fmt = (), res = True):
+        for arg_fmt in body_fmt:
+            if arg_fmt not in scalar_codes:
+                raise TypeError(f'request_encoder only packs fixed-size arguments ({", ".join(scalar_codes)}), got "{arg_fmt}".')
+        self.command_name = command_name
+        self.body_fmt = tuple(body_fmt)
+        self.struct = st.Struct('>32siHH' + ''.join(scalar_codes[arg_fmt] for arg_fmt in body_fmt))
+        self.prefix = (command_name_encode(command_name), self.struct.size - HEADER_SIZE, 1 if res else 0, 0)
+        self.buf = bytearray(self.struct.size)
+        self.view = memoryview(self.buf)
+
+    def encode(self, *args):
+        try:
+            self.struct.pack_into(self.buf, 0, *self.prefix, *args)
+        except st.error:
+            # e.g. a float given for an integer argument: convert like numpy did before
+            args = [int(arg) if scalar_codes[arg_fmt] in 'iHI' else float(arg) for arg_fmt, arg in zip(self.body_fmt, args)]
+            self.struct.pack_into(self.buf, 0, *self.prefix, *args)
+        return self.view
@@ -5,38 +5,133 @@
 modified 2026/14/05 GPT
 '''
 
-# data types: 'str', 'int'(i), 'uint16'(H), 'uint32'(L), 'float32'(f), 'float64'(d), 'hex'
+# data types: 'str', 'int'(i), 'uint16'(H), 'uint32'(u4), 'float32'(f), 'float64'(d), 'hex'
 # big-endian encoded '>'
 ############################### packages ######################################
 import socket
-from collections import defaultdict
+import threading
+import time
+from collections import deque
 import struct as st
 import pandas as pd
 import numpy as np
+from . import tcp_codec
+from .tcp_stats import tcp_stats
+from . import tcp_raw
 
 class tcp_ctrl:
 ############################### functions #####################################
 #################### basic functions for creating commands ####################
     # create a connection between tcp client and nanonis software
-    def __init__(self, TCP_IP = '127.0.0.1', PORT = 6501, buffersize=50*1024*1024, version=999999): # buffer size = 50 MB enough for tip recorder 200k samples of 62 channels 
+    # framed receive: replies up to rx_pool_max bytes are read into reusable buffers,
+    # one per power-of-two size class (smallest class is rx_pool_min bytes).
+    # Larger replies (TipRec data, big scan frames) get a buffer of their own.
+    rx_pool_min = 4096
+    rx_pool_max = 4*1024*1024
+    supported_dtypes = ['bin', 'str', 'int', 'uint16', 'uint32', 'float32', 'float64',
+                        '1dstr', '1dint', '1duint32', '1dfloat32',
+                        '2dstr', '2dfloat32']
+    empty_df = pd.DataFrame() # returned for the header/error that was not requested. do not modify
+    no_error_df = pd.DataFrame({'error status': [0], 'error body size': [0], 'error description': ['']}) # returned for commands sent without reply. do not modify
+
+    def __init__(self, TCP_IP = '127.0.0.1', PORT = 6501, buffersize=50*1024*1024, version=999999, framed=True, connect=True, stats=None, journal=None): # buffer size = 50 MB enough for tip recorder 200k samples of 62 channels 
         """
        Parameters
        IP              : Listening IP address
        PORT            : Listening Port (check Nanonis File>Settings>TCP)
-       max_buf_size    : maximum size of the response message. just make it big
+       max_buf_size    : maximum size of the response message. just make it big. Only used when framed = False
        version         : Nanonis version. See Nanonis > help > info and take the RT Engine number.
                          Defaults to the latest version of Nanonis 
+       framed          : read every response as header + exactly "body size" bytes (recommended).
+                         False falls back to a single recv of buffersize bytes
+       connect         : open the connection. False gives an object that only encodes and decodes
+                         messages (used by tcp_async and the benchmarks)
+       stats           : tcp_stats collecting per-command counts, bytes and timings (see stats_enable)
+       journal         : tcp_journal recording every request and reply (see journal_enable)
        """
         self.server_addr = (TCP_IP, PORT)
-        self.sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sk.connect(self.server_addr)
+        self.sk = None
+        if connect:
+            self.sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sk.connect(self.server_addr)
         self.buffersize = buffersize
         self.version = version
+        self.framed = framed
+        self.rx_header = memoryview(bytearray(40))
+        self.rx_pool = {}
+        self.rx_pooled = False
+        self.encoders = {}
+        self.raw_all = 0    # > 0: raw mode for every thread (nanonis_ctrl(tcp, raw = True))
+        self.local = threading.local() # modes of the calling thread only: raw (connect.raw()), no_reply, pending
+        self.stats = None
+        self.in_flight = deque() # send times of the requests waiting for their reply (only with stats)
+        if stats is not None:
+            self.stats_enable(stats)
+        self.journal = None
+        self.journal_id = 0
+        if journal is not None:
+            self.journal_enable(journal)
+
+    # > 0: res_recv hands the decoded reply to the method's caller (see tcp_raw).
+    # Counted per thread, so a worker using connect.raw() does not change what other
+    # threads sharing the connection get back.
+    @property
+    def raw(self):
+        return self.raw_all + getattr(self.local, 'raw', 0)
+
+    @raw.setter
+    def raw(self, value):
+        self.local.raw = value - self.raw_all
+
+    # > 0: commands without return arguments are sent with "send response back" = 0 (see tcp_batch.no_reply).
+    # Per thread, as raw: requests held back by another thread are not sent within this thread's exchange
+    @property
+    def no_reply(self):
+        return getattr(self.local, 'no_reply', 0)
+
+    @no_reply.setter
+    def no_reply(self, value):
+        self.local.no_reply = value
+
+    # requests held back by cmd_send in no-reply mode (of the calling thread)
+    @property
+    def pending(self):
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            pending = self.local.pending = []
+        return pending
 
     # close socket
     def socket_close(self):
         self.sk.close()
 
+    # collect statistics of the commands sent and received on this connection
+        '''
+        stats: tcp_stats to add to (can be shared by several connections), None for a new one.
+        Returns the tcp_stats, see tcp_stats.snapshot. stats_disable() stops collecting.
+        '''
+    def stats_enable(self, stats = None):
+        self.stats = tcp_stats() if stats is None else stats
+        self.in_flight.clear()
+        return self.stats
+
+    def stats_disable(self):
+        self.stats = None
+        self.in_flight.clear()
+
+    # record the requests and replies of this connection in a binary journal
+        '''
+        journal: tcp_journal to append to (can be shared by several connections), see tcp_journal
+        for the replay. journal_disable() stops recording.
+        '''
+    def journal_enable(self, journal):
+        self.journal = journal
+        self.journal_id = journal.connection_id()
+        return journal
+
+    def journal_disable(self):
+        self.journal = None
+
     # data type conversion. 
     '''
        - the arguments returned by this function are bytelike strings when converting to 'bin' and data in requested format and the length of the data when converting from 'bin'
@@ -46,10 +141,6 @@ class tcp_ctrl:
             for a string: arg should be a integer
     '''
     def dtype_cvt(self, data, original_fmt, target_fmt, *arg):  
-        self.supported_dtypes = ['bin', 'str', 'int', 'uint16', 'uint32', 'float32', 'float64',
-                                 '1dstr', '1dint', '1duint32', '1dfloat32',
-                                 '2dstr', '2dfloat32']
-        
         ##############* TO BYTES ####################
         #* str to binary
         if original_fmt == 'str' and target_fmt == 'bin': 
@@ -73,7 +164,7 @@ class tcp_ctrl:
             return np.array(data, '>H').tobytes()
         #* unsigned int32 to binary
         elif original_fmt in ['uint32', '1duint32'] and target_fmt == 'bin': 
-            return np.array(data, '>L').tobytes()
+            return np.array(data, '>u4').tobytes()
         #* float32 to binary
         elif original_fmt in ['float32', '1dfloat32', '2dfloat32'] and target_fmt == 'bin': 
             return np.array(data, '>f').tobytes()
@@ -89,17 +180,8 @@ class tcp_ctrl:
             return [data_cvted, len(data)]
         #* binary to 1d or 2d string
         elif original_fmt == 'bin' and target_fmt in ['1dstr', '2dstr']: 
-            ele_idx = 0
-            str_array= []
-            for idx in range(np.prod(arg)):
-                ele_size = np.frombuffer(data[ele_idx: ele_idx+4], '>i')[0]
-                ele_idx += 4
-
-                ele = np.frombuffer(data[ele_idx: ele_idx + ele_size], '>%dS' % ele_size)[0].decode('utf-8')
-                ele_idx += ele_size
-
-                str_array.append(ele)
-            return [np.array(str_array).reshape(arg), len(data)]
+            str_array, array_size = tcp_codec.decode_str_array(data, 0, int(np.prod(arg)))
+            return [str_array.reshape(arg), array_size]
         #* binary to int & 1d int
         elif original_fmt == 'bin' and target_fmt in ['int', '1dint']: 
             data_cvted = np.frombuffer(data, '>i')
@@ -114,7 +196,7 @@ class tcp_ctrl:
             return [data_cvted, len(data)]
         #* binary to unsigned int32 and 1d unsigned int32
         elif original_fmt == 'bin' and target_fmt in ['uint32', '1duint32']: 
-            data_cvted = np.frombuffer(data, '>L')
+            data_cvted = np.frombuffer(data, '>u4')
             if len(data_cvted) == 1:
                 data_cvted = data_cvted[0]
             return [data_cvted, len(data)]
@@ -158,15 +240,94 @@ class tcp_ctrl:
 
     # construct header
     def header_construct(self,command_name, body_size, res = True):
-        self.header_bin_rep =  bytes(command_name, 'utf-8').ljust(32, b'\x00')  # convert command name to binary representation and pad it to 32 bytes long with b'\x00'
-        self.header_bin_rep += self.dtype_cvt(body_size, 'int', 'bin')         # boty size
-        self.header_bin_rep += self.dtype_cvt(1 if res else 0, 'uint16', 'bin') # send response back (1) or not (0)
-        self.header_bin_rep += b'\x00\x00'
+        self.header_bin_rep = tcp_codec.header_encode(command_name, body_size, res) # command name padded to 32 bytes, body size, send response back (1) or not (0)
         return self.header_bin_rep
 
+    # complete request (header + body) for commands whose body has only fixed-size arguments
+        '''
+        - body_fmt: tuple of 'int', 'uint16', 'uint32', 'float32', 'float64', eg. ('float64', 'float64', 'uint32')
+        - the encoder of every command is compiled once per connection and packs into its own buffer,
+          which is reused by the next call of the same command. cmd_send it right away.
+        '''
+    def cmd_encode(self, command_name, body_fmt, *args, res = True):
+        key = (command_name, body_fmt, res)
+        encoder = self.encoders.get(key)
+        if encoder is None:
+            encoder = self.encoders[key] = tcp_codec.request_encoder(command_name, body_fmt, res)
+        return encoder.encode(*args)
+
     # send command to nanonis tcp server
+        '''
+        in no-reply mode the request is held back until res_recv, which knows if a reply is needed:
+        commands without return arguments are then sent with "send response back" = 0 and nothing is read,
+        all other commands are sent unchanged. This keeps the replies in sync with the requests.
+        '''
     def cmd_send(self, data):
+        if self.no_reply:
+            self.pending.append(bytes(data))
+            return
+        self.sk.sendall(data)
+        if self.stats is not None:
+            self.stats.sent(data, self.in_flight)
+        if self.journal is not None:
+            self.journal.sent(self.journal_id, data)
+
+    def pending_send(self, res = True):
+        data = b''.join(self.pending)
+        self.pending.clear()
+        if not res:
+            data = tcp_codec.response_flag_set(data, 0)
         self.sk.sendall(data)
+        if self.stats is not None:
+            self.stats.sent(data, self.in_flight)
+        if self.journal is not None:
+            self.journal.sent(self.journal_id, data)
+
+    # receive exactly len(view) bytes into a writable memoryview
+    def recv_exact(self, view):
+        received = 0
+        size = len(view)
+        while received < size:
+            n = self.sk.recv_into(view[received:], size - received)
+            if n == 0:
+                raise ConnectionError('The Nanonis TCP server closed the connection while sending a response.')
+            received += n
+        return received
+
+    # get a receive buffer of at least 'size' bytes. returns the buffer and whether it belongs to the pool
+    def rx_buffer(self, size):
+        if size > self.rx_pool_max:
+            return bytearray(size), False
+        size_class = max(self.rx_pool_min, 1 << (size - 1).bit_length())
+        buf = self.rx_pool.get(size_class)
+        if buf is None:
+            buf = self.rx_pool[size_class] = bytearray(size_class)
+        return buf, True
+
+    # receive one complete response message (header + body) and return it as a memoryview
+        '''
+        - the 40-byte header is read first, the body size is taken from bytes 32:36 and
+          exactly that many bytes are read after it
+        - small responses are read into a pooled buffer which is reused by the next call,
+          so anything that should outlive the next response has to be copied (res_recv does this)
+        '''
+    def frame_recv(self):
+        if not self.framed:
+            self.rx_pooled = False
+            frame = memoryview(self.sk.recv(self.buffersize))
+        else:
+            header = self.rx_header
+            self.recv_exact(header)
+            body_size = st.unpack_from('>i', header, 32)[0]
+            buf, self.rx_pooled = self.rx_buffer(40 + body_size)
+            frame = memoryview(buf)[:40 + body_size]
+            frame[:40] = header
+            self.recv_exact(frame[40:])
+        if self.stats is not None:
+            self.stats.received(frame, self.in_flight)
+        if self.journal is not None:
+            self.journal.received(self.journal_id, frame)
+        return frame
 
     # receive and decode response message
         '''
@@ -174,151 +335,77 @@ class tcp_ctrl:
             'str', 'int', 'uint16', 'uint32', 'float32', 'float64', 
             '1dstr', '1dint', '1duint8'(not supported now), '1duint32', 
             '1dfloat32', '1dfloat64', '2dfloat32', '2dstr'
+        the format is compiled once into a decoder plan (see tcp_codec.compile_plan) and reused
+        by every later response with the same format.
         '''
     def res_recv_MarksPointsGet(self, *varg_fmt, get_header = True, get_arg = True, get_err = True):
-        res_bin_rep = self.sk.recv(self.buffersize)
-        
-        res_arg = []
-        res_err = pd.DataFrame()
-        res_header = pd.DataFrame()
-
-        num_pts = None
-
-        # parse the header of a response message
-        if get_header:
-            res_header['commmand name'] = self.dtype_cvt(res_bin_rep[0:32], 'bin', 'str', 32) # drop all '\x00' in the string
-            res_header['body size'] = self.dtype_cvt(res_bin_rep[32:36], 'bin', 'int')  
-        # parse the arguments values of a response message
-        if get_arg:
-            arg_byte_idx = 40   
-            arg_size_dict = {'int': 4,'uint16': 2,'uint32': 4,'float32': 4,'float64': 8}
-            for idx, arg_fmt in enumerate(varg_fmt):
-                if arg_fmt == 'int':
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + arg_size_dict[arg_fmt]], 'bin', arg_fmt)
-                    arg_byte_idx += arg_size
-                    res_arg.append(arg)
-                    if num_pts == None:
-                        num_pts = arg
-
-                elif arg_fmt == '1dstr':
-                    num_rows = 1
-                    num_cols = num_pts
-                    
-                    # calculate the total size of the string array
-                    interal_byte_idx = arg_byte_idx
-                    for ele_idx in range(num_rows*num_cols): 
-                        ele_size, len_int = self.dtype_cvt(res_bin_rep[interal_byte_idx: interal_byte_idx + arg_size_dict['int']], 'bin', 'int')
-                        interal_byte_idx += ele_size + len_int
-                    array_size = interal_byte_idx - arg_byte_idx
-
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + array_size], 'bin', arg_fmt, num_rows, num_cols)
-                    arg_byte_idx += arg_size
-
-                    if array_size == arg_size:
-                        res_arg.append(arg)
-                    else:
-                        print('There might be an error when parsing the string array. Possible causes could be: \n 1) the argument format (arg_fmt) input is wrong. \n 2) the previous arg_fmt is wrong. ' )
-                        res_arg.append(arg)
-
-                elif arg_fmt in ['1dint', '1duint32', '1dfloat32', '1dfloat64']:
-                    num_rows = 1
-                    num_cols = num_pts
-
-                    array_size = num_rows * num_cols * arg_size_dict[arg_fmt[2:]]
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + array_size], 'bin', arg_fmt, num_rows, num_cols)
-                    arg_byte_idx += arg_size
-                    res_arg.append(arg)
-                else: 
-                    raise TypeError('Please check the data types! Supported data types are: \
-                                    "bin", "str", "int", "uint16", "uint32", "float32", "float64", \
-                                    "1dstr", "1dint", "1duint8" (currently unavailable), "1duint32", "1dfloat32", "1dfloat64", \
-                                    "2dfloat32", "2dstr"')
-                
-            res_bin_rep = res_bin_rep[arg_byte_idx-1:] # for parsing the error in a request or a response
-
-            # parse the error of a response message
-            if get_err:
-                res_err['error status'] = [self.dtype_cvt(res_bin_rep[0:4], 'bin', 'uint32')[0]] # error status
-                res_err['error body size'] = [self.dtype_cvt(res_bin_rep[4:8], 'bin', 'int')[0]]# error description size
-                res_err['error description'] = [self.dtype_cvt(res_bin_rep[8:], 'bin', 'str', len(res_bin_rep[8:]))[0]] # error description
-            return res_header, res_arg, res_err
+        # all arrays of Marks.PointsGet have the number of points given by the first 'int'
+        count_idx = varg_fmt.index('int') if 'int' in varg_fmt else None
+        if self.pending:
+            self.pending_send()
+        if self.raw:
+            self.raw_reply(self.frame_recv(), varg_fmt, count_idx)
+        return self.res_decode(self.frame_recv(), *varg_fmt, get_header = get_header, get_arg = get_arg, get_err = get_err, count_idx = count_idx)
 
     def res_recv(self, *varg_fmt, get_header = True, get_arg = True, get_err = True):  
-        res_bin_rep = self.sk.recv(self.buffersize)
-
+        if self.pending:
+            if not varg_fmt: # no-reply mode, the command returns nothing but the error
+                self.pending_send(res = False)
+                if self.raw:
+                    self.raw_reply(None, varg_fmt)
+                return self.empty_df, [], self.no_error_df
+            self.pending_send()
+        if self.raw:
+            self.raw_reply(self.frame_recv(), varg_fmt)
+        return self.res_decode(self.frame_recv(), *varg_fmt, get_header = get_header, get_arg = get_arg, get_err = get_err)
+
+    # raw mode: decode the arguments and the error only and stop the method with the reply (see tcp_raw)
+    def raw_reply(self, frame, varg_fmt, count_idx = None):
+        if frame is None: # sent without reply
+            raise tcp_raw.reply_ready(tcp_raw.reply([], (0, 0, ''), None, self))
+        t_decode = time.perf_counter() if self.stats is not None else 0.
+        frame = bytearray(frame) # the arrays in the arguments are views on this copy
+        res_arg, err_byte_idx = tcp_codec.decode_args(tcp_codec.compile_plan(varg_fmt, count_idx), frame)
+        res_err = tcp_codec.decode_error(frame, err_byte_idx)
+        if res_err[1]:
+            print(res_err[2])
+        if self.stats is not None:
+            self.stats.decoded(tcp_codec.decode_header(frame)[0], time.perf_counter() - t_decode)
+        raise tcp_raw.reply_ready(tcp_raw.reply(res_arg, res_err, frame, self))
+
+    # decode a complete response message (header + body)
+    def res_decode(self, res_bin_rep, *varg_fmt, get_header = True, get_arg = True, get_err = True, count_idx = None):
+        t_decode = time.perf_counter() if self.stats is not None else 0.
         res_arg = []
-        res_err = pd.DataFrame()
-        res_header = pd.DataFrame()
-      #  print(f"Response binary representation length: {len(res_bin_rep)}")
+        res_err = self.empty_df
+        res_header = self.empty_df
 
         # parse the header of a response message
         if get_header:
-            res_header['commmand name'] = self.dtype_cvt(res_bin_rep[0:32], 'bin', 'str', 32) # drop all '\x00' in the string
-            res_header['body size'] = self.dtype_cvt(res_bin_rep[32:36], 'bin', 'int')            
-        # parse the arguments values of a response message
-        if get_arg:
-            arg_byte_idx = 40   
-            arg_size_dict = {'int': 4,'uint16': 2,'uint32': 4,'float32': 4,'float64': 8}
-            for idx, arg_fmt in enumerate(varg_fmt):
-                if arg_fmt in arg_size_dict.keys():
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + arg_size_dict[arg_fmt]], 'bin', arg_fmt)
-                    arg_byte_idx += arg_size
-                    res_arg.append(arg)
-
-                elif arg_fmt == 'str': 
-                    str_size = res_arg[idx-1]
-                    if str_size != 0:
-                        arg, _ = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + str_size], 'bin', arg_fmt, str_size)
-                    else:
-                        arg = 'EmptyString'
-                    arg_byte_idx += str_size
-                    res_arg.append(arg)
-
-                elif arg_fmt in ['1dstr', '2dstr']:
-                    num_rows = res_arg[idx-2] if arg_fmt == '2dstr' else 1
-                    num_cols = res_arg[idx-1]
-
-                    # calculate the total size of the string array
-                    interal_byte_idx = arg_byte_idx
-                    for ele_idx in range(num_rows*num_cols): 
-                        ele_size, len_int = self.dtype_cvt(res_bin_rep[interal_byte_idx: interal_byte_idx + arg_size_dict['int']], 'bin', 'int')
-                        interal_byte_idx += ele_size + len_int
-                    array_size = interal_byte_idx - arg_byte_idx
-
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + array_size], 'bin', arg_fmt, num_rows, num_cols)
-                    arg_byte_idx += arg_size
-
-                    if array_size == arg_size:
-                        res_arg.append(arg)
-                    else:
-                        print('There might be an error when parsing the string array. Possible causes could be: \n 1) the argument format (arg_fmt) input is wrong. \n 2) the previous arg_fmt is wrong. ' )
-                        res_arg.append(arg)
-
-                elif arg_fmt in ['1dint', '1duint32', '1dfloat32', '1dfloat64', '2dfloat32']:
-                    num_rows = res_arg[idx-2] if arg_fmt == '2dfloat32' else 1
-                    num_cols = res_arg[idx-1] if varg_fmt[idx-1] == 'int' else res_arg[len(varg_fmt) - 1 - varg_fmt[::-1].index('int')]
-
-                    array_size = num_rows * num_cols * arg_size_dict[arg_fmt[2:]]
-                    arg, arg_size = self.dtype_cvt(res_bin_rep[arg_byte_idx: arg_byte_idx + array_size], 'bin', arg_fmt, num_rows, num_cols)
-                    arg_byte_idx += arg_size
-                    res_arg.append(arg)
-                else: 
-                    raise TypeError('Please check the data types! Supported data types are: \
-                                    "bin", "str", "int", "uint16", "uint32", "float32", "float64", \
-                                    "1dstr", "1dint", "1duint8" (currently unavailable), "1duint32", "1dfloat32", "1dfloat64", \
-                                    "2dfloat32", "2dstr"')
-                
-            res_bin_rep = res_bin_rep[arg_byte_idx-1:] # for parsing the error in a request or a response
+            command_name, body_size = tcp_codec.decode_header(res_bin_rep)
+            res_header = pd.DataFrame({'commmand name': [command_name, 32], 'body size': [body_size, 4]})
+        # parse the arguments values of a response message (also needed to locate the error)
+        if get_arg or get_err:
+            plan = tcp_codec.compile_plan(varg_fmt, count_idx)
+            args, err_byte_idx = tcp_codec.decode_args(plan, res_bin_rep, copy = self.rx_pooled)
+            if get_arg:
+                res_arg = args
 
         # parse the error of a response message
         if get_err:
-            res_err['error status'] = [self.dtype_cvt(res_bin_rep[0:4], 'bin', 'uint32')[0]] # error status
-            res_err['error body size'] = [self.dtype_cvt(res_bin_rep[4:8], 'bin', 'int')[0]]# error description size
-            res_err['error description'] = [self.dtype_cvt(res_bin_rep[8:], 'bin', 'str', len(res_bin_rep[8:]))[0]] # error description
+            err_status, err_size, err_description = tcp_codec.decode_error(res_bin_rep, err_byte_idx)
+            res_err = pd.DataFrame({'error status': [err_status],                # error status
+                                    'error body size': [err_size],               # error description size
+                                    'error description': [err_description]})     # error description
+        if self.stats is not None:
+            self.stats.decoded(tcp_codec.decode_header(res_bin_rep)[0], time.perf_counter() - t_decode)
         return res_header, res_arg, res_err
     
     def print_err(self, res_err):
-        if not res_err.loc[0, 'error body size'] == 0:
+        if isinstance(res_err, tuple): # raw mode
+            if res_err[1]:
+                print(res_err[2])
+        elif not res_err.loc[0, 'error body size'] == 0:
             print(res_err.loc[0, 'error description'])
 
     def tristate_cvt(self, status):
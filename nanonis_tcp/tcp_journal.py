@@ -0,0 +1,291 @@
+# -*- encoding: utf-8 -*-
+'''
+Binary journal of the Nanonis TCP traffic, and its replay.
+
+    journal = tcp_journal('session.njr', capacity = 256*1024*1024)
+    connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', 6501, journal = journal))
+    ...                                                     # every request and reply is recorded
+    journal.close()
+
+    connect = nanonis_ctrl(journal_tcp('session.njr'))      # the recorded replies through the decoders, no socket
+    with journal_server('session.njr', ports = (6501, 6502)) as server:
+        ...                                                 # the recorded replies served over TCP
+
+The journal is a memory-mapped file of fixed size used as a ring buffer: when it is full the
+oldest records are overwritten. Every record holds the bytes written to (request) or one
+message read from (reply) the socket, the connection and a monotonic timestamp (ns). One
+journal can be shared by several connections (e.g. all connections of a tcp_pool).
+
+The replay answers every request with the next recorded reply of the same command, so the
+client does not have to send the requests in the recorded order (several connections, timing
+dependent polling). When the replies of a command run out, the last one is repeated.
+'''
+############################### packages ######################################
+import mmap
+import os
+import socketserver
+import struct as st
+import threading
+import time
+from collections import defaultdict, deque
+
+from . import tcp_codec
+from .tcp_ctrl import tcp_ctrl
+
+# file header: magic, capacity, head and tail (logical positions: bytes written since the start),
+# records in the buffer, records dropped (larger than the buffer), connections, wall clock and
+# monotonic time at the creation (ns)
+journal_magic = b'NNSJRNL1'
+journal_header = st.Struct('<8sQQQQQQqq')
+JOURNAL_HEADER_SIZE = 128
+# record header: direction (REQUEST, REPLY), reserved, connection, size of the data, monotonic time (ns)
+record_header = st.Struct('<BBHIq')
+REQUEST, REPLY = 0, 1
+
+class tcp_journal:
+    def __init__(self, path, capacity = 64*1024*1024, append = False):
+        """
+       Parameters
+       path            : journal file
+       capacity        : size of the ring buffer (bytes). The file is capacity + 128 bytes
+       append          : continue an existing journal (its capacity is kept), otherwise it is overwritten
+       """
+        self.path = path
+        self.lock = threading.Lock()
+        if append and os.path.exists(path):
+            self.file = open(path, 'r+b')
+            self.mm = mmap.mmap(self.file.fileno(), 0)
+            (magic, self.capacity, self.head, self.tail, self.records, self.dropped,
+             self.connections, self.t0_wall, self.t0_mono) = journal_header.unpack_from(self.mm, 0)
+            if magic != journal_magic:
+                self.close()
+                raise ValueError(f'{path} is not a Nanonis TCP journal.')
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(JOURNAL_HEADER_SIZE + capacity)
+            self.mm = mmap.mmap(self.file.fileno(), 0)
+            self.capacity = capacity
+            self.head = self.tail = self.records = self.dropped = self.connections = 0
+            self.t0_wall, self.t0_mono = time.time_ns(), time.monotonic_ns()
+            self.header_write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def header_write(self):
+        journal_header.pack_into(self.mm, 0, journal_magic, self.capacity, self.head, self.tail, self.records,
+                                 self.dropped, self.connections, self.t0_wall, self.t0_mono)
+
+    def connection_id(self):
+        '''id of a new connection writing to the journal'''
+        with self.lock:
+            self.connections += 1
+            self.header_write()
+            return self.connections - 1
+
+    # copy data to / from the ring at a logical position, wrapping at the end of the buffer
+    def ring_write(self, pos, data):
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.mm[JOURNAL_HEADER_SIZE + start: JOURNAL_HEADER_SIZE + start + first] = data[:first]
+        if first < len(data):
+            self.mm[JOURNAL_HEADER_SIZE: JOURNAL_HEADER_SIZE + len(data) - first] = data[first:]
+
+    def ring_read(self, pos, size):
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        data = self.mm[JOURNAL_HEADER_SIZE + start: JOURNAL_HEADER_SIZE + start + first]
+        if first < size:
+            data += self.mm[JOURNAL_HEADER_SIZE: JOURNAL_HEADER_SIZE + size - first]
+        return data
+
+    def append(self, direction, connection, data):
+        '''record data (request: bytes sent, reply: one message received)'''
+        t_ns = time.monotonic_ns()
+        data = memoryview(data).cast('B')
+        size = record_header.size + len(data)
+        with self.lock:
+            if size > self.capacity:
+                self.dropped += 1
+                self.header_write()
+                return
+            while self.head + size - self.tail > self.capacity: # overwrite the oldest records
+                self.tail += record_header.size + record_header.unpack(self.ring_read(self.tail, record_header.size))[3]
+                self.records -= 1
+            self.ring_write(self.head, record_header.pack(direction, 0, connection, len(data), t_ns))
+            self.ring_write(self.head + record_header.size, data)
+            self.head += size
+            self.records += 1
+            self.header_write()
+
+    def sent(self, connection, data):
+        self.append(REQUEST, connection, data)
+
+    def received(self, connection, frame):
+        self.append(REPLY, connection, frame)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+
+def journal_records(path):
+    '''
+    records of the journal file, oldest first: (monotonic time (ns), direction, connection, data)
+    '''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        journal = tcp_journal.__new__(tcp_journal) # reader only: ring_read on the mapping
+        journal.mm = mm
+        (magic, journal.capacity, head, pos, *_) = journal_header.unpack_from(mm, 0)
+        if magic != journal_magic:
+            raise ValueError(f'{path} is not a Nanonis TCP journal.')
+        records = []
+        while pos < head:
+            direction, _, connection, size, t_ns = record_header.unpack(journal.ring_read(pos, record_header.size))
+            records.append((t_ns, direction, connection, journal.ring_read(pos + record_header.size, size)))
+            pos += record_header.size + size
+    return records
+
+def messages_split(data):
+    '''(command name, "send response back" flag) of the request messages in data'''
+    offset = 0
+    while offset + tcp_codec.HEADER_SIZE <= len(data):
+        command_name = bytes(data[offset: offset + 32]).rstrip(b'\x00').decode('iso-8859-1')
+        body_size, res, _ = tcp_codec.size_flag_struct.unpack_from(data, offset + 32)
+        yield command_name, res
+        offset += tcp_codec.HEADER_SIZE + body_size
+
+############################### replay ########################################
+class journal_replies:
+    '''recorded replies per command, handed out in the recorded order (the last one repeated)'''
+    def __init__(self, path, session_path = None):
+        """
+       Parameters
+       path            : journal file
+       session_path    : replace the recorded reply of Util.SessionPathGet (files and logs of the replayed
+                         session are then written there instead of the recorded session path)
+       """
+        self.lock = threading.Lock()
+        self.replies = defaultdict(deque)
+        for _, direction, _, data in journal_records(path):
+            if direction == REPLY:
+                self.replies[tcp_codec.decode_header(data)[0]].append(data)
+        if session_path is not None:
+            path_bin = session_path.encode('iso-8859-1')
+            body = st.pack('>i', len(path_bin)) + path_bin + tcp_codec.error_struct.pack(0, 0)
+            self.replies['Util.SessionPathGet'] = deque([tcp_codec.header_encode('Util.SessionPathGet', len(body), res = False) + body])
+
+    def reply(self, command_name):
+        with self.lock:
+            replies = self.replies.get(command_name)
+            if not replies:
+                raise ConnectionError(f'{command_name} has no reply in the journal.')
+            return replies.popleft() if len(replies) > 1 else replies[0]
+
+    def replies_for(self, data):
+        '''replies to the request message(s) in data'''
+        return b''.join(self.reply(command_name) for command_name, res in messages_split(data) if res)
+
+class journal_socket:
+    '''stands in for the socket of tcp_ctrl: requests are answered from the journal'''
+    def __init__(self, replies):
+        self.replies = replies
+        self.rx = bytearray()
+        self.rx_pos = 0
+
+    def sendall(self, data):
+        if self.rx_pos == len(self.rx):
+            self.rx.clear()
+            self.rx_pos = 0
+        self.rx += self.replies.replies_for(data)
+
+    def recv_into(self, view, size = 0):
+        size = min(size or len(view), len(self.rx) - self.rx_pos)
+        if size == 0:
+            raise ConnectionError('No reply pending in the journal replay.')
+        view[:size] = self.rx[self.rx_pos: self.rx_pos + size]
+        self.rx_pos += size
+        return size
+
+    def close(self):
+        pass
+
+def journal_tcp(path, session_path = None, version = 999999, replies = None, **tcp_kwargs):
+    '''
+    tcp_ctrl answering from the journal instead of Nanonis (no connection): the recorded replies
+    go through the same receive and decode code as live ones. replies: a journal_replies to share
+    (e.g. between several connections), otherwise read from path.
+    '''
+    tcp = tcp_ctrl(version = version, connect = False, **tcp_kwargs)
+    tcp.sk = journal_socket(replies if replies is not None else journal_replies(path, session_path))
+    return tcp
+
+class journal_connection(socketserver.StreamRequestHandler):
+    def handle(self):
+        replies = self.server.replies
+        try:
+            while True:
+                header = self.rfile.read(tcp_codec.HEADER_SIZE)
+                if len(header) < tcp_codec.HEADER_SIZE:
+                    break
+                body_size = tcp_codec.size_flag_struct.unpack_from(header, 32)[0]
+                reply = replies.replies_for(header + self.rfile.read(body_size))
+                if reply:
+                    self.request.sendall(reply)
+        except ConnectionError as e:
+            print(e)
+        except OSError:
+            pass
+
+class journal_tcp_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class journal_server:
+    def __init__(self, path, TCP_IP = '127.0.0.1', ports = (6501, 6502, 6503, 6504), session_path = None, start = True):
+        """
+       Parameters
+       path            : journal file
+       TCP_IP          : IP address to listen on
+       ports           : TCP ports to serve, all from the same replies (0: any free port, see self.ports)
+       session_path    : see journal_replies
+       start           : start serving right away (otherwise call start())
+       """
+        self.replies = journal_replies(path, session_path)
+        self.servers, self.threads = [], []
+        for port in ports:
+            server = journal_tcp_server((TCP_IP, port), journal_connection)
+            server.replies = self.replies
+            self.servers.append(server)
+        self.ports = [server.server_address[1] for server in self.servers]
+        if start:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target = server.serve_forever, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for server in self.servers:
+            if self.threads:
+                server.shutdown()
+            server.server_close()
+        self.threads = []
@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+'''
+Pool of connections to the Nanonis TCP ports, checked out per thread.
+
+    pool = tcp_pool('127.0.0.1', ports = (6502, 6503, 6504))
+    with pool.checkout() as connect:   # nanonis_ctrl on a socket of its own
+        connect.SignalsValsGet([0, 1, 2], 1)
+
+Nanonis serves one client per port, so a connection must never be used by two threads
+at once. A thread keeps the same connection for nested checkouts and gives it back
+when its outermost checkout ends. Threads wait when all connections are busy.
+'''
+############################### packages ######################################
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+
+from .tcp_ctrl import tcp_ctrl
+from .nanonis_ctrl import nanonis_ctrl
+
+class pooled_connection:
+    def __init__(self, port, connect):
+        self.port = port
+        self.connect = connect   # nanonis_ctrl (or tcp_ctrl)
+        self.owner = None        # thread holding the connection
+        self.depth = 0           # nested checkouts of the owner
+        self.checkouts = 0
+        self.busy_time = 0.
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+        self.since = 0.
+
+class tcp_pool:
+    def __init__(self, TCP_IP = '127.0.0.1', ports = (6502, 6503, 6504), version = 999999, ctrl = True, command_stats = None, journal = None):
+        """
+       Parameters
+       TCP_IP          : Listening IP address
+       ports           : Nanonis TCP ports to open (check Nanonis File>Settings>TCP). Leave out the ports
+                         that are already used by other connections: the default leaves 6501 to the
+                         main connect (of photon_meas)
+       version         : Nanonis version, see tcp_ctrl
+       ctrl            : hand out nanonis_ctrl objects (True) or bare tcp_ctrl connections (False)
+       command_stats   : tcp_stats shared by all connections of the pool (per-command timings, see tcp_stats)
+       journal         : tcp_journal recording the traffic of all connections of the pool (see tcp_journal)
+       Ports that cannot be opened are skipped.
+       """
+        self.connections = []
+        self.command_stats = command_stats
+        for port in ports:
+            try:
+                tcp = tcp_ctrl(TCP_IP, port, version = version, stats = command_stats, journal = journal)
+            except OSError as e:
+                print(f'Nanonis TCP port {port} is not available ({e}), skipped.')
+                continue
+            self.connections.append(pooled_connection(port, nanonis_ctrl(tcp) if ctrl else tcp))
+        if not self.connections:
+            raise ConnectionError(f'None of the Nanonis TCP ports {ports} could be opened.')
+
+        self.free = deque(self.connections)
+        self.owned = {}  # thread ident -> pooled_connection
+        self.cond = threading.Condition()
+        self.t_open = time.perf_counter()
+
+    def __len__(self):
+        return len(self.connections)
+
+    # take a connection for the calling thread (the one it already holds, if any)
+    def acquire(self, timeout = None):
+        ident = threading.get_ident()
+        with self.cond:
+            conn = self.owned.get(ident)
+            if conn is not None:
+                conn.depth += 1
+                return conn
+
+            t_wait = time.perf_counter()
+            if not self.cond.wait_for(lambda: self.free, timeout):
+                raise TimeoutError(f'No free Nanonis connection within {timeout} s ({len(self.connections)} in use).')
+            conn = self.free.popleft()
+            now = time.perf_counter()
+            conn.wait_time += now - t_wait
+            conn.max_wait_time = max(conn.max_wait_time, now - t_wait)
+            conn.owner, conn.depth, conn.since = ident, 1, now
+            conn.checkouts += 1
+            self.owned[ident] = conn
+            return conn
+
+    def release(self, conn):
+        with self.cond:
+            conn.depth -= 1
+            if conn.depth:
+                return
+            conn.busy_time += time.perf_counter() - conn.since
+            del self.owned[conn.owner]
+            conn.owner = None
+            self.free.append(conn)
+            self.cond.notify()
+
+    @contextmanager
+    def checkout(self, timeout = None):
+        """
+        Connection of the calling thread for the duration of the with block.
+        Waits up to timeout seconds (None: forever) for a free connection, then raises TimeoutError.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn.connect
+        finally:
+            self.release(conn)
+
+    def stats(self, prt = False):
+        """
+        Usage of every connection since the pool was opened: number of checkouts, time in use,
+        utilisation (time in use / time open) and time threads waited for it.
+        """
+        elapsed = time.perf_counter() - self.t_open
+        now = time.perf_counter()
+        with self.cond:
+            rows = {}
+            for conn in self.connections:
+                busy = conn.busy_time + (now - conn.since if conn.owner is not None else 0)
+                rows[conn.port] = {'Checkouts': conn.checkouts,
+                                   'In use': conn.owner is not None,
+                                   'Busy time (s)': busy,
+                                   'Utilisation': busy/elapsed if elapsed else 0.,
+                                   'Wait time (s)': conn.wait_time,
+                                   'Max wait time (s)': conn.max_wait_time}
+        stats_df = pd.DataFrame(rows)
+        stats_df.columns.name = 'Port'
+        if prt:
+            print('\n' + stats_df.to_string() + '\n')
+        return stats_df
+
+    def close(self):
+        with self.cond:
+            for conn in self.connections:
+                tcp = conn.connect.tcp if isinstance(conn.connect, nanonis_ctrl) else conn.connect
+                tcp.socket_close()
+            self.free.clear()
@@ -0,0 +1,158 @@
+# -*- encoding: utf-8 -*-
+'''
+Raw mode of nanonis_ctrl: methods return the decoded reply instead of building DataFrames.
+
+    vals = connect.raw().SignalsValsGet([0, 1, 2], 1)   # a single call
+    vals[1]                                             # reply arguments: numpy scalars and arrays
+    vals.error                                          # (error status, error body size, error description)
+    vals.df                                             # the usual DataFrame, built on first access
+
+    with connect.raw():                                 # every call in the block
+        status = connect.ScanWaitEndOfScan(1)[0]
+
+    connect = nanonis_ctrl(tcp, raw = True)             # every call on the connection
+
+In raw mode tcp_ctrl.res_recv decodes only the arguments and the error (no header and error
+DataFrames) and stops the method there, handing the reply to its caller as a reply object.
+The DataFrame is the method run once more on the stored reply, only when it is asked for:
+reply.df, or any DataFrame attribute on the reply itself (reply.iloc[0, 0], reply.values,
+reply.loc[...]), so code written for the DataFrame API keeps working. Nothing is printed
+in raw mode except the error descriptions.
+
+connect.raw() applies to the calling thread only; nanonis_ctrl(tcp, raw = True) to every
+thread using the connection. Since nothing after res_recv runs in raw mode, methods with
+side effects besides building their result (e.g. SignalsInSlotSet dropping the signal
+cache) do them before res_recv.
+'''
+############################### packages ######################################
+import copy
+from functools import wraps
+
+from .log_utils import logging_suppressed
+
+class reply_ready(BaseException):
+    '''raised by tcp_ctrl.res_recv in raw mode to return the reply from the method (not an Exception, so the method's own except clauses do not catch it)'''
+    def __init__(self, reply):
+        self.reply = reply
+
+class reply:
+    '''
+    Raw result of a nanonis_ctrl method.
+       - args: the reply arguments as decoded (see tcp_codec.decode_args), also reply[i], len(reply), iter(reply)
+       - error: (error status, error body size, error description)
+       - df: return value of the method in normal mode (mostly a DataFrame), built on first access
+    '''
+    __slots__ = ('args', 'error', 'frame', 'tcp', 'method', 'ctrl', 'call_args', 'call_kwargs', 'value', 'built')
+
+    def __init__(self, args, error, frame, tcp):
+        self.args = args
+        self.error = error
+        self.frame = frame # own copy of the reply message (None: sent without reply), the arrays in args are views on it
+        self.tcp = tcp
+        self.method = self.ctrl = self.call_args = self.call_kwargs = self.value = None
+        self.built = False
+
+    def bind(self, method, ctrl, args, kwargs):
+        self.method, self.ctrl, self.call_args, self.call_kwargs = method, ctrl, args, kwargs
+        return self
+
+    @property
+    def df(self):
+        if not self.built:
+            ctrl = copy.copy(self.ctrl) # the connection may be in use by another call meanwhile
+            ctrl.tcp = reply_replay(self)
+            with logging_suppressed(): # logged when called
+                self.value = self.method(ctrl, *self.call_args, **self.call_kwargs)
+            self.built = True
+        return self.value
+
+    def __getattr__(self, name):
+        if name.startswith('__'): # copy, pickle, ... look up special methods
+            raise AttributeError(name)
+        return getattr(self.df, name)
+
+    def __getitem__(self, idx):
+        return self.args[idx]
+
+    def __len__(self):
+        return len(self.args)
+
+    def __iter__(self):
+        return iter(self.args)
+
+    def __repr__(self):
+        name = self.method.__name__ if self.method is not None else 'reply'
+        return f'<{name} raw reply: args={self.args!r}, error={self.error!r}>'
+
+class reply_replay:
+    '''stands in for tcp_ctrl while a method runs again on a stored reply to build its DataFrame'''
+    raw = 0
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.tcp = reply.tcp
+
+    def __getattr__(self, name):
+        return getattr(self.tcp, name)
+
+    def cmd_send(self, data):
+        pass
+
+    def print_err(self, res_err):
+        pass # printed when the reply was read
+
+    def res_recv(self, *varg_fmt, get_header = True, get_arg = True, get_err = True, count_idx = None):
+        if self.reply.frame is None:
+            return self.tcp.empty_df, [], self.tcp.no_error_df
+        return self.tcp.res_decode(self.reply.frame, *varg_fmt, get_header = get_header,
+                                   get_arg = get_arg, get_err = get_err, count_idx = count_idx)
+
+    def res_recv_MarksPointsGet(self, *varg_fmt, **kwargs):
+        return self.res_recv(*varg_fmt, count_idx = varg_fmt.index('int') if 'int' in varg_fmt else None, **kwargs)
+
+############################### raw mode ######################################
+def raw_catch(func):
+    '''return the reply of func as a reply object when it is read in raw mode'''
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except reply_ready as ready:
+            return ready.reply.bind(func, self, args, kwargs)
+    return wrapper
+
+def apply_raw(cls):
+    '''
+    Make all public methods of cls return reply objects in raw mode. Apply before
+    apply_logging, so that the call is logged once.
+    '''
+    for attr_name, attr in list(vars(cls).items()):
+        if not attr_name.startswith('_') and callable(attr):
+            setattr(cls, attr_name, raw_catch(attr))
+    return cls
+
+class raw:
+    '''
+    Raw mode of a nanonis_ctrl, see the module docstring.
+       - per context: with connect.raw(): ...
+       - per call:    connect.raw().BiasGet()
+    '''
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __enter__(self):
+        self.ctrl.tcp.raw += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.ctrl.tcp.raw -= 1
+        return False
+
+    def __getattr__(self, name):
+        method = getattr(self.ctrl, name)
+        if not callable(method):
+            return method
+        def raw_call(*args, **kwargs):
+            with self:
+                return method(*args, **kwargs)
+        return raw_call
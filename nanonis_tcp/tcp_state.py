@@ -0,0 +1,215 @@
+# -*- encoding: utf-8 -*-
+'''
+Write-through cache of read-mostly Nanonis settings (opt-in).
+
+    connect.state_cache_enable(ttl = 60)      # or nanonis_ctrl(tcp, state_cache = True)
+    connect.ScanFrameGet()                    # asked once, then served from the cache
+    connect.FolMeSpeedSet(1e-7, 1)            # sent, and recorded as the value of FolMeSpeedGet
+    connect.FolMeSpeedSet(1e-7, 1)            # same value again: not sent
+    connect.state.stats(prt = True)           # hits, misses, suppressed sets per command
+    connect.state.invalidate()                # forget everything (e.g. after changes made in Nanonis itself)
+
+Cached getters (see getters below) are read from Nanonis on the first call and then answered
+from the stored reply, until the entry is older than ttl, invalidated, or its setter fails.
+A setter records the value written as the reply of its getter, and is not sent at all when
+the value equals the cached one. Setters whose getter returns values computed or coerced by
+Nanonis (e.g. ScanSpeedSet with a kept constant parameter, ScanBufferSet rounding the pixels
+to a multiple of 16) only drop the cached entry.
+
+Only calls made through this nanonis_ctrl are seen: settings changed in Nanonis itself (by
+the user or by other programs) are picked up once the entry expires (ttl) or is invalidated.
+Batched calls (batch()) bypass the cache, batched setters drop their entries.
+
+The cached replies go through the same decoding as live ones (raw mode: tcp_raw.reply,
+otherwise the method's DataFrame), so cached and live calls return the same.
+'''
+############################### packages ######################################
+import inspect
+import threading
+import time
+from collections import Counter
+from functools import wraps
+import pandas as pd
+
+from . import tcp_codec
+from . import tcp_raw
+from .tcp_ctrl import tcp_ctrl
+
+# getter -> (command name, reply argument formats)
+getters = {
+    'ScanFrameGet':        ('Scan.FrameGet', ('float32', 'float32', 'float32', 'float32', 'float32')),
+    'ScanBufferGet':       ('Scan.BufferGet', ('int', '1dint', 'int', 'int')),
+    'ScanSpeedGet':        ('Scan.SpeedGet', ('float32', 'float32', 'float32', 'float32', 'uint16', 'float32')),
+    'FolMeSpeedGet':       ('FolMe.SpeedGet', ('float32', 'uint32')),
+    'FolMeOversamplGet':   ('FolMe.OversamplGet', ('int', 'float32')),
+    'TipRecBufferSizeGet': ('TipRec.BufferSizeGet', ('int',)),
+    'LockInModAmpGet':     ('LockIn.ModAmpGet', ('float32',)),
+}
+# setter -> (getter, number of leading arguments selecting the entry (e.g. the modulator),
+#            True: the other arguments are the reply of the getter, False: the entry is dropped)
+setters = {
+    'ScanFrameSet':        ('ScanFrameGet', 0, True),       # applied as sent (float32 both ways)
+    'ScanBufferSet':       ('ScanBufferGet', 0, False),     # pixels coerced to a multiple of 16, lines may follow the ratio
+    'ScanSpeedSet':        ('ScanSpeedGet', 0, False),      # Nanonis computes the speeds that are not kept constant
+    'FolMeSpeedSet':       ('FolMeSpeedGet', 0, True),
+    'FolMeOversamplSet':   ('FolMeOversamplGet', 0, False), # the sample rate follows the oversampling
+    'TipRecBufferSizeSet': ('TipRecBufferSizeGet', 0, True),
+    'LockInModAmpSet':     ('LockInModAmpGet', 1, True),
+}
+
+class state_cache:
+    def __init__(self, ttl = None):
+        """
+       Parameters
+       ttl             : seconds a cached value is trusted, None: until invalidated or set again.
+                         One state_cache can be shared by several connections to the same Nanonis.
+       """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}   # (getter, selecting arguments) -> (reply message without the header, time stored)
+        self.counts = {}    # command -> Counter of 'hits', 'misses', 'suppressed', 'sent'
+        self.t_start = time.perf_counter()
+
+    def count(self, name, what):
+        with self.lock:
+            counts = self.counts.get(name)
+            if counts is None:
+                counts = self.counts[name] = Counter()
+            counts[what] += 1
+
+    def get(self, key):
+        '''stored reply body of key, None if there is none or it has expired'''
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+            return None
+        return entry[0]
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = (bytes(body), time.monotonic())
+
+    def drop(self, getter):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == getter]:
+                del self.entries[key]
+
+    def invalidate(self, *names):
+        '''forget the cached values of the getters or setters names, all when none is given'''
+        with self.lock:
+            if not names:
+                self.entries.clear()
+                return
+        for name in names:
+            self.drop(setters[name][0] if name in setters else name)
+
+    def reset(self):
+        '''set the counters to zero'''
+        with self.lock:
+            self.counts = {}
+            self.t_start = time.perf_counter()
+
+    @property
+    def saved(self):
+        '''round trips saved since the start (or reset): getters served from the cache and sets not sent'''
+        with self.lock:
+            return sum(counts['hits'] + counts['suppressed'] for counts in self.counts.values())
+
+    def stats(self, prt = False):
+        '''hits and misses of the getters, suppressed and sent setters per command since the start (or reset)'''
+        with self.lock:
+            rows = {name: {what: counts[what] for what in ('hits', 'misses', 'suppressed', 'sent')}
+                    for name, counts in self.counts.items()}
+        stats_df = pd.DataFrame.from_dict(rows, orient = 'index', columns = ['hits', 'misses', 'suppressed', 'sent'])
+        stats_df.index.name = 'Command'
+        if prt:
+            elapsed = time.perf_counter() - self.t_start
+            print('\n' + stats_df.to_string() + f'\n\n{self.saved} round trips saved in the last {elapsed:.1f} s.')
+        return stats_df
+
+############################### calls #########################################
+def reply_body(tcp, reply_fmt, values):
+    '''reply message body (arguments and error) Nanonis would send for values'''
+    body = b''.join(tcp.dtype_cvt(tcp.unit_cvt(value), fmt, 'bin') for value, fmt in zip(values, reply_fmt))
+    return body + tcp_codec.error_struct.pack(0, 0)
+
+def reply_cached(func, ctrl, args, kwargs, getter, body):
+    '''tcp_raw.reply of a call answered from the cache (body: stored reply of getter, None: a setter not sent)'''
+    if body is None:
+        return tcp_raw.reply([], (0, 0, ''), None, ctrl.tcp).bind(func, ctrl, args, kwargs)
+    command_name, reply_fmt = getters[getter]
+    frame = bytearray(tcp_codec.header_encode(command_name, len(body), res = False)) + body # own copy, the arguments are views on it
+    res_arg, _ = tcp_codec.decode_args(tcp_codec.compile_plan(reply_fmt), frame)
+    return tcp_raw.reply(res_arg, (0, 0, ''), frame, ctrl.tcp).bind(func, ctrl, args, kwargs)
+
+def reply_live(func, ctrl, args, kwargs):
+    '''run func in raw mode: (tcp_raw.reply, None), or (None, return value) if it returned without a reply'''
+    tcp = ctrl.tcp
+    tcp.raw += 1
+    try:
+        return None, func(ctrl, *args, **kwargs)
+    except tcp_raw.reply_ready as ready:
+        return ready.reply.bind(func, ctrl, args, kwargs), None
+    finally:
+        tcp.raw -= 1
+
+def state_call(func):
+    name = func.__name__
+    if name in getters:
+        getter, n_key, write_through = name, None, False
+    else:
+        getter, n_key, write_through = setters[name]
+    params = [param for param in list(inspect.signature(func).parameters)[1:] if param != 'prt']
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = getattr(self, 'state', None)
+        if cache is None or type(self.tcp) is not tcp_ctrl: # no cache, or batched / replayed (tcp stand-in)
+            if cache is not None and getter != name:
+                cache.drop(getter)
+            return func(self, *args, **kwargs)
+        caller_raw = self.tcp.raw
+        values = [kwargs[param] if param in kwargs else args[i] for i, param in enumerate(params) if param in kwargs or i < len(args)]
+
+        if getter == name:
+            key = (getter, tuple(values))
+            body = cache.get(key)
+            if body is not None:
+                cache.count(name, 'hits')
+                reply = reply_cached(func, self, args, kwargs, getter, body)
+                return reply if caller_raw else reply.df
+            cache.count(name, 'misses')
+            reply, value = reply_live(func, self, args, kwargs)
+            if reply is None:
+                return value
+            if reply.frame is not None and reply.error[0] == 0:
+                cache.put(key, reply.frame[tcp_codec.HEADER_SIZE:])
+            return reply if caller_raw else reply.df
+
+        key = (getter, tuple(values[:n_key]))
+        body = None
+        if write_through and len(values) == len(params):
+            body = reply_body(self.tcp, getters[getter][1], values[n_key:])
+            if cache.get(key) == body:
+                cache.count(name, 'suppressed')
+                reply = reply_cached(func, self, args, kwargs, getter, None)
+                return reply if caller_raw else reply.df
+        cache.count(name, 'sent')
+        cache.drop(getter)
+        reply, value = reply_live(func, self, args, kwargs)
+        if reply is None:
+            return value
+        if body is not None and reply.error[0] == 0:
+            cache.put(key, body)
+        return reply if caller_raw else reply.df
+    return wrapper
+
+def apply_state(cls):
+    '''
+    Serve the getters of cls listed in getters from the state cache of the instance (self.state)
+    and record its setters. Apply before tcp_raw.apply_raw.
+    '''
+    for attr_name in list(getters) + list(setters):
+        if attr_name in vars(cls):
+            setattr(cls, attr_name, state_call(vars(cls)[attr_name]))
+    return cls
@@ -0,0 +1,160 @@
+# -*- encoding: utf-8 -*-
+'''
+Per-command latency and throughput statistics of Nanonis TCP connections.
+
+    stats = tcp_stats(csv_path = 'tcp_stats.csv')   # written at exit (or call to_csv)
+    connect = nanonis_ctrl(tcp_ctrl('127.0.0.1', 6501, stats = stats))
+    ...
+    stats.snapshot(prt = True)
+
+For every command name: number of requests and replies, bytes sent and received, round
+trip time (request written -> reply completely read, i.e. network + Nanonis) as a histogram,
+and the time spent decoding the replies. For pipelined requests (batch) the round trip time
+also holds the time the client spent on the replies read before. One tcp_stats can be shared
+by several connections (e.g. all connections of a tcp_pool).
+'''
+############################### packages ######################################
+import atexit
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from . import tcp_codec
+
+# upper edges of the round trip time histogram bins (s), the last bin takes the rest
+rtt_bin_edges = (1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1., 2., 5., 10., np.inf)
+
+class command_record:
+    def __init__(self):
+        self.requests = 0
+        self.replies = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rtt_sum = 0.
+        self.rtt_min = np.inf
+        self.rtt_max = 0.
+        self.rtt_hist = [0]*len(rtt_bin_edges)
+        self.decodes = 0
+        self.decode_sum = 0.
+
+    def rtt_percentile(self, q):
+        '''upper edge of the histogram bin holding the q-th percentile (an upper bound)'''
+        if not self.replies:
+            return np.nan
+        rank = q/100*self.replies
+        count = 0
+        for edge, n in zip(rtt_bin_edges, self.rtt_hist):
+            count += n
+            if count >= rank:
+                return min(edge, self.rtt_max)
+        return self.rtt_max
+
+class tcp_stats:
+    def __init__(self, csv_path = None):
+        """
+       Parameters
+       csv_path        : write snapshot() to this CSV file when Python exits (None: only on to_csv)
+       """
+        self.lock = threading.Lock()
+        self.records = {}
+        self.t_start = time.perf_counter()
+        self.csv_path = csv_path
+        if csv_path is not None:
+            atexit.register(self.to_csv, csv_path)
+
+    def record(self, command_name):
+        rec = self.records.get(command_name)
+        if rec is None:
+            rec = self.records[command_name] = command_record()
+        return rec
+
+    # requests written to the socket. in_flight is the connection's queue of the replies it waits for
+    def sent(self, data, in_flight):
+        t_send = time.perf_counter()
+        offset = 0
+        with self.lock:
+            while offset + tcp_codec.HEADER_SIZE <= len(data):
+                command_name = bytes(data[offset: offset + 32]).rstrip(b'\x00').decode('iso-8859-1')
+                body_size, res, _ = tcp_codec.size_flag_struct.unpack_from(data, offset + 32)
+                rec = self.record(command_name)
+                rec.requests += 1
+                rec.bytes_sent += tcp_codec.HEADER_SIZE + body_size
+                if res:
+                    in_flight.append(t_send)
+                offset += tcp_codec.HEADER_SIZE + body_size
+
+    # a reply completely received
+    def received(self, frame, in_flight):
+        t_recv = time.perf_counter()
+        command_name = tcp_codec.decode_header(frame)[0]
+        with self.lock:
+            rec = self.record(command_name)
+            rec.replies += 1
+            rec.bytes_received += len(frame)
+            if in_flight:
+                rtt = t_recv - in_flight.popleft()
+                rec.rtt_sum += rtt
+                rec.rtt_min = min(rec.rtt_min, rtt)
+                rec.rtt_max = max(rec.rtt_max, rtt)
+                rec.rtt_hist[int(np.searchsorted(rtt_bin_edges, rtt))] += 1
+
+    def decoded(self, command_name, duration):
+        with self.lock:
+            rec = self.record(command_name)
+            rec.decodes += 1
+            rec.decode_sum += duration
+
+    def reset(self):
+        with self.lock:
+            self.records = {}
+            self.t_start = time.perf_counter()
+
+    def snapshot(self, prt = False):
+        """
+        Statistics per command since the start (or reset), sorted by the total round trip time,
+        i.e. the commands that cost the most time come first. Times in ms.
+        """
+        with self.lock:
+            rows = {}
+            for command_name, rec in self.records.items():
+                replies = rec.replies or np.nan
+                decodes = rec.decodes or np.nan
+                rows[command_name] = {'Requests': rec.requests,
+                                      'Replies': rec.replies,
+                                      'Bytes sent': rec.bytes_sent,
+                                      'Bytes received': rec.bytes_received,
+                                      'RTT total (ms)': rec.rtt_sum*1e3,
+                                      'RTT mean (ms)': rec.rtt_sum/replies*1e3,
+                                      'RTT min (ms)': rec.rtt_min*1e3 if rec.replies else np.nan,
+                                      'RTT p50 (ms)': rec.rtt_percentile(50)*1e3,
+                                      'RTT p95 (ms)': rec.rtt_percentile(95)*1e3,
+                                      'RTT max (ms)': rec.rtt_max*1e3 if rec.replies else np.nan,
+                                      'Decode total (ms)': rec.decode_sum*1e3,
+                                      'Decode mean (ms)': rec.decode_sum/decodes*1e3}
+        stats_df = pd.DataFrame.from_dict(rows, orient = 'index')
+        if len(stats_df):
+            stats_df = stats_df.sort_values('RTT total (ms)', ascending = False)
+        stats_df.index.name = 'Command'
+        if prt:
+            elapsed = time.perf_counter() - self.t_start
+            print('\n' + stats_df.round(3).to_string() + f'\n\nTCP statistics of the last {elapsed:.1f} s returned.')
+        return stats_df
+
+    def histogram(self):
+        '''round trip time histogram: number of replies per command (rows) and bin (columns, upper edge in ms)'''
+        with self.lock:
+            hist = {command_name: rec.rtt_hist for command_name, rec in self.records.items()}
+            hist_df = pd.DataFrame.from_dict(hist, orient = 'index', columns = [f'<={edge*1e3:g}' for edge in rtt_bin_edges])
+        hist_df.index.name = 'Command'
+        hist_df.columns.name = 'RTT (ms)'
+        return hist_df
+
+    def to_csv(self, path = None):
+        '''write snapshot() and the RTT histogram (path with "_hist" appended) to CSV files'''
+        path = self.csv_path if path is None else path
+        stats_df = self.snapshot()
+        stats_df.to_csv(path)
+        root, dot, ext = path.rpartition('.')
+        self.histogram().to_csv(f'{root}_hist.{ext}' if dot else f'{path}_hist')
+        return stats_df